@@ -0,0 +1,145 @@
+"""
+Query plans and timings of the hot lookups, before and after the indexes
+of luci migration 0025.
+
+Builds a scratch SQLite database migrated up to 0023, fills it with a
+synthetic corpus, measures the lookups, then migrates to the latest
+schema and measures them again:
+
+    python benchmarks/query_plans.py --messages 200000
+
+Set DJANGO_SETTINGS_MODULE to measure another database instead, such as a
+MariaDB copy. Its luci tables are migrated back and forth, so never point
+it to a database whose data matters.
+"""
+import argparse
+import os
+import sys
+import tempfile
+from datetime import timedelta
+from statistics import median
+from time import perf_counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+BEFORE = '0023_word_frequency'
+
+
+def setup(database):
+    from django.conf import settings
+    if 'DJANGO_SETTINGS_MODULE' in os.environ:
+        return
+
+    from jion.settings import development
+    options = {name: getattr(development, name) for name in dir(development) if name.isupper()}
+    options['SECRET_KEY'] = options['SECRET_KEY'] or 'benchmark'
+    options['DATABASES'] = {
+        'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': database}
+    }
+    settings.configure(**options)
+
+
+def populate(users, messages, chunk_size=5000):
+    from django.utils import timezone
+    from luci.management.commands.import_corpus import keep_stored_value
+    from luci.models import CustomConfig, Emotion, Message, Quote, User
+
+    references = [f'reference-{index}' for index in range(users)]
+    Emotion.objects.bulk_create(
+        [Emotion(reference=reference) for reference in references]
+    )
+    User.objects.bulk_create(
+        [User(reference=reference, name=reference) for reference in references]
+    )
+    CustomConfig.objects.bulk_create(
+        [CustomConfig(reference=reference) for reference in references[:users // 10 or 1]]
+    )
+    Quote.objects.bulk_create(
+        [
+            Quote(reference=references[index % users], quote=b'quote %d' % index, author='author')
+            for index in range(messages // 10)
+        ]
+    )
+
+    # messages are spread over time, which auto_now_add would override
+    now = timezone.now()
+    with keep_stored_value(Message, 'message_datetime'):
+        for start in range(0, messages, chunk_size):
+            Message.objects.bulk_create([
+                Message(
+                    reference=references[index % users],
+                    global_intention=f'global-{index % 20}',
+                    specific_intention=f'specific-{index % 200}',
+                    text=b'message %d' % index,
+                    message_datetime=now - timedelta(seconds=index),
+                )
+                for index in range(start, min(start + chunk_size, messages))
+            ])
+
+
+def lookups(users):
+    from luci.models import CustomConfig, Emotion, Message, Quote, User
+
+    reference = f'reference-{users // 2}'
+    return [
+        ('users(reference)', User.objects.filter(reference=reference).order_by('id')[:100]),
+        ('emotions(reference)', Emotion.objects.filter(reference=reference)),
+        ('custom_config(reference)', CustomConfig.objects.filter(reference=reference)),
+        ('quotes(reference)', Quote.objects.filter(reference=reference).order_by('id')[:100]),
+        (
+            'messages(reference)',
+            Message.objects.filter(reference=reference).order_by('message_datetime', 'id')[:100]
+        ),
+        ('messages page', Message.objects.order_by('message_datetime', 'id')[:100]),
+        (
+            'messages(intentions)',
+            Message.objects.filter(
+                global_intention='global-3', specific_intention='specific-23'
+            ).order_by('message_datetime', 'id')[:100]
+        ),
+    ]
+
+
+def measure(users, repeat):
+    results = {}
+    for name, queryset in lookups(users):
+        timings = []
+        for _ in range(repeat):
+            start = perf_counter()
+            list(queryset.all())
+            timings.append(perf_counter() - start)
+        results[name] = (queryset.explain(), median(timings) * 1000)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--users', type=int, default=5000)
+    parser.add_argument('--messages', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        setup(os.path.join(directory, 'benchmark.sqlite3'))
+
+        import django
+        from django.core.management import call_command
+        django.setup()
+
+        call_command('migrate', 'luci', BEFORE, verbosity=0)
+        populate(args.users, args.messages)
+        before = measure(args.users, args.repeat)
+
+        call_command('migrate', 'luci', verbosity=0)
+        after = measure(args.users, args.repeat)
+
+    for name in before:
+        print(f'== {name}')
+        for label, (plan, milliseconds) in (('before', before[name]), ('after', after[name])):
+            print(f'-- {label}: {milliseconds:.3f} ms')
+            print(plan)
+        print()
+
+
+if __name__ == '__main__':
+    main()
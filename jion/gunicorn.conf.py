@@ -0,0 +1,27 @@
+"""
+Gunicorn configuration of the jion container.
+
+Django 2.2 and graphene-django 2 only run synchronous views, so instead of
+an ASGI server each process serves concurrent requests with a pool of
+threads (gthread workers). Requests waiting on the database or on the
+network release the GIL, and the chain calls are sent by the chain worker,
+outside of the request path. Each thread keeps its own database
+connection, so WEB_CONCURRENCY * GUNICORN_THREADS must stay under the
+database max_connections.
+"""
+import os
+
+bind = os.environ.get('GUNICORN_BIND', ':6500')
+workers = int(os.environ.get('WEB_CONCURRENCY', 3))
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', 8))
+
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 30))
+graceful_timeout = 30
+keepalive = 5
+
+# recycle workers from time to time, bounding memory fragmentation
+max_requests = 10000
+max_requests_jitter = 1000
+
+accesslog = '-'
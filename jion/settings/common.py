@@ -49,10 +49,16 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'luci.routers.ReplicaMiddleware',
 ]
 
 ROOT_URLCONF = 'jion.urls'
 
+# Read replicas, aliases of DATABASES used by GraphQL queries (luci.routers)
+DATABASE_ROUTERS = ['luci.routers.ReplicaRouter']
+DATABASE_REPLICAS = []
+REPLICA_HEALTH_CHECK_INTERVAL = int(os.environ.get('REPLICA_HEALTH_CHECK_INTERVAL', 10))
+
 TEMPLATES = [
     {
         'BACKEND': 'django.template.backends.django.DjangoTemplates',
@@ -125,10 +131,114 @@ GRAPHENE = {
     'SCHEMA': 'jion.schema.schema',
 }
 
+# Shared by every process, so use memcached or similar in production
+CACHES = {
+    'default': {
+        'BACKEND': os.environ.get(
+            'CACHE_BACKEND',
+            'django.core.cache.backends.locmem.LocMemCache'
+        ),
+        'LOCATION': os.environ.get('CACHE_LOCATION', ''),
+    }
+}
+
+# Persisted query texts are kept in the cache for PERSISTED_QUERY_TIMEOUT
+# seconds, parsed documents in a LRU of PERSISTED_QUERY_CACHE_SIZE per process
+PERSISTED_QUERY_TIMEOUT = 7 * 24 * 3600
+PERSISTED_QUERY_CACHE_SIZE = 256
+
+# Limits of the queries accepted by /graphql/ (luci.limits). Cost estimates
+# the objects resolved, taking QUERY_DEFAULT_LIST_SIZE items for list fields
+# without a first, k or limit argument.
+QUERY_MAX_DEPTH = int(os.environ.get('QUERY_MAX_DEPTH', 10))
+QUERY_MAX_COST = int(os.environ.get('QUERY_MAX_COST', 20000))
+QUERY_DEFAULT_LIST_SIZE = 100
+
+# Rows read per query by the /export/ views
+EXPORT_CHUNK_SIZE = 1000
+
+# Matched messages linked per INSERT ... SELECT by assign_response
+ASSIGN_RESPONSE_CHUNK_SIZE = 500
+
+# Lookup cache of custom configs, emotions and users by reference (luci.cache).
+# Invalidations are not broadcast: other processes see changes once their
+# local entries expire, so reads are at most CACHE_LOCAL_TIMEOUT seconds
+# stale. Misses are loaded from the primary for CACHE_PRIMARY_WINDOW seconds
+# after a write, which should exceed the replication lag.
+# The shared tier keeps the generation tokens in CACHES, so it is only on by
+# default when CACHE_BACKEND is shared by every process.
+CACHE_LOCAL_SIZE = 1024
+CACHE_LOCAL_TIMEOUT = float(os.environ.get('CACHE_LOCAL_TIMEOUT', 5))
+CACHE_SHARED_TIER = os.environ.get(
+    'CACHE_SHARED_TIER',
+    'false' if CACHES['default']['BACKEND'].endswith('.LocMemCache') else 'true'
+) == 'true'
+CACHE_SHARED_TIMEOUT = 300
+CACHE_PRIMARY_WINDOW = float(os.environ.get('CACHE_PRIMARY_WINDOW', 10))
+
+# Word counts staged by the mutations storing texts are added to Word by
+# flush_vocabulary, VOCABULARY_FLUSH_BATCH_SIZE staged rows per transaction
+# and VOCABULARY_UPDATE_CHUNK_SIZE words per UPDATE.
+VOCABULARY_FLUSH_INTERVAL = float(os.environ.get('VOCABULARY_FLUSH_INTERVAL', 5))
+VOCABULARY_FLUSH_BATCH_SIZE = 5000
+VOCABULARY_UPDATE_CHUNK_SIZE = 500
+
+# Page sizes of the messages, users, words and quotes queries
+PAGINATION_DEFAULT_PAGE_SIZE = 100
+PAGINATION_MAX_PAGE_SIZE = 1000
+
+# Codec used for storing message and quote texts: plain, zlib, lzma or zdict.
+# Messages are deduplicated by their stored blob, so run compress_texts after
+# changing it or training a dictionary to bring the stored rows to it.
+TEXT_CODEC = os.environ.get('TEXT_CODEC', 'plain')
+TEXT_COMPRESSION_LEVEL = int(os.environ.get('TEXT_COMPRESSION_LEVEL', 9))
+
+# Messages older than ARCHIVE_AFTER_DAYS are moved to ArchivedMessage by
+# archive_messages, their texts encoded with ARCHIVE_CODEC.
+ARCHIVE_AFTER_DAYS = int(os.environ.get('ARCHIVE_AFTER_DAYS', 365))
+ARCHIVE_CODEC = os.environ.get('ARCHIVE_CODEC', 'zdict')
+
+# TF-IDF index of the best_responses query, built by build_tfidf_index.
+# Candidates scored per requested response, before reference filtering.
+TFIDF_INDEX_DIR = os.environ.get('TFIDF_INDEX_DIR', os.path.join(BASE_DIR, 'tfidf_index'))
+TFIDF_CANDIDATE_FACTOR = 10
+
 ACCOUNT_ADDRESS = os.environ.get('ACCOUNT_ADDRESS')
 CONTRACT_ADDRESS = os.environ.get('CONTRACT_ADDRESS')
 PRIVATE_KEY = os.environ.get('PRIVATE_KEY')
-MAX_RETRIES = 1000000
+WEB3_PROVIDER_URL = os.environ.get(
+    'WEB3_PROVIDER_URL',
+    'https://sepolia.infura.io/v3/c0e36045c28c479eb09b407479b1d493'
+)
+WEB3_REQUEST_TIMEOUT = 10
+WEB3_POOL_SIZE = 4
+WEB3_GAS = 200000
+WEB3_GAS_PRICE_GWEI = '40'
+
+# Chain worker outbox (see luci.chain)
+WEB3_WORKER_INTERVAL = float(os.environ.get('WEB3_WORKER_INTERVAL', 1))
+WEB3_OUTBOX_BATCH_SIZE = 50
+WEB3_OUTBOX_MAX_ATTEMPTS = 10
+WEB3_OUTBOX_BACKOFF_BASE = 2
+WEB3_OUTBOX_BACKOFF_MAX = 600
+WEB3_RECEIPT_INTERVAL = float(os.environ.get('WEB3_RECEIPT_INTERVAL', 5))
+WEB3_RECEIPT_BATCH_SIZE = 100
+# Seconds a sent transaction may be unknown to the node before it is taken
+# as dropped and sent again
+WEB3_DROPPED_TIMEOUT = int(os.environ.get('WEB3_DROPPED_TIMEOUT', 600))
+# Seconds the pending nonce may stay below the cursor before the missing
+# nonce is resent or filled
+WEB3_NONCE_STALL_TIMEOUT = int(os.environ.get('WEB3_NONCE_STALL_TIMEOUT', 120))
+# Seconds a worker may go without a heartbeat before the entries it was
+# sending are reclaimed by the others
+WEB3_WORKER_LEASE = int(os.environ.get('WEB3_WORKER_LEASE', 120))
+
+# Coalesce message counts into one call per member and window. Only used if
+# the contract ABI has WEB3_COUNT_FUNCTION(member_id, amount).
+WEB3_AGGREGATE_COUNTS = os.environ.get('WEB3_AGGREGATE_COUNTS', '') == 'true'
+WEB3_COUNT_FUNCTION = os.environ.get('WEB3_COUNT_FUNCTION', 'add_member_msg_count')
+WEB3_AGGREGATION_WINDOW = int(os.environ.get('WEB3_AGGREGATION_WINDOW', 60))
+WEB3_AGGREGATION_BATCH_SIZE = int(os.environ.get('WEB3_AGGREGATION_BATCH_SIZE', 100))
 ABI = '''[
 	{
 		"inputs": [],
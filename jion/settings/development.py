@@ -10,3 +10,13 @@ DATABASES = {
         'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
     }
 }
+
+# SQLITE_REPLICA=true reads GraphQL queries from a copy of db.sqlite3,
+# made with `make replica`
+if os.environ.get('SQLITE_REPLICA', '') == 'true':
+    DATABASES['replica'] = {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.path.join(BASE_DIR, 'db.replica.sqlite3'),
+        'TEST': {'MIRROR': 'default'},
+    }
+    DATABASE_REPLICAS = ['replica']
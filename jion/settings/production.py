@@ -5,13 +5,27 @@ from jion.settings.common import *
 SECRET_KEY = os.environ.get('SECRET_KEY', '')
 DEBUG = False
 
-DATABASES = {
-    'default': {
+
+def mysql_database(host):
+    return {
         'ENGINE': 'django.db.backends.mysql',
         'NAME': os.environ.get('MYSQL_DATABASE', ''),
         'USER': os.environ.get('MYSQL_USER', ''),
         'PASSWORD': os.environ.get('MYSQL_PASSWORD', ''),
-        'HOST': os.environ.get('MYSQL_HOST', ''),
+        'HOST': host,
         'PORT': 3306,
+        # seconds a connection is kept open between requests
+        'CONN_MAX_AGE': int(os.environ.get('DB_CONN_MAX_AGE', 60)),
     }
+
+
+DATABASES = {
+    'default': mysql_database(os.environ.get('MYSQL_HOST', '')),
 }
+
+# comma separated hosts of read replicas of the default database
+for index, host in enumerate(filter(None, os.environ.get('MYSQL_REPLICA_HOSTS', '').split(','))):
+    alias = f'replica_{index + 1}'
+    DATABASES[alias] = mysql_database(host.strip())
+    DATABASES[alias]['TEST'] = {'MIRROR': 'default'}
+    DATABASE_REPLICAS.append(alias)
@@ -17,8 +17,10 @@ from django.contrib import admin
 from django.urls import path
 
 from django.views.decorators.csrf import csrf_exempt
-from graphene_django.views import GraphQLView
+from luci.views import PersistedQueryView, export, health
 
 urlpatterns = [
-    path('graphql/', csrf_exempt(GraphQLView.as_view(graphiql=True))),
+    path('graphql/', csrf_exempt(PersistedQueryView.as_view(graphiql=True))),
+    path('export/<str:kind>/', export),
+    path('health/', health),
 ]
@@ -3,3 +3,6 @@ from django.apps import AppConfig
 
 class LuciConfig(AppConfig):
     name = 'luci'
+
+    def ready(self):
+        from luci import checks  # noqa: F401 registers the system checks
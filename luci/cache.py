@@ -0,0 +1,223 @@
+"""
+Read-through cache of the rows looked up by reference.
+
+Entries are keyed by kind and reference and looked up in two tiers: a LRU
+local to the process, then, if CACHE_SHARED_TIER is on, the Django cache
+shared by every process. Misses are loaded from the database and stored in
+both tiers.
+
+Each key has a generation token, kept in the shared cache (or the process
+without the shared tier), which mutations replace once their transaction
+commits. Entries are stored with the token read before loading them, and
+shared entries whose token was replaced are misses, so a load racing a
+write can not cache the old row for CACHE_SHARED_TIMEOUT. Misses within
+CACHE_PRIMARY_WINDOW seconds of a write are loaded from the primary
+database, as replicas may not have the write yet.
+
+Local entries are not checked against the token: a process drops its own
+entries on commit, but other processes keep serving theirs until they
+expire, so reads can be up to CACHE_LOCAL_TIMEOUT seconds stale.
+"""
+import threading
+from collections import OrderedDict
+from time import monotonic, time
+from uuid import uuid4
+from django.conf import settings
+from django.core.cache import cache as shared_cache
+from django.db import transaction
+from luci import routers
+
+CUSTOM_CONFIG = 'custom_config'
+EMOTIONS = 'emotions'
+USERS = 'users'
+
+# cached when the row does not exist, so lookups of it are cached too
+MISSING = 'missing'
+
+
+class LocalCache:
+    """
+    Thread safe LRU whose entries expire after a timeout.
+    """
+    def __init__(self, size, timeout):
+        self.size = size
+        self.timeout = timeout
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+
+            expires_at, value = entry
+            if expires_at <= monotonic():
+                del self.entries[key]
+                return None
+
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = (monotonic() + self.timeout, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+
+local_cache = LocalCache(settings.CACHE_LOCAL_SIZE, settings.CACHE_LOCAL_TIMEOUT)
+
+_stats_lock = threading.Lock()
+_stats = {
+    'local_hits': 0,
+    'shared_hits': 0,
+    'misses': 0,
+    'invalidations': 0,
+}
+
+
+def count(stat, amount=1):
+    with _stats_lock:
+        _stats[stat] += amount
+
+
+def get_stats():
+    """
+    Return the counters of this process, with the size of its local tier.
+    """
+    with _stats_lock:
+        stats = dict(_stats)
+    stats['local_size'] = len(local_cache)
+    return stats
+
+
+def reset_stats():
+    with _stats_lock:
+        for stat in _stats:
+            _stats[stat] = 0
+
+
+def make_key(kind, reference):
+    return f'luci:{kind}:{reference}'
+
+
+def make_generation_key(key):
+    return f'{key}:generation'
+
+
+_generations_lock = threading.Lock()
+_generations = {}
+
+
+def new_generation(written_at=0):
+    return (uuid4().hex, written_at)
+
+
+def get_generation(key):
+    """
+    Return the (token, written_at) generation of a key, creating it if
+    there is none, as after an eviction.
+    """
+    if not settings.CACHE_SHARED_TIER:
+        with _generations_lock:
+            return _generations.setdefault(key, new_generation())
+
+    generation_key = make_generation_key(key)
+    generation = shared_cache.get(generation_key)
+    if generation is None:
+        shared_cache.add(generation_key, new_generation(), None)
+        generation = shared_cache.get(generation_key)
+
+    return generation
+
+
+def renew_generation(key):
+    generation = new_generation(time())
+    if settings.CACHE_SHARED_TIER:
+        shared_cache.set(make_generation_key(key), generation, None)
+    else:
+        with _generations_lock:
+            _generations[key] = generation
+
+
+def get_shared(key):
+    """
+    Return the shared entry of a key if it was loaded in its current generation.
+    """
+    generation_key = make_generation_key(key)
+    values = shared_cache.get_many([key, generation_key])
+    entry = values.get(key)
+    generation = values.get(generation_key)
+    if entry is None or generation is None:
+        return None
+
+    token, value = entry
+    return value if token == generation[0] else None
+
+
+def get_or_load(kind, reference, load):
+    """
+    Return the cached value of kind and reference, calling load() on a miss.
+    Load may return None for missing rows, which is cached as well.
+    """
+    key = make_key(kind, reference)
+    value = local_cache.get(key)
+    if value is not None:
+        count('local_hits')
+        return None if value == MISSING else value
+
+    if settings.CACHE_SHARED_TIER:
+        value = get_shared(key)
+        if value is not None:
+            count('shared_hits')
+            local_cache.set(key, value)
+            return None if value == MISSING else value
+
+    count('misses')
+    token, written_at = get_generation(key)
+    if time() - written_at < settings.CACHE_PRIMARY_WINDOW:
+        with routers.primary_reads():
+            value = load()
+    else:
+        value = load()
+
+    stored = MISSING if value is None else value
+    if settings.CACHE_SHARED_TIER:
+        shared_cache.set(key, (token, stored), settings.CACHE_SHARED_TIMEOUT)
+    # a write committed during the load makes the value stale
+    if get_generation(key)[0] == token:
+        local_cache.set(key, stored)
+
+    return value
+
+
+def invalidate(kind, references):
+    """
+    Drop the entries of kind for the references and renew their generation,
+    once the current transaction commits, so no request can cache the old
+    rows again.
+    """
+    keys = [make_key(kind, reference) for reference in set(references)]
+
+    def delete():
+        for key in keys:
+            renew_generation(key)
+            local_cache.delete(key)
+        if settings.CACHE_SHARED_TIER:
+            shared_cache.delete_many(keys)
+        count('invalidations', len(keys))
+
+    transaction.on_commit(delete)
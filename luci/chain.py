@@ -0,0 +1,533 @@
+"""
+Contract calls made on behalf of Luci members.
+
+Mutations never talk to the chain: they queue a ChainTransaction row in the
+same database transaction as their own writes. The worker started by the
+`run_chain_worker` command sends queued rows, retrying failures with
+exponential backoff. Receipts of sent rows are recorded by luci.receipts.
+Workers keep a heartbeat while running, and the rows a worker was sending
+are only reclaimed by the others once it missed settings.WEB3_WORKER_LEASE.
+
+Nonces are allocated from a NonceCursor row locked for the allocation, so
+several processes can keep transactions in flight from the same account
+without asking the chain for the next nonce every time. An entry keeps its
+nonce and signed transaction from the first attempt on, and retries resend
+the same transaction, so a send whose outcome is unknown can never be
+mined twice. Nonces are never given back: the worker follows the pending
+nonce of the account, and when it stops advancing below the cursor it
+resends the transaction holding the missing nonce, or fills the gap with
+an empty transaction if no entry will send it anymore.
+
+When count aggregation is enabled, messages of a member queued within
+settings.WEB3_AGGREGATION_WINDOW are coalesced into a single call of
+settings.WEB3_COUNT_FUNCTION, carrying the number of messages.
+"""
+import json
+import logging
+import os
+import socket
+from datetime import timedelta
+from functools import lru_cache
+from uuid import uuid4
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+from web3.exceptions import TransactionNotFound
+from luci.models import ChainTransaction, ChainWorker, NonceCursor
+
+logger = logging.getLogger(__name__)
+
+UPDATE_MEMBER_MSG_COUNT = 'update_member_msg_count'
+
+# what a failed eth_sendRawTransaction tells about the transaction
+SEND_UNKNOWN = 'unknown'  # it may have reached the node
+SEND_KNOWN = 'known'  # the node already has it
+SEND_NONCE_USED = 'nonce_used'  # its nonce was already mined
+SEND_REJECTED = 'rejected'  # the node refused it, its nonce is still free
+
+# JSON-RPC error codes of refused submissions: the generic server error
+# used by geth, erigon and besu, EIP-1474 transaction rejected, and the
+# transaction error of nethermind and openethereum
+RPC_INVALID_PARAMS = -32602
+SUBMISSION_ERROR_CODES = (-32000, -32003, -32010)
+
+# message prefixes of those errors, lowercased, by client
+ALREADY_KNOWN_ERRORS = ('already known', 'known transaction', 'alreadyknown', 'transaction already imported')
+NONCE_TOO_LOW_ERRORS = ('nonce too low', 'oldnonce', 'nonce_too_low', 'transaction nonce is too low')
+
+# a transaction replacing a pending one must pay 10% more gas on geth
+GAP_FILL_GAS_PRICE_BUMP = 1.25
+TRANSFER_GAS = 21000
+
+
+@lru_cache(maxsize=None)
+def contract_has_count_function():
+    """
+    Tell if the contract ABI declares settings.WEB3_COUNT_FUNCTION
+    taking a member id and an amount.
+    """
+    for entry in json.loads(settings.ABI):
+        if entry.get('type') != 'function':
+            continue
+        if entry.get('name') == settings.WEB3_COUNT_FUNCTION:
+            return len(entry.get('inputs', [])) == 2
+
+    return False
+
+
+def aggregation_enabled():
+    return settings.WEB3_AGGREGATE_COUNTS and contract_has_count_function()
+
+
+def enqueue_member_message(member_id):
+    """
+    Queue an on-chain message count update for a member.
+    Must be called inside the transaction storing the message, so both
+    are committed, or discarded, together.
+    """
+    if not member_id or not member_id.isdigit():
+        return None
+
+    if not aggregation_enabled():
+        return ChainTransaction.objects.create(
+            function=UPDATE_MEMBER_MSG_COUNT,
+            member_id=member_id
+        )
+
+    return coalesce_member_messages(member_id, 1)
+
+
+def enqueue_member_messages(counts):
+    """
+    Queue the count updates of many members at once, given as a dict of
+    member id to number of messages.
+    """
+    counts = {
+        member_id: count for member_id, count in counts.items()
+        if member_id and member_id.isdigit()
+    }
+
+    if not aggregation_enabled():
+        ChainTransaction.objects.bulk_create([
+            ChainTransaction(function=UPDATE_MEMBER_MSG_COUNT, member_id=member_id)
+            for member_id, count in counts.items()
+            for _ in range(count)
+        ])
+        return
+
+    for member_id, count in counts.items():
+        coalesce_member_messages(member_id, count)
+
+
+def coalesce_member_messages(member_id, count):
+    """
+    Add messages to the open aggregated entry of a member, opening a new
+    entry if there is none.
+    """
+    # a single UPDATE, so concurrent requests never lose an increment
+    merged = ChainTransaction.objects.filter(
+        function=settings.WEB3_COUNT_FUNCTION,
+        member_id=member_id,
+        status=ChainTransaction.PENDING,
+        attempts=0
+    ).update(increment=F('increment') + count)
+    if merged:
+        return None
+
+    window = timedelta(seconds=settings.WEB3_AGGREGATION_WINDOW)
+    return ChainTransaction.objects.create(
+        function=settings.WEB3_COUNT_FUNCTION,
+        member_id=member_id,
+        increment=count,
+        next_attempt_at=timezone.now() + window
+    )
+
+
+def get_chain_nonce(w3, address):
+    return w3.eth.get_transaction_count(address, 'pending')
+
+
+def allocate_nonce(w3, address, entry=None):
+    """
+    Hand out the next nonce of an account, storing it on the entry in the
+    same transaction, so sync_nonce can never see the cursor moved past a
+    nonce no entry holds yet.
+    The chain is only asked for it the first time the account is used.
+    """
+    if not NonceCursor.objects.filter(address=address).exists():
+        NonceCursor.objects.get_or_create(
+            address=address,
+            defaults={'next_nonce': get_chain_nonce(w3, address)}
+        )
+
+    with transaction.atomic():
+        cursor = NonceCursor.objects.select_for_update().get(address=address)
+        nonce = cursor.next_nonce
+        cursor.next_nonce = nonce + 1
+        cursor.save(update_fields=['next_nonce'])
+        if entry is not None:
+            entry.nonce = nonce
+            entry.save(update_fields=['nonce', 'updated_at'])
+
+    return nonce
+
+
+def holds_nonces_from(nonce):
+    """
+    Tell if an entry holds a nonce from the given one on, whose transaction
+    may still be sent or mined.
+    """
+    return ChainTransaction.objects.filter(
+        nonce__gte=nonce,
+        status__in=[ChainTransaction.PENDING, ChainTransaction.SENDING, ChainTransaction.SENT]
+    ).exists()
+
+
+def sync_nonce(w3, address):
+    """
+    Record the pending nonce of the account and move the cursor to it when
+    that is safe: forward when transactions were sent from elsewhere, back
+    when the nonces after it are held by no entry.
+    Returns the pending nonce, and if it stopped advancing below the cursor
+    for settings.WEB3_NONCE_STALL_TIMEOUT.
+    """
+    chain_nonce = get_chain_nonce(w3, address)
+    now = timezone.now()
+    with transaction.atomic():
+        cursor, _ = NonceCursor.objects.select_for_update().get_or_create(
+            address=address,
+            defaults={'next_nonce': chain_nonce}
+        )
+        if cursor.chain_nonce != chain_nonce:
+            cursor.chain_nonce = chain_nonce
+            cursor.chain_nonce_changed_at = now
+
+        if chain_nonce > cursor.next_nonce or (
+            chain_nonce < cursor.next_nonce and not holds_nonces_from(chain_nonce)
+        ):
+            logger.warning(
+                'Nonce of %s moved from %s to %s',
+                address,
+                cursor.next_nonce,
+                chain_nonce
+            )
+            cursor.next_nonce = chain_nonce
+
+        cursor.synced_at = now
+        cursor.save()
+
+    stall = timedelta(seconds=settings.WEB3_NONCE_STALL_TIMEOUT)
+    stalled = chain_nonce < cursor.next_nonce and now - cursor.chain_nonce_changed_at >= stall
+    return chain_nonce, stalled
+
+
+def check_nonce(w3, address):
+    """
+    Recover the nonce the account waits for when its pending nonce stopped
+    advancing, while later nonces are in flight.
+    Returns the nonce recovered, if any.
+    """
+    chain_nonce, stalled = sync_nonce(w3, address)
+    if not stalled:
+        return None
+
+    recover_nonce(w3, address, chain_nonce)
+    # give the recovery time to be mined before trying again
+    NonceCursor.objects.filter(address=address).update(chain_nonce_changed_at=timezone.now())
+    return chain_nonce
+
+
+def recover_nonce(w3, address, nonce):
+    """
+    Resend the transaction of the entry holding a nonce, as it may have been
+    dropped by the node. Entries being sent or still to be signed are left
+    to the worker, and when no entry will send the nonce anymore it is
+    filled with an empty transaction.
+    """
+    owner = ChainTransaction.objects.filter(nonce=nonce).order_by('-id').first()
+    if owner is not None and owner.status in (ChainTransaction.PENDING, ChainTransaction.SENDING, ChainTransaction.SENT):
+        if owner.status == ChainTransaction.SENDING or owner.raw_transaction is None:
+            return
+
+        logger.warning('Nonce %s of %s stalled, resending entry %s', nonce, address, owner.id)
+        try:
+            w3.eth.send_raw_transaction(owner.raw_transaction)
+        except Exception as ex:
+            logger.warning('Resending entry %s failed (%s): %s', owner.id, classify_send_error(ex), ex)
+        return
+
+    fill_nonce(w3, address, nonce)
+
+
+def fill_nonce(w3, address, nonce):
+    """
+    Send an empty transfer to the account itself with a nonce, so the later
+    ones can be mined. It pays more gas than the transaction it may replace.
+    """
+    gas_price = w3.to_wei(settings.WEB3_GAS_PRICE_GWEI, 'gwei')
+    filler = w3.eth.account.sign_transaction({
+        'from': address,
+        'to': address,
+        'value': 0,
+        'nonce': nonce,
+        'gas': TRANSFER_GAS,
+        'gasPrice': int(gas_price * GAP_FILL_GAS_PRICE_BUMP),
+        'chainId': w3.eth.chain_id,
+    }, settings.PRIVATE_KEY)
+
+    try:
+        w3.eth.send_raw_transaction(filler.rawTransaction)
+    except Exception as ex:
+        outcome = classify_send_error(ex)
+        if outcome not in (SEND_KNOWN, SEND_NONCE_USED):
+            logger.error('Filling nonce %s of %s failed (%s): %s', nonce, address, outcome, ex)
+            return None
+
+    logger.warning('Filled nonce %s of %s with %s', nonce, address, filler.hash.hex())
+    return filler.hash.hex()
+
+
+def get_rpc_error(ex):
+    """
+    Return the JSON-RPC error object of an exception, web3 raising them as
+    a ValueError of the object.
+    """
+    if isinstance(ex, ValueError) and ex.args and isinstance(ex.args[0], dict):
+        error = ex.args[0]
+        if isinstance(error.get('code'), int):
+            return error
+
+    return None
+
+
+def classify_send_error(ex):
+    """
+    Tell what a failed eth_sendRawTransaction means for its transaction,
+    one of the SEND_* outcomes. Anything but an error answered by the node
+    for the submission itself may have reached it.
+    """
+    error = get_rpc_error(ex)
+    if error is None:
+        return SEND_UNKNOWN
+
+    code = error['code']
+    if code == RPC_INVALID_PARAMS:
+        return SEND_REJECTED
+    if code not in SUBMISSION_ERROR_CODES:
+        return SEND_UNKNOWN
+
+    message = str(error.get('message', '')).lower()
+    if message.startswith(ALREADY_KNOWN_ERRORS):
+        return SEND_KNOWN
+    if message.startswith(NONCE_TOO_LOW_ERRORS):
+        return SEND_NONCE_USED
+
+    return SEND_REJECTED
+
+
+def is_transaction_known(w3, transaction_hash):
+    """
+    Tell if the node has a transaction, pending or mined.
+    """
+    try:
+        w3.eth.get_transaction(transaction_hash)
+    except TransactionNotFound:
+        return False
+
+    return True
+
+
+def get_backoff(attempts):
+    """
+    Seconds to wait before retrying an entry that failed `attempts` times.
+    """
+    delay = settings.WEB3_OUTBOX_BACKOFF_BASE * 2 ** (attempts - 1)
+    return min(delay, settings.WEB3_OUTBOX_BACKOFF_MAX)
+
+
+def sign_transaction(entry, w3, contract):
+    """
+    Build and sign the contract call of an outbox entry with its nonce.
+    """
+    args = [int(entry.member_id)]
+    if entry.function == settings.WEB3_COUNT_FUNCTION:
+        args.append(entry.increment)
+
+    tx_meta = {
+        'from': settings.ACCOUNT_ADDRESS,
+        'nonce': entry.nonce,
+        'gas': settings.WEB3_GAS,
+        'gasPrice': w3.to_wei(settings.WEB3_GAS_PRICE_GWEI, 'gwei')
+    }
+    function = getattr(contract.functions, entry.function)
+    contract_call = function(*args).build_transaction(tx_meta)
+    return w3.eth.account.sign_transaction(contract_call, settings.PRIVATE_KEY)
+
+
+def send_transaction(entry, w3, contract):
+    """
+    Send the contract call of an outbox entry.
+    The nonce, and then the signed transaction with its hash, are stored
+    before sending, so a retry after any failure resends the same one.
+    """
+    if entry.nonce is None:
+        allocate_nonce(w3, settings.ACCOUNT_ADDRESS, entry)
+
+    if entry.raw_transaction is None:
+        signed_txn = sign_transaction(entry, w3, contract)
+        entry.raw_transaction = signed_txn.rawTransaction.hex()
+        entry.transaction_hash = signed_txn.hash.hex()
+        entry.save(update_fields=['raw_transaction', 'transaction_hash', 'updated_at'])
+
+    try:
+        w3.eth.send_raw_transaction(entry.raw_transaction)
+    except Exception as ex:
+        outcome = classify_send_error(ex)
+        if outcome == SEND_NONCE_USED and is_transaction_known(w3, entry.transaction_hash):
+            # mined after an attempt whose outcome was unknown
+            outcome = SEND_KNOWN
+        elif outcome == SEND_NONCE_USED:
+            # the nonce went to a transaction sent from elsewhere, so this
+            # one can never be mined and is signed again with a new nonce
+            logger.warning('Nonce %s of entry %s was used elsewhere', entry.nonce, entry.id)
+            entry.nonce = None
+            entry.raw_transaction = None
+            entry.transaction_hash = None
+            sync_nonce(w3, settings.ACCOUNT_ADDRESS)
+
+        if outcome != SEND_KNOWN:
+            raise
+
+    entry.status = ChainTransaction.SENT
+    entry.attempts += 1
+    entry.last_error = None
+    entry.sent_at = timezone.now()
+    entry.save()
+    logger.info('Sent transaction %s for entry %s', entry.transaction_hash, entry.id)
+
+
+def get_due_entries(batch_size):
+    """
+    Pending entries due for an attempt. Coalesced entries are flushed
+    before their window ends once there are enough of them waiting.
+    """
+    pending = ChainTransaction.objects.filter(status=ChainTransaction.PENDING)
+    due = Q(next_attempt_at__lte=timezone.now())
+
+    if aggregation_enabled():
+        waiting = pending.filter(function=settings.WEB3_COUNT_FUNCTION, attempts=0)
+        if waiting.count() >= settings.WEB3_AGGREGATION_BATCH_SIZE:
+            due |= Q(function=settings.WEB3_COUNT_FUNCTION, attempts=0)
+
+    return pending.filter(due).order_by('id')[:batch_size]
+
+
+def register_worker():
+    """
+    Register a running worker under a name unique to its process.
+    """
+    name = f'{socket.gethostname()}:{os.getpid()}:{uuid4().hex[:8]}'
+    ChainWorker.objects.create(name=name)
+    return name
+
+
+def heartbeat(worker):
+    """
+    Keep a worker alive, registering it again if it was taken for dead.
+    """
+    ChainWorker.objects.update_or_create(name=worker, defaults={'heartbeat_at': timezone.now()})
+
+
+def unregister_worker(worker):
+    ChainWorker.objects.filter(name=worker).delete()
+
+
+def claim(entry, worker):
+    """
+    Mark an entry as being sent by a worker, so no more messages are
+    coalesced in it. Returns False if the entry was claimed by someone else.
+    """
+    claimed = ChainTransaction.objects.filter(
+        id=entry.id,
+        status=ChainTransaction.PENDING
+    ).update(
+        status=ChainTransaction.SENDING,
+        claimed_by=worker,
+        claimed_at=timezone.now()
+    )
+    if claimed:
+        entry.refresh_from_db()
+
+    return bool(claimed)
+
+
+def release_stale_entries(w3):
+    """
+    Reclaim the entries left in sending state by workers that stopped
+    before finishing them: claimed longer than settings.WEB3_WORKER_LEASE
+    ago by a worker without a heartbeat since then.
+    Entries whose transaction the node already has are marked as sent, the
+    others go back to the queue and are resent as they were signed.
+    Returns the number of entries reclaimed.
+    """
+    now = timezone.now()
+    expired = now - timedelta(seconds=settings.WEB3_WORKER_LEASE)
+    live_workers = ChainWorker.objects.filter(heartbeat_at__gte=expired).values('name')
+    stale = ChainTransaction.objects.filter(
+        status=ChainTransaction.SENDING
+    ).filter(
+        Q(claimed_at__lt=expired) | Q(claimed_at__isnull=True)
+    ).exclude(claimed_by__in=live_workers).order_by('id')
+
+    released = 0
+    for entry in stale:
+        if entry.transaction_hash and is_transaction_known(w3, entry.transaction_hash):
+            status, sent_at = ChainTransaction.SENT, now
+        else:
+            status, sent_at = ChainTransaction.PENDING, None
+
+        # only if no other worker reclaimed or finished it meanwhile
+        released += ChainTransaction.objects.filter(
+            id=entry.id,
+            status=ChainTransaction.SENDING,
+            claimed_by=entry.claimed_by,
+            claimed_at=entry.claimed_at
+        ).update(status=status, claimed_by=None, claimed_at=None, sent_at=sent_at, updated_at=now)
+
+    if released:
+        logger.warning('Reclaimed %s entries left in sending state by stopped workers', released)
+
+    ChainWorker.objects.filter(heartbeat_at__lt=expired).delete()
+    return released
+
+
+def send_pending(w3, contract, worker, batch_size=None):
+    """
+    Send the pending entries due for an attempt, as the named worker.
+    Returns the number of entries sent.
+    """
+    batch_size = batch_size or settings.WEB3_OUTBOX_BATCH_SIZE
+    sent = 0
+    for entry in get_due_entries(batch_size):
+        heartbeat(worker)
+        if not claim(entry, worker):
+            continue
+
+        try:
+            send_transaction(entry, w3, contract)
+            sent += 1
+        except Exception as ex:
+            entry.attempts += 1
+            entry.last_error = str(ex)
+            if entry.attempts >= settings.WEB3_OUTBOX_MAX_ATTEMPTS:
+                entry.status = ChainTransaction.FAILED
+                logger.error('Giving up entry %s: %s', entry.id, ex)
+            else:
+                entry.status = ChainTransaction.PENDING
+                delay = get_backoff(entry.attempts)
+                entry.next_attempt_at = timezone.now() + timedelta(seconds=delay)
+                logger.warning('Entry %s failed, retrying in %ss: %s', entry.id, delay, ex)
+            entry.save()
+
+    return sent
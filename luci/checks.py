@@ -0,0 +1,37 @@
+from django.conf import settings
+from django.core.checks import Error, Warning, register
+from luci import compression
+
+
+@register()
+def check_text_codec(app_configs, **kwargs):
+    """
+    Refuse to start with a TEXT_CODEC that encode() would fail on.
+    """
+    codec = settings.TEXT_CODEC
+    if codec not in compression.CODECS:
+        return [Error(
+            f'Unknown TEXT_CODEC: {codec}',
+            hint=f'Use one of {", ".join(compression.CODECS)}.',
+            id='luci.E001',
+        )]
+
+    return []
+
+
+@register()
+def check_shared_cache(app_configs, **kwargs):
+    """
+    The shared tier of luci.cache only reaches other processes through a
+    cache backend they share.
+    """
+    backend = settings.CACHES['default']['BACKEND']
+    if settings.CACHE_SHARED_TIER and backend.endswith('.LocMemCache'):
+        return [Warning(
+            'CACHE_SHARED_TIER is on with a LocMemCache, invalidations will '
+            'not reach the other processes.',
+            hint='Set CACHE_BACKEND to a shared backend such as memcached.',
+            id='luci.W001',
+        )]
+
+    return []
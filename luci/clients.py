@@ -0,0 +1,78 @@
+"""
+Process wide registry of the web3 client and Luci contract.
+
+Both are built on first use, so processes not talking to the chain never
+pay for them, and then reused: the HTTP session keeps its connections to
+the provider alive and the contract ABI is only parsed once per process.
+"""
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from django.conf import settings
+from web3 import Web3
+
+_lock = threading.Lock()
+_session = None
+_web3 = None
+_contract = None
+
+
+def get_session():
+    """
+    Return the keep-alive HTTP session used for talking to the provider.
+    """
+    global _session
+    if _session is None:
+        with _lock:
+            if _session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(
+                    pool_connections=1,
+                    pool_maxsize=settings.WEB3_POOL_SIZE
+                )
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                _session = session
+
+    return _session
+
+
+def get_web3():
+    global _web3
+    if _web3 is None:
+        session = get_session()
+        with _lock:
+            if _web3 is None:
+                provider = Web3.HTTPProvider(
+                    settings.WEB3_PROVIDER_URL,
+                    request_kwargs={'timeout': settings.WEB3_REQUEST_TIMEOUT},
+                    session=session
+                )
+                _web3 = Web3(provider)
+
+    return _web3
+
+
+def get_contract():
+    global _contract
+    if _contract is None:
+        w3 = get_web3()
+        with _lock:
+            if _contract is None:
+                address = w3.to_checksum_address(settings.CONTRACT_ADDRESS)
+                _contract = w3.eth.contract(address=address, abi=settings.ABI)
+
+    return _contract
+
+
+def reset():
+    """
+    Drop the registered clients, so they are rebuilt from current settings.
+    """
+    global _session, _web3, _contract
+    with _lock:
+        if _session is not None:
+            _session.close()
+        _session = None
+        _web3 = None
+        _contract = None
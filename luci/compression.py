@@ -0,0 +1,205 @@
+"""
+Text codecs used for storing message and quote blobs.
+
+Encoded blobs start with a small header:
+
+    0xFF | version | codec id [| dictionary id (2 bytes, big endian)]
+
+so at most MAX_DICTIONARY_ID dictionaries can be trained.
+
+The 0xFF byte never occurs in valid UTF-8, so rows stored before the header
+existed (plain UTF-8 bytes) are still decoded as they are.
+Texts are stored as plain UTF-8 whenever compressing would not make them
+smaller, which is usually the case for very short chat lines.
+"""
+import lzma
+import struct
+import zlib
+from collections import Counter
+from django.conf import settings
+
+MAGIC = b'\xff'
+VERSION = 1
+
+PLAIN = 'plain'
+ZLIB = 'zlib'
+LZMA = 'lzma'
+ZDICT = 'zdict'
+
+CODEC_IDS = {
+    ZLIB: 1,
+    LZMA: 2,
+    ZDICT: 3,
+}
+CODEC_NAMES = {value: key for key, value in CODEC_IDS.items()}
+CODECS = (PLAIN, ZLIB, LZMA, ZDICT)
+
+# zlib can not use more than 32KB of preset dictionary
+MAX_DICTIONARY_SIZE = 32 * 1024
+
+# dictionary ids are packed in 2 bytes of the header
+MAX_DICTIONARY_ID = 0xFFFF
+
+_LZMA_FILTERS = [{'id': lzma.FILTER_LZMA2, 'preset': 6}]
+
+# Dictionaries are immutable once trained, so they can be cached forever
+_dictionaries = {}
+_active_dictionary = None
+_active_dictionary_loaded = False
+
+
+def _get_dictionary(dictionary_id):
+    from luci.models import CompressionDictionary
+
+    if dictionary_id not in _dictionaries:
+        dictionary = CompressionDictionary.objects.get(id=dictionary_id)
+        _dictionaries[dictionary_id] = bytes(dictionary.data)
+
+    return _dictionaries[dictionary_id]
+
+
+def get_active_dictionary():
+    """
+    Return the (id, data) pair of the most recently trained dictionary,
+    or None when no dictionary was trained yet.
+    The lookup is done once per process.
+    """
+    global _active_dictionary, _active_dictionary_loaded
+    from luci.models import CompressionDictionary
+
+    if not _active_dictionary_loaded:
+        dictionary = CompressionDictionary.objects.order_by('-id').first()
+        if dictionary is not None:
+            _dictionaries[dictionary.id] = bytes(dictionary.data)
+            _active_dictionary = dictionary.id
+        _active_dictionary_loaded = True
+
+    if _active_dictionary is None:
+        return None
+
+    return _active_dictionary, _dictionaries[_active_dictionary]
+
+
+def reset_dictionary_cache():
+    """
+    Forget cached dictionaries, forcing them to be reloaded from database.
+    """
+    global _active_dictionary, _active_dictionary_loaded
+    _dictionaries.clear()
+    _active_dictionary = None
+    _active_dictionary_loaded = False
+
+
+def _deflate(data, zdict=None):
+    level = settings.TEXT_COMPRESSION_LEVEL
+    if zdict:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15, zdict=zdict)
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    return compressor.compress(data) + compressor.flush()
+
+
+def _inflate(data, zdict=None):
+    if zdict:
+        decompressor = zlib.decompressobj(-15, zdict=zdict)
+    else:
+        decompressor = zlib.decompressobj(-15)
+    return decompressor.decompress(data) + decompressor.flush()
+
+
+def encode(text, codec=None):
+    """
+    Encode a text to bytes with the given codec name.
+    If no codec is given, the one defined by settings.TEXT_CODEC is used.
+    """
+    codec = codec or settings.TEXT_CODEC
+    if codec not in CODECS:
+        raise ValueError(f'Unknown text codec: {codec}')
+
+    raw = text.encode('utf-8')
+    if codec == PLAIN or not raw:
+        return raw
+
+    header = MAGIC + bytes([VERSION, CODEC_IDS[codec]])
+    if codec == ZLIB:
+        payload = _deflate(raw)
+    elif codec == LZMA:
+        payload = lzma.compress(raw, format=lzma.FORMAT_RAW, filters=_LZMA_FILTERS)
+    else:
+        dictionary = get_active_dictionary()
+        if dictionary is None:
+            # no dictionary trained yet, fallback to plain deflate
+            header = MAGIC + bytes([VERSION, CODEC_IDS[ZLIB]])
+            payload = _deflate(raw)
+        else:
+            dictionary_id, zdict = dictionary
+            if dictionary_id > MAX_DICTIONARY_ID:
+                raise ValueError(
+                    f'Dictionary {dictionary_id} does not fit the blob header, '
+                    f'ids are limited to {MAX_DICTIONARY_ID}'
+                )
+            header += struct.pack('>H', dictionary_id)
+            payload = _deflate(raw, zdict)
+
+    encoded = header + payload
+    if len(encoded) >= len(raw):
+        return raw
+
+    return encoded
+
+
+def decode(data):
+    """
+    Decode bytes produced by `encode` (or legacy plain UTF-8 bytes) to str.
+    """
+    data = bytes(data)
+    if not data.startswith(MAGIC):
+        return data.decode('utf-8')
+
+    version, codec_id = data[1], data[2]
+    if version != VERSION:
+        raise ValueError(f'Unsupported text encoding version: {version}')
+
+    codec = CODEC_NAMES.get(codec_id)
+    payload = data[3:]
+    if codec == ZLIB:
+        raw = _inflate(payload)
+    elif codec == LZMA:
+        raw = lzma.decompress(payload, format=lzma.FORMAT_RAW, filters=_LZMA_FILTERS)
+    elif codec == ZDICT:
+        dictionary_id, = struct.unpack('>H', payload[:2])
+        raw = _inflate(payload[2:], _get_dictionary(dictionary_id))
+    else:
+        raise ValueError(f'Unknown text codec id: {codec_id}')
+
+    return raw.decode('utf-8')
+
+
+def train_dictionary(texts, size=MAX_DICTIONARY_SIZE):
+    """
+    Build a zlib preset dictionary from a sample of texts.
+    The most common words and word pairs are packed in the dictionary,
+    with the most frequent ones at its end, where deflate reaches them
+    with the shortest distances.
+    """
+    size = min(size, MAX_DICTIONARY_SIZE)
+    counter = Counter()
+    for text in texts:
+        words = text.split()
+        counter.update(f' {word}' for word in words)
+        counter.update(f' {first} {second}' for first, second in zip(words, words[1:]))
+
+    # only substrings that repeat are worth storing
+    candidates = [(term, count) for term, count in counter.items() if count > 1]
+    candidates.sort(key=lambda item: item[1] * len(item[0]), reverse=True)
+
+    chunks = []
+    used = 0
+    for term, _ in candidates:
+        chunk = term.encode('utf-8')
+        if used + len(chunk) > size:
+            continue
+        chunks.append(chunk)
+        used += len(chunk)
+
+    return b''.join(reversed(chunks))
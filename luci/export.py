@@ -0,0 +1,153 @@
+"""
+NDJSON export of the corpus, read back by the import_corpus command.
+
+Rows are read in keyset bounded chunks ordered by id and written one JSON
+object per line, so an export never holds more than a chunk in memory.
+A plain .iterator() would not do it on MySQL, whose driver fetches the
+whole result set before returning the first row.
+"""
+import json
+import zlib
+from functools import partial
+from django.conf import settings
+from luci.models import Emotion, Message, Quote, User, Word
+from luci.util import CompressedString
+
+
+def serialize_message(message, possible_responses):
+    return {
+        'id': message.id,
+        'reference': message.reference,
+        'global_intention': message.global_intention,
+        'specific_intention': message.specific_intention,
+        'text': CompressedString.decompress_bytes(message.text),
+        'user_id': message.user_id,
+        'message_datetime': message.message_datetime.isoformat(),
+        'possible_responses': possible_responses,
+    }
+
+
+def serialize_quote(quote):
+    return {
+        'id': quote.id,
+        'reference': quote.reference,
+        'quote': CompressedString.decompress_bytes(quote.quote),
+        'author': quote.author,
+        'date': quote.date.isoformat(),
+    }
+
+
+def read_chunks(queryset, chunk_size):
+    last_id = 0
+    while True:
+        chunk = list(queryset.filter(id__gt=last_id).order_by('id')[:chunk_size].iterator())
+        if not chunk:
+            return
+        yield chunk
+        last_id = chunk[-1].id
+
+
+def export_messages(reference=None, since=None, until=None, chunk_size=None):
+    """
+    Yield the messages as dicts, with the ids of their possible responses.
+    """
+    messages = Message.objects.all()
+    if reference is not None:
+        messages = messages.filter(reference=reference)
+    if since is not None:
+        messages = messages.filter(message_datetime__gte=since)
+    if until is not None:
+        messages = messages.filter(message_datetime__lt=until)
+
+    through = Message.possible_responses.through
+    for chunk in read_chunks(messages, chunk_size or settings.EXPORT_CHUNK_SIZE):
+        possible_responses = {message.id: [] for message in chunk}
+        links = through.objects.filter(
+            from_message_id__in=possible_responses
+        ).order_by('from_message_id', 'to_message_id').values_list('from_message_id', 'to_message_id')
+        for message_id, response_id in links:
+            possible_responses[message_id].append(response_id)
+
+        for message in chunk:
+            yield serialize_message(message, possible_responses[message.id])
+
+
+def export_quotes(reference=None, since=None, until=None, chunk_size=None):
+    quotes = Quote.objects.all()
+    if reference is not None:
+        quotes = quotes.filter(reference=reference)
+    if since is not None:
+        quotes = quotes.filter(date__gte=since)
+    if until is not None:
+        quotes = quotes.filter(date__lt=until)
+
+    for chunk in read_chunks(quotes, chunk_size or settings.EXPORT_CHUNK_SIZE):
+        for quote in chunk:
+            yield serialize_quote(quote)
+
+
+# fields of the kinds exported as they are stored
+ROW_FIELDS = {
+    'emotions': (Emotion, (
+        'id', 'reference', 'pleasantness', 'attention', 'sensitivity', 'aptitude'
+    )),
+    'users': (User, (
+        'id', 'reference', 'name', 'friendshipness', 'emotion_resume_id'
+    )),
+    'words': (Word, (
+        'id', 'token', 'language', 'pos_tag', 'lemma', 'entity', 'polarity',
+        'length', 'occurrences', 'document_frequency'
+    )),
+}
+
+
+def export_rows(kind, reference=None, since=None, until=None, chunk_size=None):
+    """
+    Yield the rows of one of ROW_FIELDS as dicts. These models have no
+    datetime, so since and until are ignored, as is reference for words.
+    """
+    model, fields = ROW_FIELDS[kind]
+    rows = model.objects.all()
+    if reference is not None and 'reference' in fields:
+        rows = rows.filter(reference=reference)
+
+    for chunk in read_chunks(rows, chunk_size or settings.EXPORT_CHUNK_SIZE):
+        for row in chunk:
+            yield {field: getattr(row, field) for field in fields}
+
+
+EXPORTS = {
+    'emotions': partial(export_rows, 'emotions'),
+    'users': partial(export_rows, 'users'),
+    'messages': export_messages,
+    'quotes': export_quotes,
+    'words': partial(export_rows, 'words'),
+}
+
+
+def to_ndjson(records, compress=False):
+    """
+    Encode records as NDJSON lines, or gzip compressed blocks of them.
+    """
+    compressor = zlib.compressobj(wbits=31) if compress else None
+    lines = []
+    for record in records:
+        lines.append(json.dumps(record, ensure_ascii=False) + '\n')
+        if len(lines) < settings.EXPORT_CHUNK_SIZE:
+            continue
+
+        block = ''.join(lines).encode('utf-8')
+        lines = []
+        if compressor is None:
+            yield block
+        else:
+            block = compressor.compress(block)
+            if block:
+                yield block
+
+    block = ''.join(lines).encode('utf-8')
+    if compressor is None:
+        if block:
+            yield block
+    else:
+        yield compressor.compress(block) + compressor.flush()
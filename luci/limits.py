@@ -0,0 +1,149 @@
+"""
+Depth and cost limits of GraphQL queries.
+
+The depth of a query is how deeply its fields are nested. Its cost is an
+estimate of the number of objects resolved: each item returned by a field
+returning objects costs one, plus the cost of its selections. The size of
+a list field is taken from its first, k or limit argument, or
+QUERY_DEFAULT_LIST_SIZE when it has none, so recursive fields such as
+possible_responses add up exponentially.
+"""
+from django.conf import settings
+from graphql import GraphQLError
+from graphql.language import ast
+from graphql.type.definition import GraphQLList, get_named_type, get_nullable_type
+from graphql.utils.get_operation_ast import get_operation_ast
+
+# arguments setting how many items a list field returns
+SIZE_ARGUMENTS = ('first', 'k', 'limit')
+
+
+def get_root_type(schema, operation):
+    if operation.operation == 'mutation':
+        return schema.get_mutation_type()
+    if operation.operation == 'subscription':
+        return schema.get_subscription_type()
+    return schema.get_query_type()
+
+
+def get_variables(operation, variables):
+    """
+    Return the request variables with the defaults of the operation.
+    """
+    values = {}
+    for definition in operation.variable_definitions or []:
+        if isinstance(definition.default_value, ast.IntValue):
+            values[definition.variable.name.value] = int(definition.default_value.value)
+    values.update(variables or {})
+    return values
+
+
+def get_list_size(field_node, field, variables):
+    arguments = {argument.name.value: argument.value for argument in field_node.arguments}
+    for name in SIZE_ARGUMENTS:
+        if name in arguments:
+            value = arguments[name]
+            if isinstance(value, ast.Variable):
+                size = variables.get(value.name.value)
+            elif isinstance(value, ast.IntValue):
+                size = int(value.value)
+            else:
+                size = None
+        elif name in field.args:
+            size = field.args[name].default_value
+        else:
+            continue
+
+        if isinstance(size, int) and size > 0:
+            return size
+
+    return settings.QUERY_DEFAULT_LIST_SIZE
+
+
+class QueryMeasure:
+    def __init__(self, schema, fragments, variables):
+        self.schema = schema
+        self.fragments = fragments
+        self.variables = variables
+
+    def measure(self, selection_set, parent_type, depth, path=()):
+        """
+        Return the depth and cost of a selection set.
+        Fragment spreads already in path are skipped, so fragment cycles,
+        rejected later by validation, do not recurse forever.
+        """
+        max_depth = depth
+        cost = 0
+        for selection in selection_set.selections:
+            if isinstance(selection, ast.Field):
+                name = selection.name.value
+                fields = getattr(parent_type, 'fields', {})
+                if name.startswith('__') or name not in fields or selection.selection_set is None:
+                    continue
+
+                field = fields[name]
+                size = 1
+                if isinstance(get_nullable_type(field.type), GraphQLList):
+                    size = get_list_size(selection, field, self.variables)
+
+                child_depth, child_cost = self.measure(
+                    selection.selection_set, get_named_type(field.type), depth + 1, path
+                )
+                max_depth = max(max_depth, child_depth)
+                cost += size * (1 + child_cost)
+
+            else:
+                if isinstance(selection, ast.FragmentSpread):
+                    name = selection.name.value
+                    fragment = self.fragments.get(name)
+                    if fragment is None or name in path:
+                        continue
+                    path = path + (name,)
+                    type_condition = fragment.type_condition
+                    selections = fragment.selection_set
+                else:
+                    type_condition = selection.type_condition
+                    selections = selection.selection_set
+
+                fragment_type = parent_type
+                if type_condition is not None:
+                    fragment_type = self.schema.get_type(type_condition.name.value)
+
+                child_depth, child_cost = self.measure(selections, fragment_type, depth, path)
+                max_depth = max(max_depth, child_depth)
+                cost += child_cost
+
+        return max_depth, cost
+
+
+def measure_query(schema, document_ast, operation_name=None, variables=None):
+    """
+    Return the depth and cost of the operation to be executed.
+    """
+    operation = get_operation_ast(document_ast, operation_name)
+    if operation is None:
+        return 0, 0
+
+    fragments = {
+        definition.name.value: definition
+        for definition in document_ast.definitions
+        if isinstance(definition, ast.FragmentDefinition)
+    }
+    measure = QueryMeasure(schema, fragments, get_variables(operation, variables))
+    return measure.measure(operation.selection_set, get_root_type(schema, operation), 1)
+
+
+def check_limits(depth, cost):
+    """
+    Return the errors of a query over the configured limits.
+    """
+    errors = []
+    if depth > settings.QUERY_MAX_DEPTH:
+        errors.append(GraphQLError(
+            f'Query depth {depth} exceeds the maximum of {settings.QUERY_MAX_DEPTH}'
+        ))
+    if cost > settings.QUERY_MAX_COST:
+        errors.append(GraphQLError(
+            f'Query cost {cost} exceeds the maximum of {settings.QUERY_MAX_COST}'
+        ))
+    return errors
@@ -0,0 +1,115 @@
+"""
+Per-request DataLoaders, batching the queries made by nested resolvers.
+All loads of the same kind done while resolving one GraphQL request become
+a single query, no matter how many rows the request returns.
+"""
+from collections import defaultdict
+from promise import Promise
+from promise.dataloader import DataLoader
+from luci.models import ArchivedMessage, ArchivedResponseLink, Emotion, Message, User
+from luci.util import CompressedString
+
+# Responses starting with these are bot commands or links, never suggested
+EXCLUDED_RESPONSE_PREFIXES = ('!', 'http', ';;')
+
+
+class UserLoader(DataLoader):
+    def batch_load_fn(self, keys):
+        users = User.objects.in_bulk(keys)
+        return Promise.resolve([users.get(key) for key in keys])
+
+
+class EmotionLoader(DataLoader):
+    def batch_load_fn(self, keys):
+        emotions = Emotion.objects.in_bulk(keys)
+        return Promise.resolve([emotions.get(key) for key in keys])
+
+
+class UserMessagesLoader(DataLoader):
+    def batch_load_fn(self, keys):
+        messages = defaultdict(list)
+        for message in Message.objects.filter(user_id__in=keys).order_by('id'):
+            messages[message.user_id].append(message)
+        return Promise.resolve([messages[key] for key in keys])
+
+
+class PossibleResponsesLoader(DataLoader):
+    def batch_load_fn(self, keys):
+        through = Message.possible_responses.through
+        links = through.objects.filter(
+            from_message_id__in=keys
+        ).values_list('from_message_id', 'to_message_id')
+
+        links = list(links)
+        responses = Message.objects.in_bulk({response for _, response in links})
+
+        # filtered after decoding, since compressed texts can not be
+        # matched by prefix in SQL
+        allowed = {
+            pk for pk, message in responses.items()
+            if not CompressedString.decompress_bytes(message.text)
+            .startswith(EXCLUDED_RESPONSE_PREFIXES)
+        }
+
+        possible_responses = defaultdict(list)
+        for message_id, response_id in sorted(links, key=lambda link: link[1]):
+            if response_id in allowed:
+                possible_responses[message_id].append(responses[response_id])
+
+        return Promise.resolve([possible_responses[key] for key in keys])
+
+
+class ArchivedResponsesLoader(DataLoader):
+    """
+    Possible responses of messages or archived messages, including the
+    archived ones. Responses are flagged so theirs include archived too.
+    """
+    def batch_load_fn(self, keys):
+        through = Message.possible_responses.through
+        links = set(
+            through.objects.filter(from_message_id__in=keys)
+            .values_list('from_message_id', 'to_message_id')
+        )
+        links.update(
+            ArchivedResponseLink.objects.filter(message_id__in=keys)
+            .values_list('message_id', 'response_id')
+        )
+
+        response_ids = {response for _, response in links}
+        responses = Message.objects.in_bulk(response_ids)
+        responses.update(ArchivedMessage.objects.in_bulk(response_ids - set(responses)))
+
+        possible_responses = defaultdict(list)
+        for message_id, response_id in sorted(links, key=lambda link: link[1]):
+            response = responses.get(response_id)
+            if response is None or CompressedString.decompress_bytes(response.text).startswith(
+                EXCLUDED_RESPONSE_PREFIXES
+            ):
+                continue
+            response.include_archived = True
+            possible_responses[message_id].append(response)
+
+        return Promise.resolve([possible_responses[key] for key in keys])
+
+
+class Loaders:
+    def __init__(self):
+        self.users = UserLoader()
+        self.emotions = EmotionLoader()
+        self.user_messages = UserMessagesLoader()
+        self.possible_responses = PossibleResponsesLoader()
+        self.archived_responses = ArchivedResponsesLoader()
+
+
+def get_loaders(context):
+    """
+    Return the loaders bound to the request context, creating them on the
+    first use. Without a context, a new set of loaders is returned.
+    """
+    loaders = getattr(context, 'loaders', None)
+    if loaders is None:
+        loaders = Loaders()
+        if context is not None:
+            context.loaders = loaders
+
+    return loaders
@@ -0,0 +1,96 @@
+from datetime import timedelta
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+from luci import compression
+from luci.models import ArchivedMessage, ArchivedResponseLink, Message
+
+
+class Command(BaseCommand):
+    help = (
+        'Moves old messages to the ArchivedMessage table, with compressed '
+        'texts, keeping their ids and possible_responses links. Archived '
+        'messages are left out of search and word counts, and are listed by '
+        'the messages query with include_archived.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--older-than',
+            type=int,
+            default=settings.ARCHIVE_AFTER_DAYS,
+            help='Archive messages older than this number of days.'
+        )
+        parser.add_argument(
+            '--chunk-size',
+            type=int,
+            default=1000,
+            help='Number of messages moved per transaction.'
+        )
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - timedelta(days=options['older_than'])
+        old_messages = Message.objects.filter(message_datetime__lt=cutoff)
+
+        total = 0
+        last_id = 0
+        while True:
+            with transaction.atomic():
+                messages = list(
+                    old_messages.filter(id__gt=last_id)
+                    .order_by('id')
+                    .select_for_update()[:options['chunk_size']]
+                )
+                if not messages:
+                    break
+                self.archive(messages)
+
+            last_id = messages[-1].id
+            total += len(messages)
+            self.stdout.write(f'{total} messages archived, last id {last_id}.')
+
+        self.stdout.write(self.style.SUCCESS(f'Done! Archived {total} messages.'))
+
+    @staticmethod
+    def archive(messages):
+        """
+        Copy the messages and their links to the archive, then delete them.
+        Links between these and hot messages are kept on the archive side.
+        """
+        ArchivedMessage.objects.bulk_create(
+            [
+                ArchivedMessage(
+                    id=message.id,
+                    reference=message.reference,
+                    server_id=message.server_id,
+                    member_id=message.member_id,
+                    global_intention=message.global_intention,
+                    specific_intention=message.specific_intention,
+                    text=compression.encode(
+                        compression.decode(message.text), settings.ARCHIVE_CODEC
+                    ),
+                    user_id=message.user_id,
+                    message_datetime=message.message_datetime,
+                )
+                for message in messages
+            ],
+            ignore_conflicts=True
+        )
+
+        ids = [message.id for message in messages]
+        through = Message.possible_responses.through
+        links = through.objects.filter(
+            Q(from_message_id__in=ids) | Q(to_message_id__in=ids)
+        ).values_list('from_message_id', 'to_message_id')
+        ArchivedResponseLink.objects.bulk_create(
+            [
+                ArchivedResponseLink(message_id=message_id, response_id=response_id)
+                for message_id, response_id in links
+            ],
+            ignore_conflicts=True
+        )
+
+        # links and search tokens of the messages go with them
+        Message.objects.filter(id__in=ids).delete()
@@ -0,0 +1,42 @@
+from django.core.management.base import BaseCommand
+from luci import retrieval
+from luci.util import flush_vocabulary
+
+
+class Command(BaseCommand):
+    help = (
+        'Builds the TF-IDF index of the best_responses query from the Word '
+        'vocabulary, flushing the staged word counts first. Run '
+        'populate_word_table first so the words of older texts are known. '
+        'Serving processes pick up the new index on their next query.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--chunk-size',
+            type=int,
+            default=5000,
+            help='Number of messages read per query.'
+        )
+        parser.add_argument(
+            '--incremental',
+            action='store_true',
+            help=(
+                'Only add the messages stored since the current index. '
+                'Weights of existing rows are kept, so rebuild fully from '
+                'time to time as word frequencies drift.'
+            )
+        )
+
+    def handle(self, *args, **options):
+        while flush_vocabulary():
+            pass
+
+        meta = retrieval.build(
+            incremental=options['incremental'],
+            chunk_size=options['chunk_size'],
+            stdout=self.stdout
+        )
+        self.stdout.write(self.style.SUCCESS(
+            f"Done! Index built up to message {meta['last_message_id']}."
+        ))
@@ -0,0 +1,113 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from luci import compression
+from luci.models import CompressionDictionary, Message, Quote
+
+
+class Command(BaseCommand):
+    help = (
+        'Re-encodes stored message and quote texts with a text codec.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--codec',
+            choices=compression.CODECS,
+            help='Codec to use. Defaults to settings.TEXT_CODEC.'
+        )
+        parser.add_argument(
+            '--chunk-size',
+            type=int,
+            default=1000,
+            help='Number of rows re-encoded per transaction.'
+        )
+        parser.add_argument(
+            '--train-dictionary',
+            action='store_true',
+            help='Train a new preset dictionary from the message corpus first.'
+        )
+        parser.add_argument(
+            '--sample-size',
+            type=int,
+            default=20000,
+            help='Number of recent messages used for training the dictionary.'
+        )
+        parser.add_argument(
+            '--dictionary-size',
+            type=int,
+            default=compression.MAX_DICTIONARY_SIZE,
+            help='Maximum dictionary size in bytes.'
+        )
+
+    def handle(self, *args, **options):
+        if options['train_dictionary']:
+            self.train(options['sample_size'], options['dictionary_size'])
+
+        codec = options['codec'] or settings.TEXT_CODEC
+        chunk_size = options['chunk_size']
+        self.reencode(Message, 'text', codec, chunk_size)
+        self.reencode(Quote, 'quote', codec, chunk_size)
+
+    def train(self, sample_size, dictionary_size):
+        texts = (
+            compression.decode(text)
+            for text in Message.objects.order_by('-id')
+            .values_list('text', flat=True)[:sample_size]
+            .iterator()
+        )
+        data = compression.train_dictionary(texts, dictionary_size)
+        with transaction.atomic():
+            dictionary = CompressionDictionary.objects.create(
+                data=data,
+                sample_size=sample_size
+            )
+            if dictionary.id > compression.MAX_DICTIONARY_ID:
+                raise CommandError(
+                    f'Dictionary ids are limited to {compression.MAX_DICTIONARY_ID} '
+                    'by the blob header, no more dictionaries can be trained.'
+                )
+        compression.reset_dictionary_cache()
+        self.stdout.write(
+            f'Trained dictionary {dictionary.id} with {len(data)} bytes.'
+        )
+
+    def reencode(self, model, field, codec, chunk_size):
+        """
+        Walk the table in primary key order, one chunk per transaction,
+        so the command can be interrupted and run again at any time.
+        """
+        last_id = 0
+        total = 0
+        saved = 0
+        while True:
+            with transaction.atomic():
+                rows = list(
+                    model.objects.filter(id__gt=last_id)
+                    .order_by('id')
+                    .only('id', field)[:chunk_size]
+                )
+                if not rows:
+                    break
+
+                changed = []
+                for row in rows:
+                    current = bytes(getattr(row, field))
+                    encoded = compression.encode(compression.decode(current), codec)
+                    if encoded != current:
+                        setattr(row, field, encoded)
+                        changed.append(row)
+                        saved += len(current) - len(encoded)
+
+                model.objects.bulk_update(changed, [field])
+
+            last_id = rows[-1].id
+            total += len(rows)
+            self.stdout.write(
+                f'{model.__name__}: {total} rows processed, '
+                f'{saved} bytes saved so far.'
+            )
+
+        self.stdout.write(self.style.SUCCESS(
+            f'{model.__name__}: done, {total} rows processed.'
+        ))
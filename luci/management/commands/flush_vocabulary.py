@@ -0,0 +1,39 @@
+from time import sleep
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from luci.util import flush_vocabulary
+
+
+class Command(BaseCommand):
+    help = 'Adds the word counts staged by the mutations storing texts to the vocabulary.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--interval',
+            type=float,
+            default=settings.VOCABULARY_FLUSH_INTERVAL,
+            help='Seconds to sleep once every staged count was flushed.'
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=settings.VOCABULARY_FLUSH_BATCH_SIZE,
+            help='Number of staged rows flushed per transaction.'
+        )
+        parser.add_argument(
+            '--once',
+            action='store_true',
+            help='Flush the staged counts and exit.'
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            flushed = flush_vocabulary(options['batch_size'])
+            if flushed:
+                self.stdout.write(f'{flushed} word counts flushed.')
+            if flushed >= options['batch_size']:
+                continue
+
+            if options['once']:
+                break
+            sleep(options['interval'])
@@ -0,0 +1,247 @@
+import csv
+import gzip
+import json
+import os
+from contextlib import contextmanager
+from itertools import islice
+from django.core.management.base import BaseCommand, CommandError
+from django.core.management.color import no_style
+from django.db import connection, transaction
+from luci.export import ROW_FIELDS
+from luci.models import Emotion, Message, ProcessingCheckpoint, Quote, User
+from luci.util import CompressedString, index_messages
+
+# model, stored fields, text field encoded as CompressedString and the
+# auto_now_add field whose exported value is kept
+KINDS = {
+    'emotions': (Emotion, ROW_FIELDS['emotions'][1], None, None),
+    'users': (User, ROW_FIELDS['users'][1], None, None),
+    'messages': (Message, (
+        'id', 'reference', 'global_intention', 'specific_intention',
+        'user_id', 'message_datetime'
+    ), 'text', 'message_datetime'),
+    'quotes': (Quote, ('id', 'reference', 'author', 'date'), 'quote', 'date'),
+    'words': (ROW_FIELDS['words'][0], ROW_FIELDS['words'][1], None, None),
+}
+
+
+@contextmanager
+def keep_stored_value(model, field_name):
+    """
+    Disable auto_now_add on a field, so bulk inserts keep the given values.
+    """
+    if field_name is None:
+        yield
+        return
+
+    field = model._meta.get_field(field_name)
+    field.auto_now_add = False
+    try:
+        yield
+    finally:
+        field.auto_now_add = True
+
+
+def read_records(path, file_format):
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rt', encoding='utf-8', newline='') as dump:
+        if file_format == 'csv':
+            for record in csv.DictReader(dump):
+                # CSV has no nulls nor lists
+                record = {key: (value if value != '' else None) for key, value in record.items()}
+                if record.get('possible_responses'):
+                    record['possible_responses'] = json.loads(record['possible_responses'])
+                yield record
+        else:
+            for line in dump:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def stored_ids(model, ids, batch_size):
+    ids = list(ids)
+    stored = set()
+    for start in range(0, len(ids), batch_size):
+        stored.update(
+            model.objects.filter(id__in=ids[start:start + batch_size])
+            .values_list('id', flat=True)
+        )
+    return stored
+
+
+def fingerprint(path):
+    """
+    Identify a dump by its name, size and modification time, so a new dump
+    with the same name does not resume the progress of the previous one.
+    """
+    stat = os.stat(path)
+    return f'{os.path.basename(path)[:150]}:{stat.st_size}:{stat.st_mtime_ns}'
+
+
+def chunks(records, size):
+    records = iter(records)
+    while True:
+        chunk = list(islice(records, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+class Command(BaseCommand):
+    help = (
+        'Imports a NDJSON or CSV dump of the /export/ views, keeping the '
+        'row ids, so dumps of emotions, users, messages, quotes and words '
+        'should be imported in this order, into empty tables. Rows whose '
+        'unique fields are already stored are skipped, ids already stored '
+        'abort the import. An interrupted import resumes after its last '
+        'committed chunk when run again on the same file.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('kind', choices=list(KINDS))
+        parser.add_argument('path', help='Dump file, optionally gzip compressed (.gz)')
+        parser.add_argument(
+            '--format',
+            choices=['ndjson', 'csv'],
+            help='Format of the dump, guessed from its extension by default.'
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=1000,
+            help='Number of rows per INSERT.'
+        )
+        parser.add_argument(
+            '--chunk-size',
+            type=int,
+            default=10000,
+            help='Number of rows imported per transaction.'
+        )
+        parser.add_argument(
+            '--restart',
+            action='store_true',
+            help='Ignore the progress of previous runs and start over.'
+        )
+
+    def handle(self, *args, **options):
+        kind = options['kind']
+        path = options['path']
+        if not os.path.exists(path):
+            raise CommandError(f'{path} does not exist.')
+
+        file_format = options['format']
+        if file_format is None:
+            file_format = 'csv' if path.replace('.gz', '').endswith('.csv') else 'ndjson'
+
+        model = KINDS[kind][0]
+        name = f'import_corpus:{kind}:{fingerprint(path)}'
+        passes = [(name, self.import_rows)]
+        if kind == 'messages':
+            passes.append((f'{name}:links', self.import_links))
+
+        checkpoints = []
+        for checkpoint_name, import_chunk in passes:
+            checkpoint, _ = ProcessingCheckpoint.objects.get_or_create(name=checkpoint_name)
+            if options['restart']:
+                checkpoint.position = 0
+                checkpoint.save()
+            checkpoints.append((checkpoint, import_chunk))
+
+        # links are only checked against stored ids, which must all be of the dump
+        if checkpoints[0][0].position == 0 and model.objects.exists():
+            raise CommandError(
+                f'{model._meta.db_table} is not empty, dumps are only imported '
+                'into empty tables.'
+            )
+
+        for checkpoint, import_chunk in checkpoints:
+            self.run_pass(
+                kind, read_records(path, file_format), checkpoint, import_chunk, options
+            )
+
+        with connection.cursor() as cursor:
+            for sql in connection.ops.sequence_reset_sql(no_style(), [model]):
+                cursor.execute(sql)
+
+        ProcessingCheckpoint.objects.filter(
+            id__in=[checkpoint.id for checkpoint, _ in checkpoints]
+        ).delete()
+
+        self.stdout.write(self.style.SUCCESS(f'Done! {kind} imported from {path}.'))
+
+    def run_pass(self, kind, records, checkpoint, import_chunk, options):
+        """
+        Import the records after the checkpoint, one chunk per transaction.
+        The checkpoint counts the records read and moves with each chunk.
+        """
+        records = islice(records, checkpoint.position, None)
+        total = checkpoint.position
+        for chunk in chunks(records, options['chunk_size']):
+            with transaction.atomic():
+                import_chunk(kind, chunk, options['batch_size'])
+                total += len(chunk)
+                checkpoint.position = total
+                checkpoint.save()
+
+            self.stdout.write(f'{checkpoint.name}: {total} records imported.')
+
+    def import_rows(self, kind, records, batch_size):
+        model, fields, text_field, kept_field = KINDS[kind]
+        rows = []
+        texts = []
+        for record in records:
+            values = {
+                field: model._meta.get_field(field).to_python(record.get(field))
+                for field in fields
+            }
+            if text_field is not None:
+                texts.append(record[text_field])
+                values[text_field] = CompressedString(record[text_field]).bit_string
+
+            row = model(**values)
+            if hasattr(row, 'set_reference_keys'):
+                row.set_reference_keys()
+            rows.append(row)
+
+        # rows stored since the import started, by the API or another import
+        collisions = stored_ids(model, [row.id for row in rows], batch_size)
+        if collisions:
+            raise CommandError(
+                f'{len(collisions)} ids of the dump are already stored in '
+                f'{model._meta.db_table}, such as {min(collisions)}.'
+            )
+
+        with keep_stored_value(model, kept_field):
+            model.objects.bulk_create(rows, batch_size=batch_size, ignore_conflicts=True)
+
+        if model is Message:
+            # rows skipped for a duplicated text have no row to index
+            stored = stored_ids(Message, [row.id for row in rows], batch_size)
+            index_messages([
+                (row, text) for row, text in zip(rows, texts) if row.id in stored
+            ])
+
+    def import_links(self, kind, records, batch_size):
+        """
+        Store the possible_responses links between imported messages.
+        Links to messages left out of the dump are dropped.
+        """
+        links = [
+            (int(record['id']), int(response_id))
+            for record in records
+            for response_id in record.get('possible_responses') or []
+        ]
+        stored = stored_ids(
+            Message, {message_id for link in links for message_id in link}, batch_size
+        )
+
+        through = Message.possible_responses.through
+        through.objects.bulk_create(
+            [
+                through(from_message_id=message_id, to_message_id=response_id)
+                for message_id, response_id in links
+                if message_id in stored and response_id in stored
+            ],
+            batch_size=batch_size,
+            ignore_conflicts=True
+        )
@@ -0,0 +1,47 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from luci.models import Message
+from luci.util import CompressedString, index_messages
+
+
+class Command(BaseCommand):
+    help = 'Builds the inverted token index used by message search.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--chunk-size',
+            type=int,
+            default=1000,
+            help='Number of messages indexed per transaction.'
+        )
+        parser.add_argument(
+            '--start-id',
+            type=int,
+            default=0,
+            help='Only index messages with id greater than this one.'
+        )
+
+    def handle(self, *args, **options):
+        chunk_size = options['chunk_size']
+        last_id = options['start_id']
+        total = 0
+        while True:
+            messages = list(
+                Message.objects.filter(id__gt=last_id)
+                .order_by('id')
+                .only('id', 'text')[:chunk_size]
+            )
+            if not messages:
+                break
+
+            with transaction.atomic():
+                index_messages([
+                    (message, CompressedString.decompress_bytes(message.text))
+                    for message in messages
+                ])
+
+            last_id = messages[-1].id
+            total += len(messages)
+            self.stdout.write(f'{total} messages indexed, last id {last_id}.')
+
+        self.stdout.write(self.style.SUCCESS(f'Done! Indexed {total} messages.'))
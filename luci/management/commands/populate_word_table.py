@@ -0,0 +1,107 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from luci.models import Message, ProcessingCheckpoint, Quote, Word, WordCountDelta, TOKEN_MAX_LENGTH
+from luci.util import CompressedString, flush_vocabulary, learn_vocabulary, tokenize
+
+SOURCES = (
+    (Message, 'text'),
+    (Quote, 'quote'),
+)
+
+
+class Command(BaseCommand):
+    help = (
+        'Creates Word records from the tokens of messages and quotes. '
+        'Only rows stored since the previous run are processed. '
+        'Word counts are staged by the mutations storing texts and added by '
+        'flush_vocabulary, use --recount for computing them again from the '
+        'whole corpus.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--chunk-size',
+            type=int,
+            default=2000,
+            help='Number of rows read and inserted per transaction.'
+        )
+        parser.add_argument(
+            '--full',
+            action='store_true',
+            help='Ignore the high-water marks and process every row again.'
+        )
+        parser.add_argument(
+            '--recount',
+            action='store_true',
+            help=(
+                'Reset the word counts and count them again from every row. '
+                'Texts stored while it runs may be counted twice, so pause '
+                'ingestion meanwhile.'
+            )
+        )
+
+    def handle(self, *args, **options):
+        recount = options['recount']
+        if recount:
+            # staged counts are of texts counted again below
+            WordCountDelta.objects.all().delete()
+            Word.objects.update(occurrences=0, document_frequency=0)
+
+        for model, field in SOURCES:
+            self.process(model, field, options['chunk_size'], options['full'] or recount, recount)
+
+        if recount:
+            while flush_vocabulary():
+                pass
+
+    def process(self, model, field, chunk_size, full, recount=False):
+        """
+        Read the rows after the high-water mark, one keyset bounded chunk at
+        a time, so memory does not grow with the corpus on any database.
+        The mark moves in the same transaction as the words of each chunk.
+        """
+        checkpoint, _ = ProcessingCheckpoint.objects.get_or_create(
+            name=f'populate_word_table:{model._meta.model_name}'
+        )
+        last_id = 0 if full else checkpoint.position
+        rows = 0
+        tokens = 0
+
+        while True:
+            chunk = list(
+                model.objects.filter(id__gt=last_id)
+                .order_by('id')
+                .values_list('id', field)[:chunk_size]
+                .iterator()
+            )
+            if not chunk:
+                break
+
+            texts = [CompressedString.decompress_bytes(text) for _, text in chunk]
+            words = set()
+            for text in texts:
+                words.update(tokenize(text))
+            words = [word for word in words if len(word) <= TOKEN_MAX_LENGTH]
+
+            last_id = chunk[-1][0]
+            with transaction.atomic():
+                if recount:
+                    learn_vocabulary(texts)
+                else:
+                    Word.objects.bulk_create(
+                        [Word(token=word, length=len(word)) for word in words],
+                        ignore_conflicts=True
+                    )
+                checkpoint.position = last_id
+                checkpoint.save()
+
+            rows += len(chunk)
+            tokens += len(words)
+            self.stdout.write(
+                f'{model.__name__}: {rows} rows read, {tokens} tokens seen, '
+                f'last id {last_id}.'
+            )
+
+        self.stdout.write(self.style.SUCCESS(
+            f'{model.__name__}: done, {rows} new rows processed.'
+        ))
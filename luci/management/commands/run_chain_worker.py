@@ -0,0 +1,77 @@
+from time import monotonic, sleep
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from luci import chain, clients, receipts
+
+
+class Command(BaseCommand):
+    help = 'Sends queued contract transactions and records their receipts.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--interval',
+            type=float,
+            default=settings.WEB3_WORKER_INTERVAL,
+            help='Seconds to sleep between idle polls.'
+        )
+        parser.add_argument(
+            '--receipt-interval',
+            type=float,
+            default=settings.WEB3_RECEIPT_INTERVAL,
+            help='Seconds between receipt reconciliations, stale entry and nonce checks.'
+        )
+        parser.add_argument(
+            '--once',
+            action='store_true',
+            help='Process the outbox a single time and exit.'
+        )
+
+    def handle(self, *args, **options):
+        w3 = clients.get_web3()
+        contract = clients.get_contract()
+        self.stdout.write(f'Chain worker connected to {settings.WEB3_PROVIDER_URL}')
+        worker = chain.register_worker()
+        try:
+            self.run(w3, contract, worker, options)
+        finally:
+            chain.unregister_worker(worker)
+
+    def run(self, w3, contract, worker, options):
+        last_reconcile = None
+        while True:
+            chain.heartbeat(worker)
+            sent = chain.send_pending(w3, contract, worker)
+            if sent:
+                self.stdout.write(f'{sent} transactions sent.')
+
+            now = monotonic()
+            if last_reconcile is None or now - last_reconcile >= options['receipt_interval']:
+                last_reconcile = now
+                try:
+                    settled = receipts.reconcile()
+                except Exception as ex:
+                    self.stderr.write(f'Receipt reconciliation failed: {ex}')
+                else:
+                    if settled:
+                        self.stdout.write(f'{settled} transactions settled.')
+
+                try:
+                    released = chain.release_stale_entries(w3)
+                except Exception as ex:
+                    self.stderr.write(f'Reclaiming stale entries failed: {ex}')
+                else:
+                    if released:
+                        self.stdout.write(f'{released} stale entries reclaimed.')
+
+                try:
+                    recovered = chain.check_nonce(w3, settings.ACCOUNT_ADDRESS)
+                except Exception as ex:
+                    self.stderr.write(f'Nonce check failed: {ex}')
+                else:
+                    if recovered is not None:
+                        self.stdout.write(f'Nonce {recovered} recovered.')
+
+            if options['once']:
+                break
+            if not sent:
+                sleep(options['interval'])
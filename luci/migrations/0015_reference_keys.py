@@ -0,0 +1,43 @@
+# Generated by Django 2.2.13 on 2026-10-18 10:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('luci', '0014_compressiondictionary'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='emotion',
+            name='member_id',
+            field=models.CharField(blank=True, db_index=True, max_length=50, null=True),
+        ),
+        migrations.AddField(
+            model_name='emotion',
+            name='server_id',
+            field=models.CharField(blank=True, db_index=True, max_length=50, null=True),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='member_id',
+            field=models.CharField(blank=True, db_index=True, max_length=50, null=True),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='server_id',
+            field=models.CharField(blank=True, db_index=True, max_length=50, null=True),
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='member_id',
+            field=models.CharField(blank=True, db_index=True, max_length=50, null=True),
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='server_id',
+            field=models.CharField(blank=True, db_index=True, max_length=50, null=True),
+        ),
+    ]
@@ -0,0 +1,55 @@
+from base64 import b64decode
+from django.db import migrations
+
+CHUNK_SIZE = 1000
+
+
+def split_reference(reference):
+    """
+    Split a base64 encoded `server_id:user_id` reference into its parts,
+    as luci.models.split_reference did when this migration was written.
+    """
+    if not reference:
+        return None, None
+
+    try:
+        key = b64decode(reference.encode('utf-8')).decode('utf-8')
+        server_id, member_id = key.split(':')
+    except ValueError:
+        return None, None
+
+    return server_id, member_id
+
+
+def backfill_reference_keys(apps, schema_editor):
+    """
+    Fill server_id and member_id from the reference of existing rows,
+    one chunk at a time so large tables are never loaded at once.
+    """
+    for model_name in ('Emotion', 'User', 'Message'):
+        model = apps.get_model('luci', model_name)
+        last_id = 0
+        while True:
+            rows = list(
+                model.objects.filter(id__gt=last_id)
+                .order_by('id')
+                .only('id', 'reference')[:CHUNK_SIZE]
+            )
+            if not rows:
+                break
+
+            for row in rows:
+                row.server_id, row.member_id = split_reference(row.reference)
+            model.objects.bulk_update(rows, ['server_id', 'member_id'])
+            last_id = rows[-1].id
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('luci', '0015_reference_keys'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_reference_keys, migrations.RunPython.noop),
+    ]
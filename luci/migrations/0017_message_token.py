@@ -0,0 +1,25 @@
+# Generated by Django 2.2.13 on 2026-10-18 10:14
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('luci', '0016_backfill_reference_keys'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MessageToken',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('token', models.CharField(max_length=100)),
+                ('message', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='tokens', to='luci.Message')),
+            ],
+            options={
+                'unique_together': {('token', 'message')},
+            },
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 2.2.13 on 2026-10-18 10:16
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('luci', '0017_message_token'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChainTransaction',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('function', models.CharField(max_length=50)),
+                ('member_id', models.CharField(max_length=50)),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('sent', 'Sent'), ('confirmed', 'Confirmed'), ('failed', 'Failed')], default='pending', max_length=10)),
+                ('attempts', models.IntegerField(default=0)),
+                ('next_attempt_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('last_error', models.TextField(blank=True, null=True)),
+                ('transaction_hash', models.CharField(blank=True, max_length=66, null=True)),
+                ('gas_used', models.BigIntegerField(null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'index_together': {('status', 'next_attempt_at')},
+            },
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 2.2.13 on 2026-10-18 10:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('luci', '0018_chain_transaction'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chaintransaction',
+            name='increment',
+            field=models.PositiveIntegerField(default=1),
+        ),
+        migrations.AlterField(
+            model_name='chaintransaction',
+            name='status',
+            field=models.CharField(choices=[('pending', 'Pending'), ('sending', 'Sending'), ('sent', 'Sent'), ('confirmed', 'Confirmed'), ('failed', 'Failed')], default='pending', max_length=10),
+        ),
+    ]
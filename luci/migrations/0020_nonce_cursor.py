@@ -0,0 +1,28 @@
+# Generated by Django 2.2.13 on 2026-10-18 10:18
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('luci', '0019_chain_transaction_increment'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='NonceCursor',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('address', models.CharField(max_length=42, unique=True)),
+                ('next_nonce', models.BigIntegerField()),
+                ('synced_at', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='chaintransaction',
+            name='nonce',
+            field=models.BigIntegerField(null=True),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 2.2.13 on 2026-10-18 10:19
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('luci', '0020_nonce_cursor'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chaintransaction',
+            name='block_number',
+            field=models.BigIntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='chaintransaction',
+            name='receipt_status',
+            field=models.IntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='chaintransaction',
+            name='settled_at',
+            field=models.DateTimeField(null=True),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 2.2.13 on 2026-10-18 10:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('luci', '0022_processing_checkpoint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='word',
+            name='document_frequency',
+            field=models.BigIntegerField(db_index=True, default=0),
+        ),
+        migrations.AddField(
+            model_name='word',
+            name='occurrences',
+            field=models.BigIntegerField(db_index=True, default=0),
+        ),
+    ]
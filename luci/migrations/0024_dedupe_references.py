@@ -0,0 +1,95 @@
+from django.db import migrations
+from django.db.models import Count, F, Min, Sum
+
+CHUNK_SIZE = 1000
+
+EMOTION_FIELDS = ('pleasantness', 'attention', 'sensitivity', 'aptitude')
+
+
+def duplicated_references(model):
+    return list(
+        model.objects.values('reference')
+        .annotate(rows=Count('id'), keep_id=Min('id'))
+        .filter(rows__gt=1)
+        .values_list('reference', 'keep_id')
+    )
+
+
+def merge_emotions(Emotion, User, keep, other_ids):
+    """
+    Add the emotional data of the other users to the one of the kept user,
+    which takes one of theirs if it has none, and delete it.
+    """
+    emotion_ids = set(
+        User.objects.filter(id__in=other_ids, emotion_resume_id__isnull=False)
+        .exclude(emotion_resume_id=keep.emotion_resume_id)
+        .values_list('emotion_resume_id', flat=True)
+    )
+    if not emotion_ids:
+        return
+
+    if keep.emotion_resume_id is None:
+        keep.emotion_resume_id = min(emotion_ids)
+        emotion_ids.remove(keep.emotion_resume_id)
+        User.objects.filter(id=keep.id).update(emotion_resume_id=keep.emotion_resume_id)
+
+    if emotion_ids:
+        totals = Emotion.objects.filter(id__in=emotion_ids).aggregate(
+            **{field: Sum(field) for field in EMOTION_FIELDS}
+        )
+        Emotion.objects.filter(id=keep.emotion_resume_id).update(
+            **{field: F(field) + (totals[field] or 0) for field in EMOTION_FIELDS}
+        )
+
+    # deleting an emotion cascades to its users, so they go first
+    User.objects.filter(id__in=other_ids).delete()
+    Emotion.objects.filter(id__in=emotion_ids).exclude(
+        id__in=User.objects.filter(emotion_resume_id__in=emotion_ids).values('emotion_resume_id')
+    ).delete()
+
+
+def merge_duplicated_users(apps, schema_editor):
+    """
+    Merge the users created twice for a reference into the oldest one,
+    which get_or_create and ingest_messages already read. Its friendship
+    and emotional data get the increments of the others, and their
+    messages are moved to it.
+    """
+    User = apps.get_model('luci', 'User')
+    Emotion = apps.get_model('luci', 'Emotion')
+    Message = apps.get_model('luci', 'Message')
+
+    duplicated = duplicated_references(User)
+    for start in range(0, len(duplicated), CHUNK_SIZE):
+        for reference, keep_id in duplicated[start:start + CHUNK_SIZE]:
+            keep = User.objects.get(id=keep_id)
+            others = User.objects.filter(reference=reference).exclude(id=keep_id)
+            other_ids = list(others.values_list('id', flat=True))
+            extra = others.aggregate(total=Sum('friendshipness'))['total'] or 0
+
+            Message.objects.filter(user_id__in=other_ids).update(user_id=keep_id)
+            User.objects.filter(id=keep_id).update(friendshipness=F('friendshipness') + extra)
+            merge_emotions(Emotion, User, keep, other_ids)
+            User.objects.filter(id__in=other_ids).delete()
+
+
+def delete_duplicated_configs(apps, schema_editor):
+    """
+    Keep the oldest config of each reference. Lookups of duplicated ones
+    failed, so the others were never read.
+    """
+    CustomConfig = apps.get_model('luci', 'CustomConfig')
+    for reference, keep_id in duplicated_references(CustomConfig):
+        CustomConfig.objects.filter(reference=reference).exclude(id=keep_id).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('luci', '0023_word_frequency'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicated_users, migrations.RunPython.noop),
+        migrations.RunPython(delete_duplicated_configs, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,98 @@
+from django.db import migrations, models
+
+# table, index name, columns and uniqueness of the indexes below
+INDEXES = [
+    ('luci_customconfig', 'customconfig_reference_uniq', ['reference'], True),
+    ('luci_emotion', 'emotion_reference', ['reference'], False),
+    ('luci_message', 'message_datetime', ['message_datetime'], False),
+    ('luci_quote', 'quote_reference', ['reference'], False),
+    ('luci_user', 'user_reference_uniq', ['reference'], True),
+    ('luci_message', 'message_reference_datetime', ['reference', 'message_datetime'], False),
+    ('luci_message', 'message_intentions', ['global_intention', 'specific_intention'], False),
+]
+
+
+def create_indexes(apps, schema_editor):
+    """
+    Build the indexes without blocking writes to the tables. MySQL fails
+    instead of falling back to a locking table copy if it can not.
+    """
+    quote = schema_editor.quote_name
+    vendor = schema_editor.connection.vendor
+    for table, name, columns, unique in INDEXES:
+        unique = 'UNIQUE ' if unique else ''
+        columns = ', '.join(quote(column) for column in columns)
+        if vendor == 'mysql':
+            schema_editor.execute(
+                f'ALTER TABLE {quote(table)} ADD {unique}INDEX {quote(name)} ({columns}), '
+                f'ALGORITHM=INPLACE, LOCK=NONE'
+            )
+        elif vendor == 'postgresql':
+            schema_editor.execute(
+                f'CREATE {unique}INDEX CONCURRENTLY {quote(name)} ON {quote(table)} ({columns})'
+            )
+        else:
+            schema_editor.execute(f'CREATE {unique}INDEX {quote(name)} ON {quote(table)} ({columns})')
+
+
+def drop_indexes(apps, schema_editor):
+    quote = schema_editor.quote_name
+    for table, name, _, _ in reversed(INDEXES):
+        if schema_editor.connection.vendor == 'mysql':
+            schema_editor.execute(
+                f'ALTER TABLE {quote(table)} DROP INDEX {quote(name)}, ALGORITHM=INPLACE, LOCK=NONE'
+            )
+        else:
+            schema_editor.execute(f'DROP INDEX {quote(name)}')
+
+
+class Migration(migrations.Migration):
+    # concurrent index builds can not run inside a transaction
+    atomic = False
+
+    dependencies = [
+        ('luci', '0024_dedupe_references'),
+    ]
+
+    state_operations = [
+        migrations.AlterField(
+            model_name='customconfig',
+            name='reference',
+            field=models.CharField(max_length=100, unique=True),
+        ),
+        migrations.AlterField(
+            model_name='emotion',
+            name='reference',
+            field=models.CharField(db_index=True, max_length=100),
+        ),
+        migrations.AlterField(
+            model_name='message',
+            name='message_datetime',
+            field=models.DateTimeField(auto_now_add=True, db_index=True),
+        ),
+        migrations.AlterField(
+            model_name='quote',
+            name='reference',
+            field=models.CharField(db_index=True, max_length=100),
+        ),
+        migrations.AlterField(
+            model_name='user',
+            name='reference',
+            field=models.CharField(max_length=100, unique=True),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['reference', 'message_datetime'], name='message_reference_datetime'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['global_intention', 'specific_intention'], name='message_intentions'),
+        ),
+    ]
+
+    operations = [
+        migrations.SeparateDatabaseAndState(
+            database_operations=[migrations.RunPython(create_indexes, drop_indexes)],
+            state_operations=state_operations,
+        ),
+    ]
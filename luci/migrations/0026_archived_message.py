@@ -0,0 +1,43 @@
+# Generated by Django 2.2.13 on 2026-10-18 10:33
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('luci', '0025_reference_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedResponseLink',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('message_id', models.IntegerField()),
+                ('response_id', models.IntegerField()),
+            ],
+            options={
+                'unique_together': {('message_id', 'response_id')},
+            },
+        ),
+        migrations.CreateModel(
+            name='ArchivedMessage',
+            fields=[
+                ('server_id', models.CharField(blank=True, db_index=True, max_length=50, null=True)),
+                ('member_id', models.CharField(blank=True, db_index=True, max_length=50, null=True)),
+                ('id', models.IntegerField(primary_key=True, serialize=False)),
+                ('reference', models.CharField(db_index=True, max_length=100)),
+                ('global_intention', models.CharField(max_length=25)),
+                ('specific_intention', models.CharField(max_length=50)),
+                ('text', models.BinaryField()),
+                ('message_datetime', models.DateTimeField(db_index=True)),
+                ('archived_at', models.DateTimeField(auto_now_add=True)),
+                ('user', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='archived_messages', to='luci.User')),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+    ]
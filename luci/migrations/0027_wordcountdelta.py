@@ -0,0 +1,22 @@
+# Generated by Django 2.2.13 on 2026-10-18 10:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('luci', '0026_archived_message'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='WordCountDelta',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('token', models.CharField(max_length=100)),
+                ('occurrences', models.BigIntegerField(default=0)),
+                ('document_frequency', models.BigIntegerField(default=0)),
+            ],
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 2.2.13 on 2026-10-18 10:49
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('luci', '0027_wordcountdelta'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chaintransaction',
+            name='raw_transaction',
+            field=models.TextField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='noncecursor',
+            name='chain_nonce',
+            field=models.BigIntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='noncecursor',
+            name='chain_nonce_changed_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+    ]
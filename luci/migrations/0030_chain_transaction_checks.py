@@ -0,0 +1,27 @@
+# Generated by Django 2.2.13 on 2026-10-18 10:53
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('luci', '0029_chainworker'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chaintransaction',
+            name='last_checked_at',
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.AddField(
+            model_name='chaintransaction',
+            name='sent_at',
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.AlterIndexTogether(
+            name='chaintransaction',
+            index_together={('status', 'next_attempt_at'), ('status', 'last_checked_at')},
+        ),
+    ]
@@ -1,9 +1,51 @@
+from base64 import b64decode
 from operator import length_hint
 from django.db import models
+from django.utils import timezone
 
+TOKEN_MAX_LENGTH = 100
 
-class Emotion(models.Model):
-    reference = models.CharField(max_length=100, null=False, blank=False, unique=False)
+
+def split_reference(reference):
+    """
+    Split a base64 encoded `server_id:user_id` reference into its parts.
+    Returns (None, None) for references not following this format.
+    """
+    if not reference:
+        return None, None
+
+    try:
+        key = b64decode(reference.encode('utf-8')).decode('utf-8')
+        server_id, member_id = key.split(':')
+    except ValueError:
+        return None, None
+
+    return server_id, member_id
+
+
+class ReferenceKeys(models.Model):
+    """
+    Indexed copies of the server and user ids encoded in the reference,
+    so lookups by them can be filtered in SQL.
+    The user id is stored as `member_id` since `Message.user_id` is already
+    the column of its user foreign key.
+    """
+    server_id = models.CharField(max_length=50, null=True, blank=True, db_index=True)
+    member_id = models.CharField(max_length=50, null=True, blank=True, db_index=True)
+
+    class Meta:
+        abstract = True
+
+    def set_reference_keys(self):
+        self.server_id, self.member_id = split_reference(self.reference)
+
+    def save(self, *args, **kwargs):
+        self.set_reference_keys()
+        super().save(*args, **kwargs)
+
+
+class Emotion(ReferenceKeys):
+    reference = models.CharField(max_length=100, null=False, blank=False, db_index=True)
     pleasantness = models.FloatField(default=0)
     attention = models.FloatField(default=0)
     sensitivity = models.FloatField(default=0)
@@ -11,34 +53,65 @@ class Emotion(models.Model):
 
 
 class Quote(models.Model):
-    reference = models.CharField(max_length=100, null=False, blank=False, unique=False)
+    reference = models.CharField(max_length=100, null=False, blank=False, db_index=True)
     quote = models.BinaryField(null=False, max_length=1000)
     author = models.CharField(max_length=100, null=False, blank=False)
     date = models.DateField(auto_now_add=True)
 
 
-class User(models.Model):
-    reference = models.CharField(max_length=100, null=False, blank=False, unique=False)
+class User(ReferenceKeys):
+    reference = models.CharField(max_length=100, null=False, blank=False, unique=True)
     name = models.CharField(max_length=100)
     friendshipness = models.FloatField(default=0.0)
     emotion_resume = models.ForeignKey(Emotion, on_delete=models.CASCADE, null=True)
 
 
-class Message(models.Model):
+class Message(ReferenceKeys):
     reference = models.CharField(max_length=100, null=False, blank=False, unique=False)
     global_intention = models.CharField(max_length=25)
     specific_intention = models.CharField(max_length=50)
     text = models.BinaryField(null=False)
     user = models.ForeignKey(User, on_delete=models.CASCADE, null=True)
-    message_datetime = models.DateTimeField(auto_now_add=True)
+    message_datetime = models.DateTimeField(auto_now_add=True, db_index=True)
     possible_responses = models.ManyToManyField("self")
 
     class Meta:
         unique_together = ['reference', 'text']
+        indexes = [
+            models.Index(fields=['reference', 'message_datetime'], name='message_reference_datetime'),
+            models.Index(fields=['global_intention', 'specific_intention'], name='message_intentions'),
+        ]
+
+
+class ArchivedMessage(ReferenceKeys):
+    """
+    Messages moved out of the Message table by archive_messages, keeping
+    their ids. Texts are stored with settings.ARCHIVE_CODEC.
+    """
+    id = models.IntegerField(primary_key=True)
+    reference = models.CharField(max_length=100, null=False, blank=False, db_index=True)
+    global_intention = models.CharField(max_length=25)
+    specific_intention = models.CharField(max_length=50)
+    text = models.BinaryField(null=False)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, null=True, related_name='archived_messages')
+    message_datetime = models.DateTimeField(db_index=True)
+    archived_at = models.DateTimeField(auto_now_add=True)
+
+
+class ArchivedResponseLink(models.Model):
+    """
+    possible_responses links of archived messages, in both directions.
+    Ids may be of messages or archived messages.
+    """
+    message_id = models.IntegerField()
+    response_id = models.IntegerField()
+
+    class Meta:
+        unique_together = ['message_id', 'response_id']
 
 
 class CustomConfig(models.Model):
-    reference = models.CharField(max_length=100, null=False, blank=False, unique=False)
+    reference = models.CharField(max_length=100, null=False, blank=False, unique=True)
     server_name = models.CharField(max_length=100, null=True, blank=True)
     main_channel = models.CharField(max_length=35, null=True, blank=True)
     allow_auto_send_messages = models.BooleanField(default=True)
@@ -48,10 +121,119 @@ class CustomConfig(models.Model):
 
 class Word(models.Model):
     """ Store known words learned by Luci """
-    token = models.CharField(max_length=100, unique=True, null=False, blank=False)
+    token = models.CharField(max_length=TOKEN_MAX_LENGTH, unique=True, null=False, blank=False)
     language = models.CharField(max_length=20, null=True, blank=True)
     pos_tag = models.CharField(max_length=10, null=True, blank=True)
     lemma = models.CharField(max_length=100, null=True, blank=True)
     entity = models.CharField(max_length=10, null=True, blank=True)
     polarity = models.FloatField(null=True)
     length = models.IntegerField()
+    # times the word was used, and number of texts using it
+    occurrences = models.BigIntegerField(default=0, db_index=True)
+    document_frequency = models.BigIntegerField(default=0, db_index=True)
+
+
+class WordCountDelta(models.Model):
+    """
+    Word counts of newly stored texts, added to Word in batches by
+    luci.util.flush_vocabulary outside of the requests storing them.
+    """
+    token = models.CharField(max_length=TOKEN_MAX_LENGTH, null=False, blank=False)
+    occurrences = models.BigIntegerField(default=0)
+    document_frequency = models.BigIntegerField(default=0)
+
+
+class MessageToken(models.Model):
+    """ Inverted index of the word tokens found on each message """
+    token = models.CharField(max_length=TOKEN_MAX_LENGTH, null=False, blank=False)
+    message = models.ForeignKey(Message, on_delete=models.CASCADE, related_name='tokens')
+
+    class Meta:
+        unique_together = ['token', 'message']
+
+
+class CompressionDictionary(models.Model):
+    """ Preset dictionaries trained for compressing stored texts """
+    data = models.BinaryField(null=False)
+    sample_size = models.IntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+
+class ChainTransaction(models.Model):
+    """
+    Outbox of contract transactions, sent by the web3 worker
+    (see luci.chain) after the request that queued them commits.
+    """
+    PENDING = 'pending'
+    SENDING = 'sending'
+    SENT = 'sent'
+    CONFIRMED = 'confirmed'
+    FAILED = 'failed'
+    STATUS_CHOICES = (
+        (PENDING, 'Pending'),
+        (SENDING, 'Sending'),
+        (SENT, 'Sent'),
+        (CONFIRMED, 'Confirmed'),
+        (FAILED, 'Failed'),
+    )
+
+    function = models.CharField(max_length=50)
+    member_id = models.CharField(max_length=50)
+    # messages counted by this call, greater than 1 when coalesced
+    increment = models.PositiveIntegerField(default=1)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING)
+    attempts = models.IntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(null=True, blank=True)
+    # kept from the first attempt on, so retries resend the same transaction
+    nonce = models.BigIntegerField(null=True)
+    transaction_hash = models.CharField(max_length=66, null=True, blank=True)
+    raw_transaction = models.TextField(null=True, blank=True)
+    # ChainWorker.name of the worker sending the entry, and since when
+    claimed_by = models.CharField(max_length=255, null=True, blank=True)
+    claimed_at = models.DateTimeField(null=True)
+    gas_used = models.BigIntegerField(null=True)
+    block_number = models.BigIntegerField(null=True)
+    receipt_status = models.IntegerField(null=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    sent_at = models.DateTimeField(null=True)
+    # last time the receipt reconciler asked for the receipt
+    last_checked_at = models.DateTimeField(null=True)
+    settled_at = models.DateTimeField(null=True)
+
+    class Meta:
+        index_together = [['status', 'next_attempt_at'], ['status', 'last_checked_at']]
+
+
+class NonceCursor(models.Model):
+    """
+    Next transaction nonce of a signing account, shared by all the
+    processes sending transactions from it.
+    """
+    address = models.CharField(max_length=42, unique=True)
+    next_nonce = models.BigIntegerField()
+    synced_at = models.DateTimeField(default=timezone.now)
+    # pending nonce last reported by the chain, and when it last moved
+    chain_nonce = models.BigIntegerField(null=True)
+    chain_nonce_changed_at = models.DateTimeField(default=timezone.now)
+
+
+class ChainWorker(models.Model):
+    """
+    A running chain worker, alive while it keeps its heartbeat within
+    settings.WEB3_WORKER_LEASE.
+    """
+    name = models.CharField(max_length=255, unique=True)
+    started_at = models.DateTimeField(default=timezone.now)
+    heartbeat_at = models.DateTimeField(default=timezone.now)
+
+
+class ProcessingCheckpoint(models.Model):
+    """
+    High-water mark of a resumable batch job, usually the last row id
+    it processed.
+    """
+    name = models.CharField(max_length=255, unique=True)
+    position = models.BigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
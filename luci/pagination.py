@@ -0,0 +1,77 @@
+"""
+Keyset pagination for list queries.
+
+Pages are ordered by a set of fields ending on a unique one, and the cursor
+of a row holds its values for those fields. The next page is filtered to
+the rows coming after the cursor, so its cost does not depend on how deep
+the client is in the list, unlike OFFSET based pages.
+"""
+import json
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from django.conf import settings
+from django.db.models import Q
+from graphql import GraphQLError
+
+
+def encode_cursor(values):
+    # datetimes keep their microseconds, unlike with DjangoJSONEncoder
+    data = json.dumps(values, default=lambda value: value.isoformat()).encode('utf-8')
+    return urlsafe_b64encode(data).decode('utf-8')
+
+
+def decode_cursor(cursor, ordering):
+    try:
+        values = json.loads(urlsafe_b64decode(cursor.encode('utf-8')))
+    except ValueError:
+        raise GraphQLError('Invalid cursor')
+
+    if not isinstance(values, list) or len(values) != len(ordering):
+        raise GraphQLError('Invalid cursor')
+
+    return values
+
+
+def get_page_size(first):
+    if first is None:
+        return settings.PAGINATION_DEFAULT_PAGE_SIZE
+
+    if first < 1 or first > settings.PAGINATION_MAX_PAGE_SIZE:
+        raise GraphQLError(
+            f'first must be between 1 and {settings.PAGINATION_MAX_PAGE_SIZE}'
+        )
+
+    return first
+
+
+def keyset_filter(ordering, values):
+    """
+    Filter for the rows coming after the given values, in the given ordering.
+    For ('a', '-b') it is: a > x OR (a = x AND b < y)
+    """
+    condition = Q()
+    equal = {}
+    for field, value in zip(ordering, values):
+        name = field.lstrip('-')
+        lookup = 'lt' if field.startswith('-') else 'gt'
+        condition |= Q(**equal, **{f'{name}__{lookup}': value})
+        equal[name] = value
+
+    return condition
+
+
+def paginate(queryset, ordering, first=None, after=None):
+    """
+    Return a page of the queryset as a list, with the `cursor` attribute
+    of each row set for requesting the rows after it.
+    """
+    queryset = queryset.order_by(*ordering)
+    if after:
+        queryset = queryset.filter(keyset_filter(ordering, decode_cursor(after, ordering)))
+
+    page = list(queryset[:get_page_size(first)])
+    for row in page:
+        row.cursor = encode_cursor(
+            [getattr(row, field.lstrip('-')) for field in ordering]
+        )
+
+    return page
@@ -0,0 +1,167 @@
+"""
+Receipt reconciler for sent chain transactions.
+
+The transaction hashes waiting for a receipt are the ChainTransaction rows
+in sent state. They are checked together, with JSON-RPC batch requests,
+on the timer of the chain worker, and the receipt data is stored on each
+row so it can be queried later.
+
+Each pass checks the rows checked least recently, so a backlog of
+transactions never mined can not starve the others. A transaction the node
+stopped knowing about for settings.WEB3_DROPPED_TIMEOUT after it was sent
+was dropped from its pool, and its row goes back to the outbox, which
+sends the same signed transaction again.
+"""
+import logging
+from datetime import timedelta
+from django.conf import settings
+from django.db.models import F
+from django.utils import timezone
+from luci.clients import get_session
+from luci.models import ChainTransaction
+
+logger = logging.getLogger(__name__)
+
+
+class BatchError(Exception):
+    """
+    A JSON-RPC batch request answered with something else than a list of
+    responses to it.
+    """
+
+
+def call_batch(method, params):
+    """
+    Call a JSON-RPC method once per item of `params`, in a single batch.
+    Returns a dict of index in `params` to result, without the calls that
+    failed or had no result.
+    """
+    if not params:
+        return {}
+
+    payload = [
+        {
+            'jsonrpc': '2.0',
+            'id': index,
+            'method': method,
+            'params': item_params
+        }
+        for index, item_params in enumerate(params)
+    ]
+    response = get_session().post(
+        settings.WEB3_PROVIDER_URL,
+        json=payload,
+        timeout=settings.WEB3_REQUEST_TIMEOUT
+    )
+    response.raise_for_status()
+
+    items = response.json()
+    if isinstance(items, dict) and items.get('error'):
+        # the whole batch was refused, e.g. batches disabled or too large
+        raise BatchError(f'{method} batch failed: {items["error"]}')
+    if not isinstance(items, list):
+        raise BatchError(f'{method} batch answered with a {type(items).__name__}')
+
+    results = {}
+    for item in items:
+        index = item.get('id') if isinstance(item, dict) else None
+        if not isinstance(index, int) or not 0 <= index < len(params):
+            logger.warning('Ignoring unexpected %s response: %r', method, item)
+            continue
+        if item.get('error'):
+            logger.warning('%s request %s failed: %s', method, index, item['error'])
+            continue
+        if item.get('result') is not None:
+            results[index] = item['result']
+
+    return results
+
+
+def fetch_receipts(hashes):
+    """
+    Fetch the receipts of many transactions in a single JSON-RPC batch.
+    Returns a dict of hash to receipt, without the transactions not mined yet.
+    """
+    results = call_batch('eth_getTransactionReceipt', [[transaction_hash] for transaction_hash in hashes])
+    return {hashes[index]: receipt for index, receipt in results.items()}
+
+
+def fetch_known(hashes):
+    """
+    Return the set of the given transaction hashes the node knows about,
+    pending or mined.
+    """
+    results = call_batch('eth_getTransactionByHash', [[transaction_hash] for transaction_hash in hashes])
+    return {hashes[index] for index in results}
+
+
+def requeue_dropped(entries):
+    """
+    Send entries whose transaction the node dropped back to the outbox,
+    keeping their nonce and signed transaction.
+    Returns the entries requeued.
+    """
+    if not entries:
+        return []
+
+    known = fetch_known([entry.transaction_hash for entry in entries])
+    dropped = [entry for entry in entries if entry.transaction_hash not in known]
+
+    now = timezone.now()
+    for entry in dropped:
+        logger.warning('Transaction %s of entry %s was dropped, resending it', entry.transaction_hash, entry.id)
+        entry.status = ChainTransaction.PENDING
+        entry.next_attempt_at = now
+        entry.last_error = 'Transaction dropped by the node'
+
+    return dropped
+
+
+def reconcile(batch_size=None):
+    """
+    Record the receipts of the sent transactions already mined, and requeue
+    the ones dropped by the node.
+    Returns the number of transactions settled.
+    """
+    batch_size = batch_size or settings.WEB3_RECEIPT_BATCH_SIZE
+    sent = list(
+        ChainTransaction.objects.filter(
+            status=ChainTransaction.SENT
+        ).order_by(F('last_checked_at').asc(nulls_first=True), 'id')[:batch_size]
+    )
+    receipts = fetch_receipts([entry.transaction_hash for entry in sent])
+
+    now = timezone.now()
+    dropped_before = now - timedelta(seconds=settings.WEB3_DROPPED_TIMEOUT)
+    settled = []
+    waiting = []
+    for entry in sent:
+        entry.last_checked_at = now
+        receipt = receipts.get(entry.transaction_hash)
+        if receipt is None:
+            if entry.sent_at is None or entry.sent_at < dropped_before:
+                waiting.append(entry)
+            continue
+
+        entry.receipt_status = int(receipt['status'], 16)
+        entry.gas_used = int(receipt['gasUsed'], 16)
+        entry.block_number = int(receipt['blockNumber'], 16)
+        entry.settled_at = now
+        if entry.receipt_status == 1:
+            entry.status = ChainTransaction.CONFIRMED
+        else:
+            entry.status = ChainTransaction.FAILED
+            entry.last_error = 'Transaction reverted'
+        settled.append(entry)
+
+    requeue_dropped(waiting)
+
+    ChainTransaction.objects.bulk_update(
+        sent,
+        [
+            'status', 'receipt_status', 'gas_used', 'block_number', 'settled_at',
+            'last_error', 'next_attempt_at', 'last_checked_at'
+        ]
+    )
+
+    return len(settled)
@@ -0,0 +1,314 @@
+"""
+TF-IDF retrieval of response candidates.
+
+Messages are stored as rows of a sparse CSR matrix, one column per Word id,
+weighted by TF-IDF from the Word document frequencies and L2 normalized.
+Finding the messages most similar to a text is then a single sparse matrix
+by vector product, whose scores are cosine similarities.
+
+The matrix arrays are saved as .npy files in a versioned directory under
+settings.TFIDF_INDEX_DIR, which the CURRENT file points to. Each process
+memory-maps the current version, and maps the new one when CURRENT changes,
+so refreshing the index never blocks requests.
+"""
+import json
+import os
+import shutil
+import threading
+from collections import Counter
+from math import log, sqrt
+import numpy as np
+from scipy.sparse import csr_matrix
+from django.conf import settings
+from django.utils import timezone
+from luci.loaders import EXCLUDED_RESPONSE_PREFIXES
+from luci.models import Message, Quote, Word, TOKEN_MAX_LENGTH
+from luci.util import CompressedString, tokenize
+
+ARRAYS = ('data', 'indices', 'indptr', 'message_ids')
+POINTER = 'CURRENT'
+
+_lock = threading.Lock()
+_loaded = {'version': None, 'index': None}
+
+
+class TfidfIndex:
+    def __init__(self, matrix, message_ids, meta):
+        self.matrix = matrix
+        self.message_ids = message_ids
+        self.meta = meta
+
+    @property
+    def documents(self):
+        return self.meta['documents']
+
+    def vectorize(self, text):
+        """
+        Return the normalized TF-IDF vector of a text, as a dense array.
+        """
+        counts = Counter(token for token in tokenize(text) if len(token) <= TOKEN_MAX_LENGTH)
+        vector = np.zeros(self.matrix.shape[1], dtype=np.float32)
+        words = Word.objects.filter(token__in=counts).values_list('token', 'id', 'document_frequency')
+        for token, word_id, document_frequency in words:
+            if word_id < vector.shape[0]:
+                vector[word_id] = weight(counts[token], document_frequency, self.documents)
+
+        norm = np.linalg.norm(vector)
+        if norm:
+            vector /= norm
+        return vector
+
+    def most_similar(self, text, limit):
+        """
+        Return the (message id, score) pairs of the messages most similar
+        to the text, best first, without the ones sharing no word with it.
+        """
+        if not self.message_ids.shape[0]:
+            return []
+
+        scores = self.matrix.dot(self.vectorize(text))
+        limit = min(limit, scores.shape[0])
+        best = np.argpartition(-scores, limit - 1)[:limit]
+        best = best[np.argsort(-scores[best])]
+
+        return [
+            (int(self.message_ids[row]), float(scores[row]))
+            for row in best if scores[row] > 0
+        ]
+
+
+def best_responses(text, reference=None, k=10):
+    """
+    Return the k best (score, response) pairs for a text, from the possible
+    responses of the messages most similar to it. A response scores the
+    similarity of the best message it answers.
+    Returns None if the index was not built yet.
+    """
+    index = load_current()
+    if index is None:
+        return None
+
+    similar = index.most_similar(text, k * settings.TFIDF_CANDIDATE_FACTOR)
+    scores = dict(similar)
+    if reference is not None:
+        matching = set(
+            Message.objects.filter(id__in=scores, reference=reference)
+            .values_list('id', flat=True)
+        )
+        scores = {pk: score for pk, score in scores.items() if pk in matching}
+
+    through = Message.possible_responses.through
+    links = through.objects.filter(
+        from_message_id__in=scores
+    ).values_list('from_message_id', 'to_message_id')
+
+    response_scores = {}
+    for message_id, response_id in links:
+        score = scores[message_id]
+        if score > response_scores.get(response_id, 0):
+            response_scores[response_id] = score
+
+    responses = Message.objects.in_bulk(response_scores)
+    ranked = sorted(response_scores.items(), key=lambda item: (-item[1], item[0]))
+    best = []
+    for response_id, score in ranked:
+        response = responses.get(response_id)
+        if response is None or CompressedString.decompress_bytes(response.text).startswith(
+            EXCLUDED_RESPONSE_PREFIXES
+        ):
+            continue
+        best.append((score, response))
+        if len(best) == k:
+            break
+
+    return best
+
+
+def weight(term_count, document_frequency, documents):
+    """
+    Sublinear TF times smoothed IDF.
+    """
+    idf = log((1 + documents) / (1 + document_frequency)) + 1
+    return (1 + log(term_count)) * idf
+
+
+def count_documents():
+    # Word document frequencies count both messages and quotes
+    return Message.objects.count() + Quote.objects.count()
+
+
+def load_vocabulary():
+    return {
+        token: (word_id, document_frequency)
+        for token, word_id, document_frequency
+        in Word.objects.values_list('token', 'id', 'document_frequency').iterator()
+    }
+
+
+def vectorize_rows(messages, vocabulary, documents):
+    """
+    Build the CSR arrays of the given (id, text blob) message rows.
+    Rows sharing no known word with the vocabulary are left out.
+    """
+    data = []
+    indices = []
+    indptr = [0]
+    message_ids = []
+    for message_id, text in messages:
+        counts = Counter(tokenize(CompressedString.decompress_bytes(text)))
+        row = {}
+        for token, count in counts.items():
+            if token in vocabulary:
+                word_id, document_frequency = vocabulary[token]
+                row[word_id] = weight(count, document_frequency, documents)
+        if not row:
+            continue
+
+        norm = sqrt(sum(value * value for value in row.values()))
+        for word_id in sorted(row):
+            indices.append(word_id)
+            data.append(row[word_id] / norm)
+        indptr.append(len(indices))
+        message_ids.append(message_id)
+
+    return data, indices, indptr, message_ids
+
+
+def build(incremental=False, chunk_size=5000, stdout=None):
+    """
+    Build a new index version and make it the current one.
+    An incremental build only vectorizes the messages stored since the
+    current version, reusing the rows already built.
+    Returns the metadata of the new version.
+    """
+    current = load_current() if incremental else None
+    vocabulary = load_vocabulary()
+    documents = count_documents()
+    columns = max((word_id for word_id, _ in vocabulary.values()), default=0) + 1
+
+    if current is not None:
+        data = [current.matrix.data]
+        indices = [current.matrix.indices]
+        indptr = [current.matrix.indptr]
+        message_ids = [current.message_ids]
+        last_id = current.meta['last_message_id']
+        columns = max(columns, current.matrix.shape[1])
+    else:
+        data, indices, indptr, message_ids = [], [], [np.zeros(1, dtype=np.int64)], []
+        last_id = 0
+
+    offset = int(indptr[-1][-1])
+    rows = 0
+    while True:
+        chunk = list(
+            Message.objects.filter(id__gt=last_id)
+            .order_by('id')
+            .values_list('id', 'text')[:chunk_size]
+            .iterator()
+        )
+        if not chunk:
+            break
+
+        chunk_data, chunk_indices, chunk_indptr, chunk_ids = vectorize_rows(chunk, vocabulary, documents)
+        data.append(np.array(chunk_data, dtype=np.float32))
+        indices.append(np.array(chunk_indices, dtype=np.int64))
+        indptr.append(np.array(chunk_indptr[1:], dtype=np.int64) + offset)
+        message_ids.append(np.array(chunk_ids, dtype=np.int64))
+        offset += len(chunk_indices)
+        last_id = chunk[-1][0]
+        rows += len(chunk_ids)
+        if stdout:
+            stdout.write(f'{rows} messages vectorized, last id {last_id}.')
+
+    meta = {
+        'documents': documents if current is None else current.documents,
+        'columns': columns,
+        'last_message_id': last_id,
+        'built_at': timezone.now().isoformat(),
+    }
+    arrays = {
+        'data': np.concatenate(data) if data else np.zeros(0, dtype=np.float32),
+        'indices': np.concatenate(indices) if indices else np.zeros(0, dtype=np.int64),
+        'indptr': np.concatenate(indptr),
+        'message_ids': np.concatenate(message_ids) if message_ids else np.zeros(0, dtype=np.int64),
+    }
+    save(arrays, meta)
+    return meta
+
+
+def save(arrays, meta):
+    """
+    Write a new index version and point CURRENT to it atomically.
+    Old versions but the previous one are removed, processes still mapping
+    them keep their data until they move to the new version.
+    """
+    index_dir = settings.TFIDF_INDEX_DIR
+    version = timezone.now().strftime('%Y%m%d%H%M%S%f')
+    path = os.path.join(index_dir, version)
+    os.makedirs(path)
+
+    # int32 indices keep the matrix mappable by scipy without a copy
+    index_dtype = np.int32 if max(meta['columns'], arrays['indptr'][-1]) < 2 ** 31 else np.int64
+    arrays['indices'] = arrays['indices'].astype(index_dtype)
+    arrays['indptr'] = arrays['indptr'].astype(index_dtype)
+
+    for name in ARRAYS:
+        np.save(os.path.join(path, f'{name}.npy'), arrays[name])
+    with open(os.path.join(path, 'meta.json'), 'w') as meta_file:
+        json.dump(meta, meta_file)
+
+    pointer = os.path.join(index_dir, POINTER)
+    with open(f'{pointer}.tmp', 'w') as pointer_file:
+        pointer_file.write(version)
+    previous = read_pointer()
+    os.replace(f'{pointer}.tmp', pointer)
+
+    for name in os.listdir(index_dir):
+        if name in (version, previous, POINTER):
+            continue
+        old = os.path.join(index_dir, name)
+        if os.path.isdir(old):
+            shutil.rmtree(old, ignore_errors=True)
+
+
+def read_pointer():
+    try:
+        with open(os.path.join(settings.TFIDF_INDEX_DIR, POINTER)) as pointer_file:
+            return pointer_file.read().strip()
+    except FileNotFoundError:
+        return None
+
+
+def load_version(version):
+    path = os.path.join(settings.TFIDF_INDEX_DIR, version)
+    arrays = {
+        name: np.load(os.path.join(path, f'{name}.npy'), mmap_mode='r')
+        for name in ARRAYS
+    }
+    with open(os.path.join(path, 'meta.json')) as meta_file:
+        meta = json.load(meta_file)
+
+    matrix = csr_matrix(
+        (arrays['data'], arrays['indices'], arrays['indptr']),
+        shape=(arrays['message_ids'].shape[0], meta['columns']),
+        copy=False
+    )
+    return TfidfIndex(matrix, arrays['message_ids'], meta)
+
+
+def load_current():
+    """
+    Return the current index, mapping it again if it was rebuilt since the
+    last call, or None if no index was built yet.
+    """
+    version = read_pointer()
+    if version is None:
+        return None
+
+    if _loaded['version'] != version:
+        with _lock:
+            if _loaded['version'] != version:
+                _loaded['index'] = load_version(version)
+                _loaded['version'] = version
+
+    return _loaded['index']
@@ -0,0 +1,146 @@
+"""
+Read replica routing.
+
+Reads go to the primary database unless the current request allowed
+replica reads, which the GraphQL view does for query operations and the
+export view for its reads. Commands, workers and mutations therefore
+always use the primary. After a mutation the request is pinned to the
+primary, so the rest of it reads its own writes.
+
+Replicas are the aliases of settings.DATABASE_REPLICAS. One is picked at
+random per read among those passing their health check, which is run at
+most once per REPLICA_HEALTH_CHECK_INTERVAL seconds per process, and the
+primary is used when none does.
+"""
+import logging
+import random
+import threading
+from contextlib import contextmanager
+from time import monotonic
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections
+
+logger = logging.getLogger(__name__)
+
+_state = threading.local()
+
+_health_lock = threading.Lock()
+_health = {}
+
+
+def allow_replica_reads():
+    _state.replica_reads = True
+
+
+def pin_primary():
+    """
+    Send every read of the current request to the primary.
+    """
+    _state.pinned = True
+
+
+@contextmanager
+def primary_reads():
+    """
+    Send the reads of the block to the primary.
+    """
+    pinned = getattr(_state, 'pinned', False)
+    _state.pinned = True
+    try:
+        yield
+    finally:
+        _state.pinned = pinned
+
+
+def reset():
+    _state.replica_reads = False
+    _state.pinned = False
+
+
+def read_from_replicas(iterable):
+    """
+    Iterate with replica reads allowed, for streamed responses, which are
+    read after the view returned.
+    """
+    allow_replica_reads()
+    try:
+        yield from iterable
+    finally:
+        reset()
+
+
+def replica_reads_allowed():
+    return getattr(_state, 'replica_reads', False) and not getattr(_state, 'pinned', False)
+
+
+def check_database(alias):
+    """
+    Return if the database answers a trivial query.
+    """
+    try:
+        with connections[alias].cursor() as cursor:
+            cursor.execute('SELECT 1')
+            cursor.fetchone()
+    except DatabaseError as ex:
+        logger.warning('Database %s failed its health check: %s', alias, ex)
+        connections[alias].close()
+        return False
+
+    return True
+
+
+def is_healthy(alias):
+    with _health_lock:
+        checked_at, healthy = _health.get(alias, (None, None))
+    now = monotonic()
+    if checked_at is not None and now - checked_at < settings.REPLICA_HEALTH_CHECK_INTERVAL:
+        return healthy
+
+    healthy = check_database(alias)
+    with _health_lock:
+        _health[alias] = (now, healthy)
+    return healthy
+
+
+def healthy_replicas():
+    return [alias for alias in settings.DATABASE_REPLICAS if is_healthy(alias)]
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        if not settings.DATABASE_REPLICAS or not replica_reads_allowed():
+            return DEFAULT_DB_ALIAS
+
+        replicas = healthy_replicas()
+        if not replicas:
+            return DEFAULT_DB_ALIAS
+
+        return random.choice(replicas)
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = {DEFAULT_DB_ALIAS, *settings.DATABASE_REPLICAS}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # replicas get the schema from the primary
+        return db not in settings.DATABASE_REPLICAS
+
+
+class ReplicaMiddleware:
+    """
+    Start and end each request reading from the primary only.
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        reset()
+        try:
+            return self.get_response(request)
+        finally:
+            reset()
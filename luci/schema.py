@@ -1,11 +1,19 @@
-from time import sleep
-import logging
-from base64 import b64decode
+from collections import Counter
 import graphene
 from django.conf import settings
-from luci.models import Emotion, Quote, User, Message, CustomConfig, Word
-from luci.util import CompressedString
-from web3 import Web3
+from django.db import connection, transaction
+from django.db.models import Case, CharField, F, Value, When
+from graphql import GraphQLError
+from luci import cache, chain
+from luci.loaders import get_loaders
+from luci.pagination import get_page_size, paginate
+from luci.models import (
+    ArchivedMessage, ChainTransaction, Emotion, Quote, User, Message, CustomConfig, Word
+)
+from luci.util import (
+    CompressedString, EMOTION_FIELDS, increments, index_message,
+    filter_by_words, index_messages, keyed_increments, learn_vocabulary, search_messages
+)
 
 
 class WordType(graphene.ObjectType):
@@ -16,6 +24,9 @@ class WordType(graphene.ObjectType):
     entity = graphene.String()
     polarity = graphene.Float()
     length = graphene.Int()
+    occurrences = graphene.Int()
+    document_frequency = graphene.Int()
+    cursor = graphene.String()
 
 
 class CustomConfigType(graphene.ObjectType):
@@ -35,15 +46,27 @@ class MessageType(graphene.ObjectType):
     message_datetime = graphene.DateTime()
     possible_responses = graphene.List(lambda: MessageType)
     author = graphene.String()
+    archived = graphene.Boolean()
+    cursor = graphene.String()
 
     def resolve_text(self, info, **kwargs):
         return CompressedString.decompress_bytes(self.text)
 
+    def resolve_archived(self, info, **kwargs):
+        return isinstance(self, ArchivedMessage)
+
     def resolve_author(self, info, **kwargs):
-        return self.user.name if self.user else None
+        if self.user_id is None:
+            return None
+
+        user = get_loaders(info.context).users.load(self.user_id)
+        return user.then(lambda user: user.name if user else None)
 
     def resolve_possible_responses(self, info, **kwargs):
-        return self.possible_responses.all().exclude(text__startswith='!').exclude(text__startswith='http').exclude(text__startswith=';;')
+        loaders = get_loaders(info.context)
+        if getattr(self, 'include_archived', False):
+            return loaders.archived_responses.load(self.id)
+        return loaders.possible_responses.load(self.id)
 
 
 class UserType(graphene.ObjectType):
@@ -52,9 +75,16 @@ class UserType(graphene.ObjectType):
     friendshipness = graphene.Float()
     emotion_resume = graphene.Field('luci.schema.EmotionType')
     messages = graphene.List(MessageType)
+    cursor = graphene.String()
 
     def resolve_messages(self, info, **kwargs):
-        return self.message_set.all()
+        return get_loaders(info.context).user_messages.load(self.id)
+
+    def resolve_emotion_resume(self, info, **kwargs):
+        if self.emotion_resume_id is None:
+            return None
+
+        return get_loaders(info.context).emotions.load(self.emotion_resume_id)
 
 
 class EmotionType(graphene.ObjectType):
@@ -71,11 +101,61 @@ class QuoteType(graphene.ObjectType):
     quote = graphene.String()
     author = graphene.String()
     date = graphene.Date()
+    cursor = graphene.String()
 
     def resolve_quote(self, info, **kwargs):
         return CompressedString.decompress_bytes(self.quote)
 
 
+class ScoredMessageType(graphene.ObjectType):
+    score = graphene.Float()
+    message = graphene.Field(MessageType)
+
+
+class CacheStatsType(graphene.ObjectType):
+    local_hits = graphene.Int()
+    shared_hits = graphene.Int()
+    misses = graphene.Int()
+    invalidations = graphene.Int()
+    local_size = graphene.Int()
+
+
+class ChainTransactionType(graphene.ObjectType):
+    id = graphene.ID()
+    function = graphene.String()
+    member_id = graphene.String()
+    increment = graphene.Int()
+    status = graphene.String()
+    attempts = graphene.Int()
+    last_error = graphene.String()
+    nonce = graphene.Int()
+    transaction_hash = graphene.String()
+    gas_used = graphene.Int()
+    block_number = graphene.Int()
+    receipt_status = graphene.Int()
+    created_at = graphene.DateTime()
+    settled_at = graphene.DateTime()
+    cursor = graphene.String()
+
+
+class WordOrder(graphene.Enum):
+    ID = 'id'
+    OCCURRENCES = 'occurrences'
+    DOCUMENT_FREQUENCY = 'document_frequency'
+
+
+WORD_ORDERINGS = {
+    'id': ('id',),
+    'occurrences': ('-occurrences', '-id'),
+    'document_frequency': ('-document_frequency', '-id'),
+}
+
+
+class SearchOperator(graphene.Enum):
+    AND = 'AND'
+    OR = 'OR'
+
+
 class Query:
     version = graphene.String()
 
@@ -95,44 +175,30 @@ class Query:
         ),
         user_id=graphene.String(),
         server_id=graphene.String(),
+        first=graphene.Int(description='Page size'),
+        after=graphene.String(description='Cursor of the last row seen'),
     )
 
     def resolve_users(self, info, **kwargs):
+        first = kwargs.pop('first', None)
+        after = kwargs.pop('after', None)
         user_id = kwargs.pop('user_id', None)
         server_id = kwargs.pop('server_id', None)
-        users = User.objects.filter(**kwargs)
-
-        if not user_id and not server_id:
-            return users
-
-        if user_id and not server_id:
-            filtered = []
-            for user in users:
-                key = b64decode(user.reference.encode('utf-8')).decode('utf-8')
-                _, uid = key.split(':')
-                if user_id == uid:
-                    filtered.append(user)
-            return filtered
-
-        if server_id and not user_id:
-            filtered = []
-            for user in users:
-                key = b64decode(user.reference.encode('utf-8')).decode('utf-8')
-                sid, _ = key.split(':')
-                if server_id == sid:
-                    filtered.append(user)
-            return filtered
-    
-        if server_id and user_id:
-            filtered = []
-            for user in users:
-                key = b64decode(user.reference.encode('utf-8')).decode('utf-8')
-                sid, uid = key.split(':')
-                if server_id == sid and user_id == uid:
-                    filtered.append(user)
-            return filtered
 
-        return users
+        if user_id:
+            kwargs['member_id'] = user_id
+        if server_id:
+            kwargs['server_id'] = server_id
+
+        # the common lookup of the users of a reference is cached
+        if list(kwargs) == ['reference'] and first is None and after is None:
+            return cache.get_or_load(
+                cache.USERS,
+                kwargs['reference'],
+                lambda: paginate(User.objects.filter(**kwargs), ('id',))
+            )
+
+        return paginate(User.objects.filter(**kwargs), ('id',), first, after)
 
     emotions = graphene.List(
         EmotionType,
@@ -143,47 +209,151 @@ class Query:
     )
 
     def resolve_emotions(self, info, **kwargs):
-        return Emotion.objects.filter(reference=kwargs['reference'])
+        return cache.get_or_load(
+            cache.EMOTIONS,
+            kwargs['reference'],
+            lambda: list(Emotion.objects.filter(reference=kwargs['reference']))
+        )
 
     quotes = graphene.List(
         QuoteType,
         reference=graphene.String(required=True),
         author=graphene.String(),
-        date=graphene.Date()
+        date=graphene.Date(),
+        first=graphene.Int(description='Page size'),
+        after=graphene.String(description='Cursor of the last row seen'),
     )
 
     def resolve_quotes(self, info, **kwargs):
-        return Quote.objects.filter(**kwargs)
+        first = kwargs.pop('first', None)
+        after = kwargs.pop('after', None)
+        return paginate(Quote.objects.filter(**kwargs), ('id',), first, after)
 
     messages = graphene.List(
         MessageType,
-        text__icontains=graphene.String(),
-        text__contains=graphene.String(),
+        text__icontains=graphene.String(
+            description='Messages containing all the words of this text'
+        ),
+        text__contains=graphene.String(
+            description='Messages containing all the words of this text'
+        ),
         global_intention=graphene.String(),
         specific_intention=graphene.String(),
         user__name=graphene.String(),
         reference=graphene.String(),
-        text__startswith=graphene.String(),
-        text__not_startswith=graphene.List(graphene.String),
-        text__not_contains= graphene.List(graphene.String),
+        text__not_contains=graphene.List(
+            graphene.String,
+            description='Messages not containing all the words of any of these texts'
+        ),
+        include_archived=graphene.Boolean(
+            default_value=False,
+            description='Also list archived messages, text filters can not be used then'
+        ),
+        first=graphene.Int(description='Page size'),
+        after=graphene.String(description='Cursor of the last row seen'),
     )
 
     def resolve_messages(self, info, **kwargs):
-        startswith_exclude = []
-        if kwargs.get('text__not_startswith') is not None:
-            startswith_exclude = kwargs.pop('text__not_startswith')
+        first = kwargs.pop('first', None)
+        after = kwargs.pop('after', None)
+        ordering = ('message_datetime', 'id')
+
+        if kwargs.pop('include_archived'):
+            if any(name.startswith('text__') for name in kwargs):
+                # archived messages are not in the token index
+                raise GraphQLError('Text filters can not be used with include_archived')
+
+            # the first page of each table, merged in cursor order
+            page = paginate(Message.objects.filter(**kwargs), ordering, first, after)
+            page += paginate(ArchivedMessage.objects.filter(**kwargs), ordering, first, after)
+            page = sorted(page, key=lambda message: (message.message_datetime, message.id))
+            page = page[:get_page_size(first)]
+            for message in page:
+                message.include_archived = True
+            return page
 
         contains_exclude = []
         if kwargs.get('text__not_contains') is not None:
             contains_exclude = kwargs.pop('text__not_contains')
 
+        # word filters go through the token index
+        contains = [
+            kwargs.pop(name) for name in ('text__icontains', 'text__contains')
+            if kwargs.get(name) is not None
+        ]
+
         messages = Message.objects.filter(**kwargs)
-        for constraint in startswith_exclude:
-            messages = messages.exclude(text__istartswith=constraint)
+        for text in contains:
+            messages = filter_by_words(messages, text)
+
+        for text in contains_exclude:
+            messages = filter_by_words(messages, text, exclude=True)
+
+        return paginate(messages, ordering, first, after)
 
-        for constraint in contains_exclude:
-            messages = messages.exclude(text__icontains=constraint)
-        return messages
+    search_messages = graphene.List(
+        MessageType,
+        query=graphene.String(
+            required=True,
+            description='Words to search for, a trailing * matches by prefix'
+        ),
+        reference=graphene.String(),
+        limit=graphene.Int(default_value=50, description='Page size'),
+        after=graphene.String(description='Cursor of the last row seen'),
+        operator=SearchOperator(
+            default_value='AND',
+            description='If all (AND) or any (OR) of the words must be found'
+        )
+    )
+
+    def resolve_search_messages(self, info, **kwargs):
+        limit = kwargs['limit']
+        if limit < 1 or limit > settings.PAGINATION_MAX_PAGE_SIZE:
+            raise GraphQLError(
+                f'limit must be between 1 and {settings.PAGINATION_MAX_PAGE_SIZE}'
+            )
+
+        messages = search_messages(
+            kwargs['query'],
+            reference=kwargs.get('reference'),
+            operator=kwargs['operator']
+        )
+        return paginate(messages, ('-id',), limit, kwargs.get('after'))
+
+    best_responses = graphene.List(
+        ScoredMessageType,
+        text=graphene.String(required=True),
+        reference=graphene.String(
+            description='Only use messages with this reference as context'
+        ),
+        k=graphene.Int(default_value=10, description='Number of responses')
+    )
+
+    def resolve_best_responses(self, info, **kwargs):
+        k = kwargs['k']
+        if k < 1 or k > settings.PAGINATION_MAX_PAGE_SIZE:
+            raise GraphQLError(
+                f'k must be between 1 and {settings.PAGINATION_MAX_PAGE_SIZE}'
+            )
+
+        # numpy and scipy are only needed by this query
+        try:
+            from luci import retrieval
+        except ImportError as ex:
+            raise GraphQLError(f'best_responses is not available: {ex}')
+
+        responses = retrieval.best_responses(
+            kwargs['text'],
+            reference=kwargs.get('reference'),
+            k=k
+        )
+        if responses is None:
+            raise GraphQLError('Response index not built, run build_tfidf_index')
+
+        return [
+            ScoredMessageType(score=score, message=message)
+            for score, message in responses
+        ]
 
     custom_config = graphene.Field(
         CustomConfigType,
@@ -191,7 +361,15 @@ class Query:
     )
 
     def resolve_custom_config(self, info, **kwargs):
-        return CustomConfig.objects.get(reference=kwargs['reference'])
+        custom_config = cache.get_or_load(
+            cache.CUSTOM_CONFIG,
+            kwargs['reference'],
+            lambda: CustomConfig.objects.filter(reference=kwargs['reference']).first()
+        )
+        if custom_config is None:
+            raise CustomConfig.DoesNotExist('CustomConfig matching query does not exist.')
+
+        return custom_config
 
     words = graphene.List(
         WordType,
@@ -200,11 +378,44 @@ class Query:
         length__lte=graphene.Int(),
         length__gte=graphene.Int(),
         token__startswith=graphene.String(),
-        token__endswith=graphene.String()
+        token__endswith=graphene.String(),
+        occurrences__gte=graphene.Int(),
+        document_frequency__gte=graphene.Int(),
+        order_by=WordOrder(
+            default_value='id',
+            description='Most frequent words first, unless ordered by id'
+        ),
+        first=graphene.Int(description='Page size'),
+        after=graphene.String(description='Cursor of the last row seen'),
     )
 
     def resolve_words(self, info, **kwargs):
-        return Word.objects.filter(**kwargs)
+        first = kwargs.pop('first', None)
+        after = kwargs.pop('after', None)
+        ordering = WORD_ORDERINGS[kwargs.pop('order_by')]
+        return paginate(Word.objects.filter(**kwargs), ordering, first, after)
+
+    chain_transactions = graphene.List(
+        ChainTransactionType,
+        status=graphene.String(),
+        member_id=graphene.String(),
+        transaction_hash=graphene.String(),
+        first=graphene.Int(description='Page size'),
+        after=graphene.String(description='Cursor of the last row seen'),
+    )
+
+    def resolve_chain_transactions(self, info, **kwargs):
+        first = kwargs.pop('first', None)
+        after = kwargs.pop('after', None)
+        return paginate(ChainTransaction.objects.filter(**kwargs), ('-id',), first, after)
+
+    cache_stats = graphene.Field(
+        CacheStatsType,
+        description='Lookup cache counters of the process serving the request'
+    )
+
+    def resolve_cache_stats(self, info, **kwargs):
+        return CacheStatsType(**cache.get_stats())
 
 
 class EmotionInputs(graphene.InputObjectType):
@@ -232,17 +443,60 @@ class EmotionUpdate(graphene.relay.ClientIDMutation):
         emotion, _ = Emotion.objects.get_or_create(reference=reference)
 
         # updates the emotion with inputed values
-        for key, value in kwargs.items():
-            current = emotion.__getattribute__(key)
+        deltas = increments({field: kwargs.get(field) for field in EMOTION_FIELDS})
+        if deltas:
+            Emotion.objects.filter(id=emotion.id).update(**deltas)
+            emotion.refresh_from_db()
 
-            update = current + value
-
-            emotion.__setattr__(key, update)
-        emotion.save()
+        cache.invalidate(cache.EMOTIONS, [reference])
 
         return EmotionUpdate(emotion)
 
 
+class EmotionDeltaInput(graphene.InputObjectType):
+    reference = graphene.String(required=True)
+    pleasantness = graphene.Float()
+    attention = graphene.Float()
+    sensitivity = graphene.Float()
+    aptitude = graphene.Float()
+
+
+class EmotionUpdateBatch(graphene.relay.ClientIDMutation):
+    """
+    Updates the emotion states of many references in one transaction.
+    Deltas of the same reference are summed.
+    """
+    emotions = graphene.List(EmotionType)
+
+    class Input:
+        updates = graphene.List(EmotionDeltaInput, required=True)
+
+    @transaction.atomic
+    def mutate_and_get_payload(self, info, **kwargs):
+        deltas = {}
+        for update in kwargs['updates']:
+            reference_deltas = deltas.setdefault(update['reference'], {})
+            for field in EMOTION_FIELDS:
+                reference_deltas[field] = reference_deltas.get(field, 0) + (update.get(field) or 0)
+
+        existing = set(
+            Emotion.objects.filter(reference__in=deltas)
+            .values_list('reference', flat=True)
+        )
+        created = [Emotion(reference=reference) for reference in deltas if reference not in existing]
+        for emotion in created:
+            emotion.set_reference_keys()
+        Emotion.objects.bulk_create(created)
+
+        expressions = keyed_increments('reference', deltas)
+        if expressions:
+            Emotion.objects.filter(reference__in=deltas).update(**expressions)
+
+        cache.invalidate(cache.EMOTIONS, deltas)
+
+        return EmotionUpdateBatch(Emotion.objects.filter(reference__in=deltas))
+
+
 class CreateQuote(graphene.relay.ClientIDMutation):
     quote = graphene.Field(QuoteType)
 
@@ -251,6 +505,7 @@ class CreateQuote(graphene.relay.ClientIDMutation):
         author = graphene.String(required=True)
         reference = graphene.String(required=True)
 
+    @transaction.atomic
     def mutate_and_get_payload(self, info, **kwargs):
         quote = Quote.objects.create(
             quote=CompressedString(kwargs['quote']).bit_string,
@@ -258,6 +513,7 @@ class CreateQuote(graphene.relay.ClientIDMutation):
             reference=kwargs['reference']
         )
         quote.save()
+        learn_vocabulary([kwargs['quote']])
 
         return CreateQuote(quote)
 
@@ -289,28 +545,32 @@ class UpdateUser(graphene.relay.ClientIDMutation):
         )
         message = graphene.Argument(MessageInput, required=True)
 
+    @transaction.atomic
     def mutate_and_get_payload(self, info, **kwargs):
         emotion_resume = kwargs.get('emotion_resume')
         friendshipness = kwargs.get('friendshipness', 0)
 
         user, created = User.objects.get_or_create(
-            reference=kwargs['reference']
+            reference=kwargs['reference'],
+            defaults={'name': kwargs['name']}
         )
 
-        user.name = kwargs['name']
-        user.friendshipness += friendshipness
-
         # se o usuário é novo precisamos criar seu relatório emocional
         if created:
             user_emotion = Emotion.objects.create(reference=kwargs['reference'])
             user.emotion_resume = user_emotion
+            user.save(update_fields=['emotion_resume'])
 
-        if emotion_resume:
-            user.emotion_resume.pleasantness += emotion_resume.get('pleasantness', 0)
-            user.emotion_resume.attention += emotion_resume.get('attention', 0)
-            user.emotion_resume.sensitivity += emotion_resume.get('sensitivity', 0)
-            user.emotion_resume.aptitude += emotion_resume.get('aptitude', 0)
-            user.emotion_resume.save()
+        # counters are added by the UPDATE itself, never lost to a concurrent one
+        User.objects.filter(id=user.id).update(
+            name=kwargs['name'],
+            **increments({'friendshipness': friendshipness})
+        )
+
+        if emotion_resume and user.emotion_resume_id:
+            deltas = increments(emotion_resume)
+            if deltas:
+                Emotion.objects.filter(id=user.emotion_resume_id).update(**deltas)
 
         if kwargs.get('message'):
             message = Message.objects.create(
@@ -321,48 +581,182 @@ class UpdateUser(graphene.relay.ClientIDMutation):
                 reference=kwargs['reference']
             )
             message.save()
+            index_message(message, kwargs['message'].get('text'))
+            learn_vocabulary([kwargs['message'].get('text')])
 
-        user.save()
+        user.refresh_from_db()
+        cache.invalidate(cache.USERS, [user.reference])
+        cache.invalidate(cache.EMOTIONS, [user.reference])
 
-        w3 = Web3(Web3.HTTPProvider('https://sepolia.infura.io/v3/c0e36045c28c479eb09b407479b1d493'))
-        contract_address = w3.to_checksum_address(settings.CONTRACT_ADDRESS)
-        contract = w3.eth.contract(address=contract_address, abi=settings.ABI)
-
-        try:
-            key = b64decode(user.reference.encode('utf-8')).decode('utf-8')
-            _, uid = key.split(':')
-            tx_meta = {
-                'from': settings.ACCOUNT_ADDRESS,
-                'nonce': w3.eth.get_transaction_count(settings.ACCOUNT_ADDRESS),
-                'gas': 200000,
-                'gasPrice': w3.to_wei('40', 'gwei')
-            }
-            transaction = contract.functions.update_member_msg_count(int(uid)).build_transaction(tx_meta)
-            signed_txn = w3.eth.account.sign_transaction(transaction, settings.PRIVATE_KEY)
-            transaction_hash = w3.eth.send_raw_transaction(signed_txn.rawTransaction)
-
-            retries = 0
-            while retries < settings.MAX_RETRIES:
-                try:
-                    transaction_receipt = w3.eth.get_transaction_receipt(transaction_hash)
-                    break
-                except:
-                    sleep(1)
-                    retries += 1
-
-            result = contract.functions.update_member_msg_count(int(uid)).call()
-            print("Result: ", result)
-            print('Gas used', transaction_receipt.gasUsed)
-            print('Transaction Hash: ', transaction_receipt.transactionHash)
-        except Exception as ex:
-            print('WEB3 ERROR: ')
-            print(str(ex))
+        # the contract call is sent by the chain worker once this commits
+        chain.enqueue_member_message(user.member_id)
 
         return UpdateUser(user)
 
 
+class MessageRecordInput(graphene.InputObjectType):
+    reference = graphene.String(description='user reference', required=True)
+    name = graphene.String(description='User name', required=True)
+    friendshipness = graphene.Float(description='User affection level')
+    emotion_resume = graphene.Argument(EmotionInputs, description='User emotional data')
+    message = graphene.Argument(MessageInput, required=True)
+
+
+class IngestMessages(graphene.relay.ClientIDMutation):
+    """
+    Stores many chat messages at once, with the same effects as one
+    update_user call per record, in a single transaction.
+    Records of messages already stored for the same reference are skipped,
+    with their user and emotion deltas.
+    """
+    messages_created = graphene.Int()
+    users = graphene.List(UserType)
+
+    class Input:
+        records = graphene.List(MessageRecordInput, required=True)
+
+    @transaction.atomic
+    def mutate_and_get_payload(self, info, **kwargs):
+        records = kwargs['records']
+        references = list(dict.fromkeys(record['reference'] for record in records))
+
+        users = IngestMessages.get_users(references)
+        missing = [reference for reference in references if reference not in users]
+        if missing:
+            IngestMessages.create_users(missing, records)
+            users = IngestMessages.get_users(references)
+
+        created = IngestMessages.create_messages(records, users)
+        texts = [(message, record['message']['text']) for message, record in created]
+        index_messages(texts)
+        learn_vocabulary([text for _, text in texts])
+
+        # aggregate the deltas of each user, only for the messages inserted,
+        # as update_user fails without any effect on a stored message
+        names = {}
+        friendshipness = {}
+        emotions = {}
+        for _, record in created:
+            user = users[record['reference']]
+            names[user.id] = record['name']
+            friendshipness.setdefault(user.id, {'friendshipness': 0})
+            friendshipness[user.id]['friendshipness'] += record.get('friendshipness') or 0
+
+            if record.get('emotion_resume') and user.emotion_resume_id:
+                deltas = emotions.setdefault(user.emotion_resume_id, {})
+                for field in EMOTION_FIELDS:
+                    deltas[field] = deltas.get(field, 0) + (record['emotion_resume'].get(field) or 0)
+
+        if names:
+            User.objects.filter(id__in=names).update(
+                name=Case(
+                    *[When(id=user_id, then=Value(name)) for user_id, name in names.items()],
+                    default=F('name'),
+                    output_field=CharField()
+                ),
+                **keyed_increments('id', friendshipness)
+            )
+        emotion_deltas = keyed_increments('id', emotions)
+        if emotion_deltas:
+            Emotion.objects.filter(id__in=emotions).update(**emotion_deltas)
+
+        member_counts = Counter(message.member_id for message, _ in created)
+        chain.enqueue_member_messages(member_counts)
+
+        cache.invalidate(cache.USERS, references)
+        cache.invalidate(cache.EMOTIONS, references)
+
+        return IngestMessages(
+            messages_created=len(created),
+            users=User.objects.filter(reference__in=references)
+        )
+
+    @staticmethod
+    def get_users(references):
+        users = {}
+        for user in User.objects.filter(reference__in=references):
+            users[user.reference] = user
+        return users
+
+    @staticmethod
+    def create_users(references, records):
+        """
+        Create users and their emotional data in bulk.
+        Bulk inserts do not return ids on every database, so the new
+        emotions are read back as the latest ones of each reference.
+        """
+        new_emotions = [Emotion(reference=reference) for reference in references]
+        for emotion in new_emotions:
+            emotion.set_reference_keys()
+        Emotion.objects.bulk_create(new_emotions)
+
+        emotions = dict(
+            Emotion.objects.filter(reference__in=references)
+            .order_by('id')
+            .values_list('reference', 'id')
+        )
+        names = {record['reference']: record['name'] for record in records}
+        new_users = [
+            User(reference=reference, name=names[reference], emotion_resume_id=emotions[reference])
+            for reference in references
+        ]
+        for user in new_users:
+            user.set_reference_keys()
+        # a concurrent request may have created some of them meanwhile
+        User.objects.bulk_create(new_users, ignore_conflicts=True)
+
+    @staticmethod
+    def create_messages(records, users):
+        """
+        Insert the messages not stored yet.
+        Returns the created messages, paired with their record.
+        """
+        new_messages = {}
+        for record in records:
+            message = Message(
+                global_intention=record['message'].get('global_intention', ''),
+                specific_intention=record['message'].get('specific_intention', ''),
+                text=CompressedString(record['message']['text']).bit_string,
+                user=users[record['reference']],
+                reference=record['reference']
+            )
+            message.set_reference_keys()
+            new_messages.setdefault((message.reference, message.text), (message, record))
+
+        references = {reference for reference, _ in new_messages}
+        blobs = {blob for _, blob in new_messages}
+        stored = set(
+            (reference, bytes(blob)) for reference, blob in
+            Message.objects.filter(reference__in=references, text__in=blobs)
+            .values_list('reference', 'text')
+        )
+        for key in stored:
+            new_messages.pop(key, None)
+
+        Message.objects.bulk_create(
+            [message for message, _ in new_messages.values()],
+            ignore_conflicts=True
+        )
+
+        created = []
+        for message in Message.objects.filter(reference__in=references, text__in=blobs):
+            key = (message.reference, bytes(message.text))
+            if key in new_messages:
+                created.append((message, new_messages[key][1]))
+
+        return created
+
+
 class AssignResponse(graphene.relay.ClientIDMutation):
-    messages = graphene.List(MessageType).Field()
+    """
+    Stores a response and links it to every message containing all the
+    words of a text. The ids of the matched messages are found once through
+    the token index, and give the links, inserted by INSERT ... SELECT
+    statements skipping the ones already stored, the count and the page
+    of matched messages returned.
+    """
+    messages_count = graphene.Int()
+    messages = graphene.List(MessageType)
 
     class Input:
         text = graphene.String(required=True)
@@ -370,22 +764,56 @@ class AssignResponse(graphene.relay.ClientIDMutation):
             MessageInput,    
             required=True
         )
+        reference = graphene.String(description='Only match messages with this reference')
+        first = graphene.Int(description='Number of matched messages returned')
 
+    @transaction.atomic
     def mutate_and_get_payload(self, info, **kwargs):
-        messages = Message.objects.filter(text__icontains=kwargs['text'])
+        page_size = get_page_size(kwargs.get('first'))
+        messages = filter_by_words(Message.objects.all(), kwargs['text'])
+        if kwargs.get('reference') is not None:
+            messages = messages.filter(reference=kwargs['reference'])
+        ids = list(messages.order_by('id').values_list('id', flat=True))
 
         response = Message.objects.create(
             global_intention=kwargs['response'].get('global_intention', ''),
             specific_intention=kwargs['response'].get('specific_intention', ''),
             text=CompressedString(kwargs['response']['text']).bit_string,
         )
-        response.save()
+        index_message(response, kwargs['response']['text'])
+        learn_vocabulary([kwargs['response']['text']])
 
-        for message in messages:
-            message.possible_responses.add(response)
-            message.save()
+        AssignResponse.link_response(ids, response)
+
+        return AssignResponse(
+            messages_count=len(ids),
+            messages=Message.objects.filter(id__in=ids[:page_size]).order_by('id')
+        )
 
-        return AssignResponse(messages)
+    @staticmethod
+    def link_response(ids, response):
+        """
+        Link the response to the messages of the given ids, in both
+        directions since possible_responses is symmetrical.
+        """
+        through = Message.possible_responses.through
+        table = connection.ops.quote_name(through._meta.db_table)
+        from_column = connection.ops.quote_name(through._meta.get_field('from_message').column)
+        to_column = connection.ops.quote_name(through._meta.get_field('to_message').column)
+        insert = connection.ops.insert_statement(ignore_conflicts=True)
+        suffix = connection.ops.ignore_conflicts_suffix_sql(ignore_conflicts=True)
+
+        chunk_size = settings.ASSIGN_RESPONSE_CHUNK_SIZE
+        with connection.cursor() as cursor:
+            for start in range(0, len(ids), chunk_size):
+                matched = Message.objects.filter(id__in=ids[start:start + chunk_size]).values('id')
+                select_sql, select_params = matched.query.sql_with_params()
+                for columns in ((from_column, to_column), (to_column, from_column)):
+                    cursor.execute(
+                        f'{insert} {table} ({columns[0]}, {columns[1]}) '
+                        f'SELECT matched.id, %s FROM ({select_sql}) matched{suffix}',
+                        (response.id, *select_params)
+                    )
 
 
 class UpdateCustomConfig(graphene.relay.ClientIDMutation):
@@ -419,12 +847,15 @@ class UpdateCustomConfig(graphene.relay.ClientIDMutation):
             custom_config.filter_offensive_messages = filter_offensive_messages
 
         custom_config.save()
+        cache.invalidate(cache.CUSTOM_CONFIG, [kwargs['reference']])
         return UpdateCustomConfig(custom_config)
 
 
 class Mutation:
     emotion_update = EmotionUpdate.Field()
+    emotion_update_batch = EmotionUpdateBatch.Field()
     create_quote = CreateQuote.Field()
     update_user = UpdateUser.Field()
+    ingest_messages = IngestMessages.Field()
     assign_response = AssignResponse.Field()
     update_custom_config = UpdateCustomConfig.Field()
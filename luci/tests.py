@@ -1,3 +1,1549 @@
-from django.test import TestCase
+import gzip
+import json
+import os
+from base64 import b64encode, urlsafe_b64encode
+from importlib import import_module
+from importlib.util import find_spec
+from io import StringIO
+import tempfile
+import threading
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from unittest import mock, skipUnless
+import rlp
+from django.conf import settings
+from django.core.management import CommandError, call_command
+from django.db import connection, connections
+from django.db.migrations.loader import MigrationLoader
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from eth_account import Account
+from eth_utils import keccak
+from graphql import parse
+from jion.schema import schema
+from luci.util import CompressedString, flush_vocabulary, index_message, learn_vocabulary
+from luci import cache, chain, checks, clients, compression, limits, receipts, routers, views
+from luci.models import (
+    ArchivedMessage, ArchivedResponseLink, ChainTransaction, ChainWorker, CompressionDictionary, Emotion,
+    Message, MessageToken, NonceCursor, ProcessingCheckpoint, Quote, User, Word, WordCountDelta
+)
 
-# Create your tests here.
+ACCOUNT = Account.from_key('0x4c0883a69102937d6231471b5dbb6204fe5129617082792ae468d01a3f362318')
+ZERO_HASH = '0x' + '00' * 32
+ZERO_ADDRESS = '0x' + '00' * 20
+
+
+def store_message(text, reference='ref', index=True, **fields):
+    message = Message.objects.create(
+        text=CompressedString(text).bit_string,
+        reference=reference,
+        **fields
+    )
+    if index:
+        index_message(message, text)
+    return message
+
+
+class GraphQLTestCase(TestCase):
+    def execute(self, document, variables=None):
+        response = self.client.post(
+            '/graphql/',
+            json.dumps({'query': document, 'variables': variables or {}}),
+            content_type='application/json'
+        )
+        return response.json()
+
+
+class FakeNode:
+    """
+    JSON-RPC stand-in of an Ethereum node, with a transaction pool mining
+    the transactions of each sender in nonce order, as long as no nonce
+    is missing.
+
+    `faults` are consumed by the next eth_sendRawTransaction calls:
+    'accepted_error' accepts the transaction but answers with an internal
+    error, 'dropped' answers its hash without keeping it, and a dict is
+    answered as the error without accepting it.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.mined_nonces = {}
+        self.pool = {}
+        self.mined = {}
+        self.reverted = set()
+        self.faults = []
+        self.batch_response = None
+
+    def pending_nonce(self, sender):
+        nonce = self.mined_nonces.get(sender, 0)
+        while (sender, nonce) in self.pool:
+            nonce += 1
+        return nonce
+
+    def mine(self):
+        """
+        Mine the pool transactions following the last mined nonce.
+        """
+        with self.lock:
+            for sender in {sender for sender, _ in self.pool}:
+                nonce = self.mined_nonces.get(sender, 0)
+                while (sender, nonce) in self.pool:
+                    transaction_hash, _ = self.pool.pop((sender, nonce))
+                    self.mined[transaction_hash] = (sender, nonce)
+                    nonce += 1
+                self.mined_nonces[sender] = nonce
+
+    def find(self, transaction_hash):
+        if transaction_hash in self.mined:
+            return self.mined[transaction_hash], True
+        for key, (pool_hash, _) in self.pool.items():
+            if pool_hash == transaction_hash:
+                return key, False
+        return None, False
+
+    def send_raw_transaction(self, raw_transaction):
+        data = bytes.fromhex(raw_transaction[2:])
+        fields = rlp.decode(data)
+        nonce = int.from_bytes(fields[0], 'big')
+        gas_price = int.from_bytes(fields[1], 'big')
+        sender = Account.recover_transaction(data)
+        transaction_hash = '0x' + keccak(data).hex()
+
+        fault = self.faults.pop(0) if self.faults else None
+        if fault == 'dropped':
+            return {'result': transaction_hash}
+        if isinstance(fault, dict):
+            return {'error': fault}
+
+        if self.find(transaction_hash)[0] is not None:
+            return {'error': {'code': -32000, 'message': 'already known'}}
+        if nonce < self.mined_nonces.get(sender, 0):
+            return {'error': {'code': -32000, 'message': 'nonce too low'}}
+        current = self.pool.get((sender, nonce))
+        if current is not None and gas_price < current[1] * 1.1:
+            return {'error': {'code': -32000, 'message': 'replacement transaction underpriced'}}
+
+        self.pool[(sender, nonce)] = (transaction_hash, gas_price)
+        if fault == 'accepted_error':
+            return {'error': {'code': -32603, 'message': 'internal error'}}
+        return {'result': transaction_hash}
+
+    def get_receipt(self, transaction_hash):
+        key, mined = self.find(transaction_hash)
+        if not mined:
+            return None
+        sender, _ = key
+        return {
+            'transactionHash': transaction_hash,
+            'status': '0x0' if transaction_hash in self.reverted else '0x1',
+            'gasUsed': hex(21000),
+            'cumulativeGasUsed': hex(21000),
+            'blockNumber': '0x10',
+            'blockHash': ZERO_HASH,
+            'transactionIndex': '0x0',
+            'from': sender,
+            'to': ZERO_ADDRESS,
+            'contractAddress': None,
+            'logs': [],
+            'logsBloom': '0x' + '00' * 256,
+            'effectiveGasPrice': '0x1',
+            'type': '0x0',
+        }
+
+    def get_transaction(self, transaction_hash):
+        key, mined = self.find(transaction_hash)
+        if key is None:
+            return None
+        sender, nonce = key
+        return {
+            'hash': transaction_hash,
+            'nonce': hex(nonce),
+            'from': sender,
+            'to': ZERO_ADDRESS,
+            'blockHash': ZERO_HASH if mined else None,
+            'blockNumber': '0x10' if mined else None,
+            'transactionIndex': '0x0' if mined else None,
+            'value': '0x0',
+            'gas': hex(21000),
+            'gasPrice': '0x1',
+            'input': '0x',
+            'v': '0x25',
+            'r': ZERO_HASH,
+            's': ZERO_HASH,
+            'type': '0x0',
+        }
+
+    def handle(self, request):
+        method = request['method']
+        params = request.get('params', [])
+        response = {'jsonrpc': '2.0', 'id': request.get('id')}
+        with self.lock:
+            if method == 'eth_chainId':
+                response['result'] = '0x1'
+            elif method == 'eth_getTransactionCount':
+                response['result'] = hex(self.pending_nonce(params[0]))
+            elif method == 'eth_sendRawTransaction':
+                response.update(self.send_raw_transaction(params[0]))
+            elif method == 'eth_getTransactionReceipt':
+                response['result'] = self.get_receipt(params[0])
+            elif method == 'eth_getTransactionByHash':
+                response['result'] = self.get_transaction(params[0])
+            else:
+                response['error'] = {'code': -32601, 'message': f'Method {method} not found'}
+        return response
+
+    def start(self):
+        node = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                if not isinstance(request, list):
+                    response = node.handle(request)
+                elif node.batch_response is not None:
+                    response = node.batch_response
+                else:
+                    response = [node.handle(item) for item in request]
+
+                body = json.dumps(response).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        class Server(ThreadingMixIn, HTTPServer):
+            daemon_threads = True
+
+        self.server = Server(('127.0.0.1', 0), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return f'http://127.0.0.1:{self.server.server_address[1]}'
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class ChainTestCase(TestCase):
+    """
+    Runs against a FakeNode as the web3 provider, signing with ACCOUNT.
+    """
+    def setUp(self):
+        self.node = FakeNode()
+        url = self.node.start()
+        self.addCleanup(self.node.stop)
+
+        overrides = override_settings(
+            WEB3_PROVIDER_URL=url,
+            ACCOUNT_ADDRESS=ACCOUNT.address,
+            PRIVATE_KEY=ACCOUNT.key.hex(),
+            CONTRACT_ADDRESS='0x' + '11' * 20,
+            WEB3_AGGREGATE_COUNTS=False,
+            WEB3_OUTBOX_BACKOFF_BASE=0,
+            WEB3_OUTBOX_MAX_ATTEMPTS=3,
+        )
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+
+        clients.reset()
+        self.addCleanup(clients.reset)
+        self.w3 = clients.get_web3()
+        self.contract = clients.get_contract()
+        self.worker = chain.register_worker()
+
+    def enqueue(self, count=1):
+        return [chain.enqueue_member_message(str(member_id)) for member_id in range(1, count + 1)]
+
+    def send_pending(self):
+        return chain.send_pending(self.w3, self.contract, self.worker)
+
+    def statuses(self):
+        return list(ChainTransaction.objects.order_by('id').values_list('status', flat=True))
+
+    def expire(self, *fields):
+        """
+        Move the given datetime fields of all the rows of the outbox to an
+        hour ago.
+        """
+        an_hour_ago = timezone.now() - timedelta(hours=1)
+        ChainTransaction.objects.update(**{field: an_hour_ago for field in fields})
+
+
+class OutboxTests(ChainTestCase):
+    def test_entries_are_sent_and_confirmed(self):
+        self.enqueue(3)
+
+        self.assertEqual(self.send_pending(), 3)
+        entries = list(ChainTransaction.objects.order_by('id'))
+        self.assertEqual([entry.status for entry in entries], [ChainTransaction.SENT] * 3)
+        self.assertEqual([entry.nonce for entry in entries], [0, 1, 2])
+        self.assertEqual(len({entry.transaction_hash for entry in entries}), 3)
+
+        self.node.mine()
+        self.assertEqual(receipts.reconcile(), 3)
+        entry = ChainTransaction.objects.first()
+        self.assertEqual(entry.status, ChainTransaction.CONFIRMED)
+        self.assertEqual(entry.block_number, 16)
+        self.assertEqual(entry.gas_used, 21000)
+
+    def test_reverted_transaction_fails(self):
+        entry, = self.enqueue()
+        self.send_pending()
+        entry.refresh_from_db()
+        self.node.reverted.add(entry.transaction_hash)
+        self.node.mine()
+
+        receipts.reconcile()
+        entry.refresh_from_db()
+        self.assertEqual(entry.status, ChainTransaction.FAILED)
+        self.assertEqual(entry.receipt_status, 0)
+
+    def test_rejected_entry_is_retried_with_its_transaction(self):
+        entry, = self.enqueue()
+        self.node.faults = [{'code': -32000, 'message': 'insufficient funds for gas * price + value'}]
+
+        self.assertEqual(self.send_pending(), 0)
+        entry.refresh_from_db()
+        self.assertEqual(entry.status, ChainTransaction.PENDING)
+        self.assertEqual(entry.attempts, 1)
+        self.assertEqual(entry.nonce, 0)
+        transaction_hash = entry.transaction_hash
+
+        self.assertEqual(self.send_pending(), 1)
+        entry.refresh_from_db()
+        self.assertEqual(entry.status, ChainTransaction.SENT)
+        self.assertEqual(entry.nonce, 0)
+        self.assertEqual(entry.transaction_hash, transaction_hash)
+
+    def test_entry_fails_after_max_attempts(self):
+        entry, = self.enqueue()
+        self.node.faults = [{'code': -32000, 'message': 'insufficient funds'}] * 3
+
+        for _ in range(3):
+            self.send_pending()
+
+        entry.refresh_from_db()
+        self.assertEqual(entry.status, ChainTransaction.FAILED)
+        self.assertEqual(entry.attempts, 3)
+        self.assertEqual(self.send_pending(), 0)
+
+    def test_unknown_outcome_is_not_sent_twice(self):
+        entry, = self.enqueue()
+        self.node.faults = ['accepted_error']
+
+        self.send_pending()
+        entry.refresh_from_db()
+        self.assertEqual(entry.status, ChainTransaction.PENDING)
+
+        # the node answers that it already has the transaction
+        self.assertEqual(self.send_pending(), 1)
+        self.assertEqual(len(self.node.pool), 1)
+        self.assertEqual(NonceCursor.objects.get().next_nonce, 1)
+
+    def test_mined_outcome_is_recognized(self):
+        entry, = self.enqueue()
+        self.node.faults = ['accepted_error']
+        self.send_pending()
+        self.node.mine()
+
+        # the node answers nonce too low, for the entry's own transaction
+        self.assertEqual(self.send_pending(), 1)
+        entry.refresh_from_db()
+        self.assertEqual(entry.nonce, 0)
+
+    def test_claimed_entry_is_skipped(self):
+        entry, = self.enqueue()
+        self.assertTrue(chain.claim(entry, 'other'))
+
+        self.assertEqual(self.send_pending(), 0)
+        self.assertEqual(self.statuses(), [ChainTransaction.SENDING])
+
+
+class NonceTests(ChainTestCase):
+    def sign_external(self, nonce):
+        transaction = ACCOUNT.sign_transaction({
+            'to': ZERO_ADDRESS,
+            'value': 0,
+            'nonce': nonce,
+            'gas': 21000,
+            'gasPrice': 1,
+            'chainId': 1,
+        })
+        return transaction.rawTransaction.hex()
+
+    def test_nonces_start_at_the_pending_nonce(self):
+        self.node.mined_nonces[ACCOUNT.address] = 5
+
+        self.assertEqual(chain.allocate_nonce(self.w3, ACCOUNT.address), 5)
+        self.assertEqual(chain.allocate_nonce(self.w3, ACCOUNT.address), 6)
+        self.assertEqual(NonceCursor.objects.get().next_nonce, 7)
+
+    def test_sync_after_allocation_keeps_the_nonce(self):
+        allocate_nonce = chain.allocate_nonce
+
+        def allocate_then_sync(*args, **kwargs):
+            # another worker syncing as soon as the cursor lock is released
+            nonce = allocate_nonce(*args, **kwargs)
+            chain.sync_nonce(self.w3, ACCOUNT.address)
+            return nonce
+
+        entry, = self.enqueue()
+        with mock.patch.object(chain, 'allocate_nonce', allocate_then_sync):
+            self.assertEqual(self.send_pending(), 1)
+
+        entry.refresh_from_db()
+        self.assertEqual(entry.nonce, 0)
+        self.assertEqual(NonceCursor.objects.get().next_nonce, 1)
+
+    def test_failed_entry_keeps_its_nonce(self):
+        self.node.faults = [{'code': -32000, 'message': 'insufficient funds'}] * 3
+        self.enqueue()
+        for _ in range(3):
+            self.send_pending()
+
+        self.enqueue()
+        self.send_pending()
+        self.assertEqual(
+            list(ChainTransaction.objects.order_by('id').values_list('nonce', flat=True)),
+            [0, 1]
+        )
+
+    def test_nonce_used_elsewhere_is_replaced(self):
+        self.node.send_raw_transaction(self.sign_external(0))
+        self.node.mine()
+        chain.allocate_nonce(self.w3, ACCOUNT.address)
+        NonceCursor.objects.update(next_nonce=0)
+        entry, = self.enqueue()
+
+        self.assertEqual(self.send_pending(), 0)
+        entry.refresh_from_db()
+        self.assertIsNone(entry.nonce)
+        self.assertIsNone(entry.raw_transaction)
+        self.assertEqual(NonceCursor.objects.get().next_nonce, 1)
+
+        self.assertEqual(self.send_pending(), 1)
+        entry.refresh_from_db()
+        self.assertEqual(entry.nonce, 1)
+
+    def test_stalled_nonce_is_resent(self):
+        self.enqueue(2)
+        self.node.faults = ['dropped']
+        self.send_pending()
+        self.assertEqual(self.node.pending_nonce(ACCOUNT.address), 0)
+
+        self.assertIsNone(chain.check_nonce(self.w3, ACCOUNT.address))
+        NonceCursor.objects.update(chain_nonce_changed_at=timezone.now() - timedelta(hours=1))
+        self.assertEqual(chain.check_nonce(self.w3, ACCOUNT.address), 0)
+        self.assertEqual(self.node.pending_nonce(ACCOUNT.address), 2)
+
+    def test_stalled_nonce_of_failed_entry_is_filled(self):
+        first, _ = self.enqueue(2)
+        self.node.faults = ['dropped']
+        self.send_pending()
+        ChainTransaction.objects.filter(id=first.id).update(status=ChainTransaction.FAILED)
+
+        chain.check_nonce(self.w3, ACCOUNT.address)
+        NonceCursor.objects.update(chain_nonce_changed_at=timezone.now() - timedelta(hours=1))
+        self.assertEqual(chain.check_nonce(self.w3, ACCOUNT.address), 0)
+        self.assertEqual(self.node.pending_nonce(ACCOUNT.address), 2)
+
+    def test_cursor_moves_back_when_no_entry_holds_later_nonces(self):
+        self.enqueue()
+        self.send_pending()
+        self.node.mine()
+        NonceCursor.objects.update(next_nonce=5)
+
+        chain.check_nonce(self.w3, ACCOUNT.address)
+        self.assertEqual(NonceCursor.objects.get().next_nonce, 1)
+
+    def test_send_errors_are_classified(self):
+        cases = [
+            (ValueError({'code': -32000, 'message': 'already known'}), chain.SEND_KNOWN),
+            (ValueError({'code': -32000, 'message': 'nonce too low'}), chain.SEND_NONCE_USED),
+            (ValueError({'code': -32000, 'message': 'insufficient funds'}), chain.SEND_REJECTED),
+            (ValueError({'code': -32602, 'message': 'invalid argument'}), chain.SEND_REJECTED),
+            (ValueError({'code': -32603, 'message': 'nonce too low'}), chain.SEND_UNKNOWN),
+            (ValueError('nonce too low'), chain.SEND_UNKNOWN),
+            (TimeoutError(), chain.SEND_UNKNOWN),
+        ]
+        for ex, outcome in cases:
+            with self.subTest(ex=ex):
+                self.assertEqual(chain.classify_send_error(ex), outcome)
+
+
+class StaleEntryTests(ChainTestCase):
+    def setUp(self):
+        super().setUp()
+        self.dead_worker = chain.register_worker()
+        ChainWorker.objects.filter(name=self.dead_worker).update(
+            heartbeat_at=timezone.now() - timedelta(hours=1)
+        )
+
+    def test_entries_of_dead_workers_are_reclaimed(self):
+        broadcast, signed = self.enqueue(2)
+        chain.claim(broadcast, self.dead_worker)
+        chain.send_transaction(broadcast, self.w3, self.contract)
+        ChainTransaction.objects.filter(id=broadcast.id).update(status=ChainTransaction.SENDING)
+        chain.claim(signed, self.dead_worker)
+        signed.nonce = 1
+        signed.raw_transaction = chain.sign_transaction(signed, self.w3, self.contract).rawTransaction.hex()
+        signed.save()
+        self.expire('claimed_at')
+
+        self.assertEqual(chain.release_stale_entries(self.w3), 2)
+        self.assertEqual(self.statuses(), [ChainTransaction.SENT, ChainTransaction.PENDING])
+        self.assertFalse(ChainWorker.objects.filter(name=self.dead_worker).exists())
+
+        self.send_pending()
+        signed.refresh_from_db()
+        self.assertEqual(signed.status, ChainTransaction.SENT)
+        self.assertEqual(signed.nonce, 1)
+
+    def test_entries_of_live_workers_are_kept(self):
+        entry, = self.enqueue()
+        chain.claim(entry, self.worker)
+        self.expire('claimed_at')
+
+        self.assertEqual(chain.release_stale_entries(self.w3), 0)
+        self.assertEqual(self.statuses(), [ChainTransaction.SENDING])
+
+    def test_recent_claims_are_kept(self):
+        entry, = self.enqueue()
+        chain.claim(entry, self.dead_worker)
+
+        self.assertEqual(chain.release_stale_entries(self.w3), 0)
+        self.assertEqual(self.statuses(), [ChainTransaction.SENDING])
+
+
+class ReceiptTests(ChainTestCase):
+    def test_rows_are_checked_in_turns(self):
+        self.enqueue(3)
+        self.send_pending()
+
+        receipts.reconcile(batch_size=2)
+        receipts.reconcile(batch_size=2)
+        self.assertFalse(ChainTransaction.objects.filter(last_checked_at__isnull=True).exists())
+
+    def test_dropped_transaction_is_resent(self):
+        entry, = self.enqueue()
+        self.node.faults = ['dropped']
+        self.send_pending()
+
+        receipts.reconcile()
+        self.assertEqual(self.statuses(), [ChainTransaction.SENT])
+
+        self.expire('sent_at')
+        receipts.reconcile()
+        self.assertEqual(self.statuses(), [ChainTransaction.PENDING])
+
+        transaction_hash = ChainTransaction.objects.get().transaction_hash
+        self.assertEqual(self.send_pending(), 1)
+        self.node.mine()
+        self.assertEqual(receipts.reconcile(), 1)
+        entry.refresh_from_db()
+        self.assertEqual(entry.status, ChainTransaction.CONFIRMED)
+        self.assertEqual(entry.transaction_hash, transaction_hash)
+
+    def test_batch_error_is_raised(self):
+        self.enqueue()
+        self.send_pending()
+        self.node.batch_response = {'jsonrpc': '2.0', 'id': None, 'error': {'code': -32600, 'message': 'batch too large'}}
+
+        with self.assertRaises(receipts.BatchError):
+            receipts.reconcile()
+
+    def test_unexpected_batch_items_are_ignored(self):
+        self.enqueue()
+        self.send_pending()
+        self.node.batch_response = [{'id': 'x', 'result': {}}, 'junk', {'id': 7, 'result': {}}]
+
+        self.assertEqual(receipts.reconcile(), 0)
+        self.assertEqual(self.statuses(), [ChainTransaction.SENT])
+
+
+class ReplicaRouterTests(TestCase):
+    """
+    Uses a second SQLite database as the replica, holding a word the
+    primary does not have.
+    """
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.add_database('replica', os.path.join(directory.name, 'replica.sqlite3'))
+        with connections['replica'].schema_editor() as editor:
+            editor.create_model(Word)
+        Word.objects.using('replica').create(token='replicated', length=10)
+
+        overrides = override_settings(DATABASE_REPLICAS=['replica'])
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+
+        routers._health.clear()
+        self.addCleanup(routers._health.clear)
+        routers.reset()
+        self.addCleanup(routers.reset)
+
+    def add_database(self, alias, name):
+        connections.databases[alias] = {'ENGINE': 'django.db.backends.sqlite3', 'NAME': name}
+
+        def remove():
+            connections[alias].close()
+            del connections[alias]
+            del connections.databases[alias]
+
+        self.addCleanup(remove)
+
+    def is_replica_read(self):
+        return Word.objects.filter(token='replicated').exists()
+
+    def test_reads_use_the_primary_by_default(self):
+        self.assertFalse(self.is_replica_read())
+
+    def test_allowed_reads_use_the_replica(self):
+        routers.allow_replica_reads()
+        self.assertTrue(self.is_replica_read())
+
+    def test_writes_use_the_primary(self):
+        routers.allow_replica_reads()
+        Word.objects.create(token='written', length=7)
+
+        self.assertTrue(Word.objects.using('default').filter(token='written').exists())
+        self.assertFalse(Word.objects.using('replica').filter(token='written').exists())
+
+    def test_pinned_reads_use_the_primary(self):
+        routers.allow_replica_reads()
+        routers.pin_primary()
+        self.assertFalse(self.is_replica_read())
+
+    def test_primary_reads_block(self):
+        routers.allow_replica_reads()
+        with routers.primary_reads():
+            self.assertFalse(self.is_replica_read())
+        self.assertTrue(self.is_replica_read())
+
+    def test_unhealthy_replica_is_skipped(self):
+        self.add_database('broken', '/nonexistent/replica.sqlite3')
+        routers.allow_replica_reads()
+
+        with self.settings(DATABASE_REPLICAS=['broken']):
+            self.assertFalse(self.is_replica_read())
+            self.assertFalse(routers.is_healthy('broken'))
+
+    def test_graphql_queries_use_the_replica(self):
+        response = self.client.post(
+            '/graphql/',
+            json.dumps({'query': '{ words(token__startswith: "repl") { token } }'}),
+            content_type='application/json'
+        )
+
+        self.assertEqual(response.json()['data']['words'], [{'token': 'replicated'}])
+        self.assertFalse(routers.replica_reads_allowed())
+
+
+class MessageWordTests(GraphQLTestCase):
+    def setUp(self):
+        self.greeting = store_message('Hello there, big World!')
+        self.question = store_message('is the world round?')
+        self.other = store_message('nothing to see')
+
+    def texts(self, result, field='messages'):
+        return [message['text'] for message in result['data'][field]]
+
+    def test_index_command_inserts_once_per_chunk(self):
+        MessageToken.objects.all().delete()
+
+        with CaptureQueriesContext(connection) as queries:
+            call_command('index_messages', chunk_size=2, stdout=StringIO())
+
+        inserts = [query for query in queries if query['sql'].startswith('INSERT')]
+        self.assertEqual(len(inserts), 2)
+        self.assertEqual(
+            set(MessageToken.objects.filter(message=self.greeting).values_list('token', flat=True)),
+            {'hello', 'there', 'big', 'world'}
+        )
+
+    def test_messages_containing_words(self):
+        result = self.execute('{ messages(text__icontains: "WORLD hello") { text } }')
+        self.assertEqual(self.texts(result), ['Hello there, big World!'])
+
+        result = self.execute('{ messages(text__contains: "world") { text } }')
+        self.assertEqual(len(self.texts(result)), 2)
+
+    def test_messages_not_containing_words(self):
+        result = self.execute('{ messages(text__not_contains: ["world", "see"]) { text } }')
+        self.assertEqual(self.texts(result), [])
+
+        result = self.execute('{ messages(text__not_contains: ["round world"]) { text } }')
+        self.assertEqual(len(self.texts(result)), 2)
+
+    def test_text_without_words_matches_nothing(self):
+        result = self.execute('{ messages(text__icontains: "?!") { text } }')
+        self.assertEqual(self.texts(result), [])
+
+    def test_assign_response_links_messages_with_the_words(self):
+        result = self.execute('''
+            mutation {
+                assign_response(input: {
+                    text: "world",
+                    response: {global_intention: "", specific_intention: "", text: "it is"}
+                }) { messages_count messages { text } }
+            }
+        ''')
+
+        payload = result['data']['assign_response']
+        self.assertEqual(payload['messages_count'], 2)
+        self.assertEqual(
+            set(self.question.possible_responses.values_list('id', flat=True)),
+            set(Message.objects.filter(reference='').values_list('id', flat=True))
+        )
+        self.assertFalse(self.other.possible_responses.exists())
+
+    @override_settings(ASSIGN_RESPONSE_CHUNK_SIZE=1)
+    def test_assign_response_matches_once(self):
+        with CaptureQueriesContext(connection) as queries:
+            result = self.execute('''
+                mutation {
+                    assign_response(input: {
+                        text: "world",
+                        response: {global_intention: "", specific_intention: "", text: "yes"},
+                        first: 1
+                    }) { messages_count messages { text } }
+                }
+            ''')
+
+        payload = result['data']['assign_response']
+        self.assertEqual(payload['messages_count'], 2)
+        self.assertEqual(len(payload['messages']), 1)
+        token_queries = [
+            query for query in queries
+            if query['sql'].startswith('SELECT') and 'luci_messagetoken' in query['sql']
+        ]
+        self.assertEqual(len(token_queries), 1)
+        self.assertEqual(self.greeting.possible_responses.count(), 1)
+        self.assertEqual(self.question.possible_responses.count(), 1)
+
+
+class CompressionTests(GraphQLTestCase):
+    TEXT = 'the quick brown fox jumps over the lazy dog, ' * 8
+
+    def setUp(self):
+        compression.reset_dictionary_cache()
+        self.addCleanup(compression.reset_dictionary_cache)
+
+    def test_codecs_round_trip(self):
+        for codec in compression.CODECS:
+            encoded = compression.encode(self.TEXT, codec)
+            self.assertEqual(compression.decode(encoded), self.TEXT, codec)
+            if codec != compression.PLAIN:
+                self.assertTrue(encoded.startswith(compression.MAGIC), codec)
+                self.assertLess(len(encoded), len(self.TEXT), codec)
+
+    def test_zdict_round_trip(self):
+        data = compression.train_dictionary([self.TEXT, self.TEXT])
+        dictionary = CompressionDictionary.objects.create(data=data, sample_size=2)
+        encoded = compression.encode(self.TEXT, compression.ZDICT)
+        self.assertEqual(encoded[2], compression.CODEC_IDS[compression.ZDICT])
+        self.assertEqual(int.from_bytes(encoded[3:5], 'big'), dictionary.id)
+
+        # a fresh process loads the dictionary back from the database
+        compression.reset_dictionary_cache()
+        self.assertEqual(compression.decode(encoded), self.TEXT)
+
+    def test_plain_rows_decode_as_they_are(self):
+        self.assertEqual(compression.decode(self.TEXT.encode('utf-8')), self.TEXT)
+        self.assertEqual(compression.encode('hi', compression.LZMA), b'hi')
+
+    @override_settings(TEXT_CODEC='zlib')
+    def test_compressing_codecs_pass_the_checks(self):
+        self.assertEqual(checks.check_text_codec(None), [])
+        with self.settings(TEXT_CODEC='gzip'):
+            self.assertEqual([error.id for error in checks.check_text_codec(None)], ['luci.E001'])
+
+    def test_compress_texts_reencodes_messages(self):
+        message = store_message(self.TEXT)
+        store_message('hello world')
+        call_command('compress_texts', codec='zlib', stdout=StringIO())
+
+        message.refresh_from_db()
+        self.assertTrue(bytes(message.text).startswith(compression.MAGIC))
+        self.assertEqual(CompressedString.decompress_bytes(message.text), self.TEXT)
+
+        # word filters still match the compressed texts
+        result = self.execute('{ messages(text__icontains: "lazy FOX") { text } }')
+        self.assertEqual([item['text'] for item in result['data']['messages']], [self.TEXT])
+
+        call_command('compress_texts', codec='plain', stdout=StringIO())
+        message.refresh_from_db()
+        self.assertEqual(bytes(message.text), self.TEXT.encode('utf-8'))
+
+
+class CacheTests(TransactionTestCase):
+    """
+    Invalidations run on commit, which TestCase never reaches.
+    """
+    def setUp(self):
+        cache.shared_cache.clear()
+        cache.local_cache.clear()
+        cache._generations.clear()
+        self.loads = []
+
+    def load(self):
+        self.loads.append(len(self.loads))
+        return {'version': len(self.loads)}
+
+    def lookup(self):
+        return cache.get_or_load(cache.USERS, 'ref', self.load)
+
+    def test_invalidation_renews_the_generation(self):
+        for shared in (True, False):
+            with self.subTest(shared=shared), self.settings(CACHE_SHARED_TIER=shared):
+                key = cache.make_key(cache.USERS, 'ref')
+                self.lookup()
+                token, _ = cache.get_generation(key)
+
+                cache.invalidate(cache.USERS, ['ref'])
+                new_token, written_at = cache.get_generation(key)
+                self.assertNotEqual(new_token, token)
+                self.assertGreater(written_at, 0)
+
+    def test_invalidation_drops_the_entries(self):
+        for shared in (True, False):
+            with self.subTest(shared=shared), self.settings(CACHE_SHARED_TIER=shared):
+                self.setUp()
+                self.assertEqual(self.lookup(), {'version': 1})
+                self.assertEqual(self.lookup(), {'version': 1})
+
+                cache.invalidate(cache.USERS, ['ref'])
+                self.assertEqual(self.lookup(), {'version': 2})
+                self.assertEqual(len(self.loads), 2)
+
+    @override_settings(CACHE_SHARED_TIER=True)
+    def test_shared_entries_of_an_old_generation_are_misses(self):
+        self.lookup()
+        # another process wrote the row: only the generation token changed
+        cache.local_cache.clear()
+        cache.renew_generation(cache.make_key(cache.USERS, 'ref'))
+
+        self.assertEqual(self.lookup(), {'version': 2})
+
+    def test_shared_tier_with_a_process_cache_is_reported(self):
+        with self.settings(CACHE_SHARED_TIER=True):
+            self.assertEqual([warning.id for warning in checks.check_shared_cache(None)], ['luci.W001'])
+        with self.settings(CACHE_SHARED_TIER=False):
+            self.assertEqual(checks.check_shared_cache(None), [])
+
+
+class QueryLimitTests(GraphQLTestCase):
+    def measure(self, document, variables=None):
+        return limits.measure_query(schema, parse(document), variables=variables)
+
+    def test_scalar_fields_are_free(self):
+        self.assertEqual(self.measure('{ messages(first: 10) { text } }'), (2, 10))
+
+    def test_nested_list_costs(self):
+        # 10 messages, each with 100 responses by default
+        self.assertEqual(
+            self.measure('{ messages(first: 10) { text possible_responses { text } } }'),
+            (3, 10 * (1 + 100))
+        )
+        self.assertEqual(
+            self.measure(
+                'query ($size: Int) { messages(first: $size) '
+                '{ possible_responses { possible_responses { text } } } }',
+                {'size': 2}
+            ),
+            (4, 2 * (1 + 100 * (1 + 100)))
+        )
+
+    def test_queries_over_the_limits_are_rejected(self):
+        result = self.execute(
+            '{ messages(first: 2) { possible_responses { possible_responses { text } } } }'
+        )
+        self.assertNotIn('data', result)
+        self.assertEqual(
+            [error['message'] for error in result['errors']],
+            ['Query cost 20202 exceeds the maximum of 20000']
+        )
+
+        with self.settings(QUERY_MAX_DEPTH=2):
+            result = self.execute('{ messages(first: 1) { possible_responses { text } } }')
+        self.assertEqual(
+            [error['message'] for error in result['errors']],
+            ['Query depth 3 exceeds the maximum of 2']
+        )
+
+    def test_queries_within_the_limits_report_their_cost(self):
+        store_message('hello')
+        response = self.client.post(
+            '/graphql/',
+            json.dumps({'query': '{ messages(first: 5) { text } }'}),
+            content_type='application/json'
+        )
+        self.assertEqual(
+            response.json()['extensions']['cost'],
+            {'depth': 2, 'cost': 5, 'max_depth': 10, 'max_cost': 20000}
+        )
+
+
+class ChainTransactionQueryTests(GraphQLTestCase):
+    QUERY = '''
+        query ($after: String) {
+            chain_transactions(status: "pending", first: 2, after: $after) { member_id cursor }
+        }
+    '''
+
+    def test_transactions_are_paged_newest_first(self):
+        for member_id in range(5):
+            ChainTransaction.objects.create(function='addMessage', member_id=str(member_id))
+        ChainTransaction.objects.create(
+            function='addMessage', member_id='9', status=ChainTransaction.CONFIRMED
+        )
+
+        pages = []
+        after = None
+        while True:
+            page = self.execute(self.QUERY, {'after': after})['data']['chain_transactions']
+            if not page:
+                break
+            pages.append([item['member_id'] for item in page])
+            after = page[-1]['cursor']
+
+        self.assertEqual(pages, [['4', '3'], ['2', '1'], ['0']])
+
+
+class IngestTests(GraphQLTestCase):
+    MUTATION = '''
+        mutation ($records: [MessageRecordInput]!) {
+            ingest_messages(input: {records: $records}) {
+                messages_created
+                users { reference name friendshipness emotion_resume { pleasantness } }
+            }
+        }
+    '''
+
+    def record(self, reference, text, friendshipness=1, pleasantness=0.5, name=None):
+        return {
+            'reference': reference,
+            'name': name or reference.title(),
+            'friendshipness': friendshipness,
+            'emotion_resume': {'pleasantness': pleasantness},
+            'message': {'global_intention': '', 'specific_intention': '', 'text': text},
+        }
+
+    def ingest(self, records):
+        result = self.execute(self.MUTATION, {'records': records})
+        self.assertNotIn('errors', result)
+        return result['data']['ingest_messages']
+
+    def users(self, result):
+        return {user['reference']: user for user in result['users']}
+
+    @override_settings(WEB3_AGGREGATE_COUNTS=False)
+    def test_each_record_is_stored(self):
+        ana = make_reference('guild', '1')
+        store_message('old', reference=ana, user=User.objects.create(reference=ana, name='Ana'))
+        bob = make_reference('guild', '2')
+        records = [self.record(ana, 'hello world'), self.record(bob, 'hi world'), self.record(bob, 'bye')]
+        records[2]['message']['global_intention'] = 'farewell'
+
+        result = self.ingest(records)
+        self.assertEqual(result['messages_created'], 3)
+        self.assertEqual(set(self.users(result)), {ana, bob})
+        self.assertEqual(self.users(result)[bob]['emotion_resume'], {'pleasantness': 1.0})
+
+        messages = Message.objects.exclude(text=b'old').order_by('id')
+        self.assertEqual(
+            [(message.user.reference, message.global_intention) for message in messages],
+            [(ana, ''), (bob, ''), (bob, 'farewell')]
+        )
+        self.assertEqual(
+            sorted(ChainTransaction.objects.values_list('member_id', flat=True)),
+            ['1', '2', '2']
+        )
+        # the new messages are in the token index
+        result = self.execute('{ messages(text__icontains: "world") { author } }')
+        self.assertEqual([item['author'] for item in result['data']['messages']], [ana.title(), bob.title()])
+
+    def test_duplicate_records_are_skipped(self):
+        store_message('stored', reference='ana')
+        records = [
+            self.record('ana', 'stored'),
+            self.record('ana', 'new'),
+            self.record('ana', 'new'),
+            self.record('bob', 'new'),
+        ]
+        result = self.ingest(records)
+        self.assertEqual(result['messages_created'], 2)
+        self.assertEqual(
+            sorted(Message.objects.values_list('reference', 'text')),
+            [('ana', b'new'), ('ana', b'stored'), ('bob', b'new')]
+        )
+        self.assertEqual(self.users(result)['ana']['friendshipness'], 1.0)
+
+    def test_ingesting_twice_applies_the_deltas_once(self):
+        records = [self.record('ana', 'hello'), self.record('ana', 'bye'), self.record('bob', 'hi')]
+        first = self.ingest(records)
+        self.assertEqual(first['messages_created'], 3)
+
+        records[0]['name'] = 'Renamed'
+        second = self.ingest(records)
+        self.assertEqual(second['messages_created'], 0)
+        self.assertEqual(self.users(second), self.users(first))
+        self.assertEqual(self.users(second)['ana'], {
+            'reference': 'ana',
+            'name': 'Ana',
+            'friendshipness': 2.0,
+            'emotion_resume': {'pleasantness': 1.0},
+        })
+
+
+def make_reference(server_id, member_id):
+    return b64encode(f'{server_id}:{member_id}'.encode('utf-8')).decode('utf-8')
+
+
+class ReferenceKeyTests(GraphQLTestCase):
+    def test_references_are_split_on_save(self):
+        user = User.objects.create(reference=make_reference('guild', '42'), name='Ana')
+        self.assertEqual((user.server_id, user.member_id), ('guild', '42'))
+
+        for reference in ('plain', make_reference('a', 'b:c'), ''):
+            user = User(reference=reference, name='Bob')
+            user.set_reference_keys()
+            self.assertEqual((user.server_id, user.member_id), (None, None), reference)
+
+    def test_users_are_filtered_by_their_keys(self):
+        User.objects.create(reference=make_reference('guild', '1'), name='Ana')
+        User.objects.create(reference=make_reference('guild', '2'), name='Bob')
+        User.objects.create(reference=make_reference('other', '1'), name='Cid')
+
+        with CaptureQueriesContext(connection) as queries:
+            result = self.execute('{ users(server_id: "guild", user_id: "1") { name } }')
+        self.assertEqual(result['data']['users'], [{'name': 'Ana'}])
+        sql, = [query['sql'] for query in queries if 'luci_user' in query['sql']]
+        self.assertIn('"luci_user"."member_id" = ', sql)
+        self.assertIn('"luci_user"."server_id" = ', sql)
+
+        result = self.execute('{ users(server_id: "guild") { name } }')
+        self.assertEqual([user['name'] for user in result['data']['users']], ['Ana', 'Bob'])
+
+    def test_backfill_migration_fills_existing_rows(self):
+        reference = make_reference('guild', '7')
+        emotion = Emotion.objects.create(reference=reference)
+        user = User.objects.create(reference=reference, name='Ana', emotion_resume=emotion)
+        message = store_message('hello', reference=reference, user=user)
+        plain = User.objects.create(reference='plain', name='Bob')
+        for model in (Emotion, User, Message):
+            model.objects.update(server_id=None, member_id=None)
+
+        # run with the models as they were when the migration was written
+        migration = import_module('luci.migrations.0016_backfill_reference_keys')
+        state = MigrationLoader(connection).project_state(('luci', '0016_backfill_reference_keys'))
+        with mock.patch.object(migration, 'CHUNK_SIZE', 1):
+            migration.backfill_reference_keys(state.apps, None)
+
+        for row in (emotion, user, message):
+            row.refresh_from_db()
+            self.assertEqual((row.server_id, row.member_id), ('guild', '7'))
+        plain.refresh_from_db()
+        self.assertEqual((plain.server_id, plain.member_id), (None, None))
+
+
+@override_settings(QUERY_MAX_COST=10 ** 9)
+class LoaderTests(GraphQLTestCase):
+    QUERY = '''{
+        users(first: 100) {
+            name
+            emotion_resume { pleasantness }
+            messages { text author possible_responses { text author } }
+        }
+    }'''
+
+    def add_users(self, count):
+        start = User.objects.count()
+        for index in range(start, start + count):
+            reference = make_reference('guild', index)
+            emotion = Emotion.objects.create(reference=reference)
+            user = User.objects.create(reference=reference, name=f'user {index}', emotion_resume=emotion)
+            for text in ('hello', 'how are you?'):
+                message = store_message(f'{text} {index}', reference=reference, user=user)
+                message.possible_responses.add(*Message.objects.exclude(id=message.id)[:3])
+
+    def test_nested_fields_are_loaded_in_batches(self):
+        self.add_users(2)
+        # users, emotions, messages, authors, links and responses
+        with self.assertNumQueries(6):
+            result = self.execute(self.QUERY)
+        self.assertEqual(len(result['data']['users']), 2)
+
+        self.add_users(8)
+        with self.assertNumQueries(6):
+            result = self.execute(self.QUERY)
+        users = result['data']['users']
+        self.assertEqual(len(users), 10)
+        self.assertEqual(users[-1]['messages'][0]['author'], 'user 9')
+        self.assertEqual(len(users[-1]['messages'][0]['possible_responses']), 3)
+
+
+class PaginationTests(GraphQLTestCase):
+    QUERY = '''
+        query ($after: String) {
+            messages(first: 2, after: $after) { text cursor }
+        }
+    '''
+
+    def setUp(self):
+        for index in range(5):
+            store_message(f'message {index}', index=False)
+        # ties on message_datetime are ordered by id
+        Message.objects.filter(text__in=[b'message 1', b'message 2', b'message 3']).update(
+            message_datetime=timezone.now() - timedelta(days=1)
+        )
+
+    def page(self, after=None):
+        result = self.execute(self.QUERY, {'after': after})
+        if 'errors' in result:
+            return [error['message'] for error in result['errors']]
+        return result['data']['messages']
+
+    def test_pages_follow_the_ordering(self):
+        texts = []
+        after = None
+        while True:
+            page = self.page(after)
+            if not page:
+                break
+            self.assertLessEqual(len(page), 2)
+            texts.extend(item['text'] for item in page)
+            after = page[-1]['cursor']
+
+        self.assertEqual(texts, ['message 1', 'message 2', 'message 3', 'message 0', 'message 4'])
+
+    def test_last_cursor_gives_an_empty_page(self):
+        last = self.page(self.page(self.page()[-1]['cursor'])[-1]['cursor'])
+        self.assertEqual([item['text'] for item in last], ['message 4'])
+        self.assertEqual(self.page(last[-1]['cursor']), [])
+
+    def test_page_size_is_bounded(self):
+        result = self.execute('{ messages(first: 0) { text } }')
+        self.assertEqual(
+            [error['message'] for error in result['errors']],
+            [f'first must be between 1 and {settings.PAGINATION_MAX_PAGE_SIZE}']
+        )
+
+    def test_bad_cursors_are_rejected(self):
+        Quote.objects.create(reference='ref', quote=b'quote', author='someone')
+        foreign = self.execute('{ quotes(reference: "ref", first: 1) { cursor } }')['data']['quotes'][0]['cursor']
+        cursors = [
+            'not a cursor',
+            urlsafe_b64encode(b'{"a": 1}').decode('utf-8'),
+            urlsafe_b64encode(b'\xff\xfe').decode('utf-8'),
+            foreign,
+        ]
+        for cursor in cursors:
+            self.assertEqual(self.page(cursor), ['Invalid cursor'], cursor)
+
+
+class VocabularyTests(TestCase):
+    def counts(self):
+        return {
+            token: (occurrences, documents) for token, occurrences, documents in
+            Word.objects.values_list('token', 'occurrences', 'document_frequency')
+        }
+
+    def test_populate_word_table_counts_words(self):
+        store_message('the cat and the dog', index=False)
+        store_message('The cat!', index=False)
+        Quote.objects.create(reference='ref', quote=CompressedString('a dog').bit_string, author='me')
+
+        call_command('populate_word_table', recount=True, stdout=StringIO())
+        self.assertEqual(self.counts(), {
+            'the': (3, 2), 'cat': (2, 2), 'and': (1, 1), 'dog': (2, 2), 'a': (1, 1),
+        })
+        self.assertFalse(WordCountDelta.objects.exists())
+
+        # counting again gives the same counts
+        call_command('populate_word_table', recount=True, stdout=StringIO())
+        self.assertEqual(self.counts()['the'], (3, 2))
+
+    def test_populate_word_table_resumes_after_an_interruption(self):
+        first = store_message('first words', index=False)
+        store_message('second words', index=False)
+        store_message('third words', index=False)
+        bulk_create = Word.objects.bulk_create
+        calls = []
+
+        def interrupt_second_chunk(*args, **kwargs):
+            calls.append(args)
+            if len(calls) == 2:
+                raise KeyboardInterrupt
+            return bulk_create(*args, **kwargs)
+
+        with mock.patch.object(Word.objects, 'bulk_create', interrupt_second_chunk):
+            with self.assertRaises(KeyboardInterrupt):
+                call_command('populate_word_table', chunk_size=1, stdout=StringIO())
+        self.assertEqual(ProcessingCheckpoint.objects.get().position, first.id)
+        self.assertEqual(set(self.counts()), {'first', 'words'})
+
+        calls.clear()
+        with mock.patch.object(Word.objects, 'bulk_create', interrupt_second_chunk):
+            call_command('populate_word_table', chunk_size=2, stdout=StringIO())
+        # the first message is not read again
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(set(self.counts()), {'first', 'second', 'third', 'words'})
+
+    def test_flush_vocabulary_folds_staged_counts(self):
+        Word.objects.create(token='hello', length=5, occurrences=10, document_frequency=4)
+        learn_vocabulary(['hello hello world', 'hello there'])
+        learn_vocabulary(['world'])
+        self.assertEqual(WordCountDelta.objects.count(), 4)
+
+        self.assertEqual(flush_vocabulary(), 4)
+        self.assertEqual(self.counts(), {
+            'hello': (13, 6), 'world': (2, 2), 'there': (1, 1),
+        })
+        self.assertFalse(WordCountDelta.objects.exists())
+        self.assertEqual(flush_vocabulary(), 0)
+
+    @override_settings(VOCABULARY_UPDATE_CHUNK_SIZE=1)
+    def test_flush_vocabulary_works_in_batches(self):
+        learn_vocabulary(['one two'])
+        learn_vocabulary(['two three'])
+        self.assertEqual(flush_vocabulary(batch_size=2), 2)
+        self.assertEqual(self.counts(), {'one': (1, 1), 'two': (1, 1)})
+
+        self.assertEqual(flush_vocabulary(batch_size=2), 2)
+        self.assertEqual(self.counts(), {'one': (1, 1), 'two': (2, 2), 'three': (1, 1)})
+        self.assertFalse(WordCountDelta.objects.exists())
+
+
+@skipUnless(find_spec('numpy') and find_spec('scipy'), 'numpy and scipy are not installed')
+class RetrievalTests(GraphQLTestCase):
+    QUERY = '''
+        query ($text: String!) {
+            best_responses(text: $text, k: 2) { score message { text } }
+        }
+    '''
+
+    def setUp(self):
+        from luci import retrieval
+
+        self.retrieval = retrieval
+        index_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(index_dir.cleanup)
+        settings_override = self.settings(TFIDF_INDEX_DIR=index_dir.name)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        retrieval._loaded.update(version=None, index=None)
+
+    def converse(self, text, *responses):
+        message = store_message(text, index=False)
+        for response in responses:
+            message.possible_responses.add(store_message(response, index=False))
+        return message
+
+    def build(self, incremental=False):
+        call_command('populate_word_table', recount=True, stdout=StringIO())
+        return self.retrieval.build(incremental=incremental)
+
+    def best(self, text):
+        result = self.execute(self.QUERY, {'text': text})
+        self.assertNotIn('errors', result)
+        return [item['message']['text'] for item in result['data']['best_responses']]
+
+    def test_responses_of_the_most_similar_messages_come_first(self):
+        self.converse('how is the weather today', 'sunny and warm', '!forecast')
+        self.converse('what is your name', 'call me luci')
+        self.converse('nice weather for a walk', 'lets go outside')
+        self.build()
+
+        self.assertEqual(self.best('the weather today?'), ['sunny and warm', 'lets go outside'])
+        self.assertEqual(self.best('your name please'), ['call me luci'])
+        self.assertEqual(self.best('unknown words only'), [])
+
+    def test_incremental_build_adds_new_messages(self):
+        self.converse('what is your name', 'call me luci')
+        meta = self.build()
+        self.assertEqual(self.best('good morning'), [])
+
+        self.converse('good morning everyone', 'morning to you')
+        new_meta = self.build(incremental=True)
+        self.assertGreater(new_meta['last_message_id'], meta['last_message_id'])
+        # possible_responses links go both ways
+        self.assertEqual(self.best('good morning'), ['morning to you', 'good morning everyone'])
+        self.assertEqual(self.best('your name'), ['call me luci'])
+
+    def test_missing_index_is_reported(self):
+        result = self.execute(self.QUERY, {'text': 'hello'})
+        self.assertEqual(
+            [error['message'] for error in result['errors']],
+            ['Response index not built, run build_tfidf_index']
+        )
+
+
+class PersistedQueryTests(GraphQLTestCase):
+    QUERY = '{ messages(first: 1) { text } }'
+
+    def setUp(self):
+        cache.shared_cache.clear()
+        views.backend.documents.documents.clear()
+        store_message('hello')
+
+    def post(self, query=None, document_hash=None, version=1):
+        data = {'extensions': {'persistedQuery': {
+            'version': version,
+            'sha256Hash': document_hash or views.query_hash(self.QUERY),
+        }}}
+        if query:
+            data['query'] = query
+        return self.client.post('/graphql/', json.dumps(data), content_type='application/json')
+
+    def test_unknown_hash_is_not_found(self):
+        response = self.post()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {'errors': [{
+            'message': 'PersistedQueryNotFound',
+            'extensions': {'code': 'PERSISTED_QUERY_NOT_FOUND'},
+        }]})
+
+    def test_registered_query_is_found_by_its_hash(self):
+        response = self.post(self.QUERY)
+        self.assertEqual(response.json()['data'], {'messages': [{'text': 'hello'}]})
+
+        response = self.post()
+        self.assertEqual(response.json()['data'], {'messages': [{'text': 'hello'}]})
+
+        # another process only finds the text in the shared cache
+        views.backend.documents.documents.clear()
+        response = self.post()
+        self.assertEqual(response.json()['data'], {'messages': [{'text': 'hello'}]})
+
+    def test_invalid_persisted_queries_are_rejected(self):
+        response = self.post(self.QUERY, document_hash='0' * 64)
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(cache.shared_cache.get(views.persisted_query_key('0' * 64)))
+
+        response = self.post(self.QUERY, version=2)
+        self.assertEqual(response.status_code, 400)
+
+
+@override_settings(EXPORT_CHUNK_SIZE=2)
+class ExportTests(TestCase):
+    def setUp(self):
+        self.messages = [store_message(f'message {index}', index=False) for index in range(5)]
+        self.messages[0].possible_responses.add(self.messages[1], self.messages[2])
+        store_message('elsewhere', reference='other', index=False)
+        Message.objects.filter(id=self.messages[4].id).update(
+            message_datetime=timezone.now() + timedelta(days=2)
+        )
+
+    def export(self, kind, **params):
+        response = self.client.get(f'/export/{kind}/', params)
+        self.assertEqual(response.status_code, 200)
+        return response, b''.join(response.streaming_content)
+
+    def records(self, content):
+        return [json.loads(line) for line in content.decode('utf-8').splitlines()]
+
+    def test_messages_are_exported_as_ndjson(self):
+        response, content = self.export('messages', reference='ref')
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename="messages.ndjson"')
+
+        records = self.records(content)
+        self.assertEqual([record['text'] for record in records], [f'message {index}' for index in range(5)])
+        self.assertEqual(records[0]['possible_responses'], [self.messages[1].id, self.messages[2].id])
+        self.assertEqual(records[1]['possible_responses'], [self.messages[0].id])
+
+    def test_exports_are_filtered_by_date(self):
+        tomorrow = (timezone.now() + timedelta(days=1)).date().isoformat()
+        _, content = self.export('messages', reference='ref', until=tomorrow)
+        self.assertEqual(len(self.records(content)), 4)
+
+        _, content = self.export('messages', since=tomorrow)
+        self.assertEqual([record['text'] for record in self.records(content)], ['message 4'])
+
+    def test_gzip_export(self):
+        response, content = self.export('messages', gzip='1')
+        self.assertEqual(response['Content-Type'], 'application/gzip')
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename="messages.ndjson.gz"')
+
+        _, plain = self.export('messages')
+        self.assertEqual(gzip.decompress(content), plain)
+        self.assertEqual(len(self.records(plain)), 6)
+
+    def test_bad_requests(self):
+        response = self.client.get('/export/messages/', {'since': 'yesterday'})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.content, b'Invalid date: yesterday')
+        response = self.client.get('/export/messages/', {'until': '2020-13-45'})
+        self.assertEqual(response.status_code, 400)
+
+        self.assertEqual(self.client.get('/export/secrets/').status_code, 404)
+
+
+class ImportCorpusTests(TestCase):
+    def setUp(self):
+        dump_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(dump_dir.cleanup)
+        self.path = os.path.join(dump_dir.name, 'messages.ndjson')
+        self.write_dump([
+            {
+                'id': 10 + index,
+                'reference': 'ref',
+                'global_intention': '',
+                'specific_intention': '',
+                'text': f'imported message {index}',
+                'user_id': None,
+                'message_datetime': '2020-01-0%dT12:00:00+00:00' % (index + 1),
+                # links are exported from both of their messages
+                'possible_responses': [response_id],
+            }
+            for index, response_id in enumerate([11, 10, 13, 12, 19])
+        ])
+
+    def write_dump(self, records):
+        with open(self.path, 'w') as dump:
+            for record in records:
+                dump.write(json.dumps(record) + '\n')
+
+    def import_corpus(self, **options):
+        call_command('import_corpus', 'messages', self.path, chunk_size=2, stdout=StringIO(), **options)
+
+    def interrupted_import(self):
+        index_messages = import_module('luci.management.commands.import_corpus').index_messages
+        calls = []
+
+        def interrupt_second_chunk(pairs):
+            calls.append(pairs)
+            if len(calls) == 2:
+                raise KeyboardInterrupt
+            index_messages(pairs)
+
+        with mock.patch('luci.management.commands.import_corpus.index_messages', interrupt_second_chunk):
+            with self.assertRaises(KeyboardInterrupt):
+                self.import_corpus()
+
+    def test_messages_are_imported_with_their_ids_and_links(self):
+        self.import_corpus()
+        messages = Message.objects.order_by('id')
+        self.assertEqual([message.id for message in messages], [10, 11, 12, 13, 14])
+        self.assertEqual(CompressedString.decompress_bytes(messages[0].text), 'imported message 0')
+        self.assertEqual(messages[0].message_datetime.day, 1)
+        self.assertEqual(list(messages[0].possible_responses.values_list('id', flat=True)), [11])
+        # links to messages out of the dump are dropped
+        self.assertFalse(messages[4].possible_responses.exists())
+        self.assertTrue(MessageToken.objects.filter(message_id=14, token='imported').exists())
+        self.assertFalse(ProcessingCheckpoint.objects.exists())
+
+        # the sequence continues after the imported ids
+        self.assertGreater(store_message('new', index=False).id, 14)
+
+    def test_interrupted_import_resumes(self):
+        self.interrupted_import()
+        self.assertEqual(list(Message.objects.values_list('id', flat=True)), [10, 11])
+        self.assertEqual(
+            sorted(ProcessingCheckpoint.objects.values_list('position', flat=True)), [0, 2]
+        )
+
+        self.import_corpus()
+        self.assertEqual(Message.objects.count(), 5)
+        self.assertEqual(Message.possible_responses.through.objects.count(), 4)
+
+    def test_ids_stored_meanwhile_abort_the_import(self):
+        self.interrupted_import()
+        Message.objects.create(id=13, reference='other', text=b'written by the API')
+
+        with self.assertRaisesMessage(CommandError, '1 ids of the dump are already stored'):
+            self.import_corpus()
+        self.assertEqual(Message.objects.count(), 3)
+
+    def test_non_empty_tables_are_refused(self):
+        store_message('already there', index=False)
+        with self.assertRaisesMessage(CommandError, 'luci_message is not empty'):
+            self.import_corpus()
+
+        # a new dump under the same name does not resume the previous one
+        Message.objects.all().delete()
+        self.interrupted_import()
+        self.write_dump([])
+        with self.assertRaisesMessage(CommandError, 'luci_message is not empty'):
+            self.import_corpus()
+
+
+class ArchiveTests(GraphQLTestCase):
+    TEXT = 'good morning to everyone in the channel, how are you all doing today?'
+    QUERY = '''
+        query ($archived: Boolean) {
+            messages(include_archived: $archived) { text archived possible_responses { text archived } }
+        }
+    '''
+
+    def setUp(self):
+        compression.reset_dictionary_cache()
+        self.addCleanup(compression.reset_dictionary_cache)
+
+        self.old = store_message(self.TEXT)
+        self.old_response = store_message('morning! ' + self.TEXT)
+        self.recent = store_message('and a good morning to you too')
+        self.old.possible_responses.add(self.old_response, self.recent)
+        Message.objects.filter(id__in=[self.old.id, self.old_response.id]).update(
+            message_datetime=timezone.now() - timedelta(days=400)
+        )
+        call_command('compress_texts', train_dictionary=True, stdout=StringIO())
+        call_command('archive_messages', older_than=365, stdout=StringIO())
+
+    def messages(self, archived):
+        result = self.execute(self.QUERY, {'archived': archived})
+        self.assertNotIn('errors', result)
+        return result['data']['messages']
+
+    def test_archived_messages_keep_their_ids_and_links(self):
+        self.assertEqual(list(Message.objects.values_list('id', flat=True)), [self.recent.id])
+        self.assertEqual(
+            sorted(ArchivedMessage.objects.values_list('id', flat=True)),
+            [self.old.id, self.old_response.id]
+        )
+        self.assertEqual(
+            sorted(ArchivedResponseLink.objects.values_list('message_id', 'response_id')),
+            sorted([
+                (self.old.id, self.old_response.id), (self.old_response.id, self.old.id),
+                (self.old.id, self.recent.id), (self.recent.id, self.old.id),
+            ])
+        )
+        # archived messages leave the token index
+        self.assertFalse(MessageToken.objects.filter(message_id=self.old.id).exists())
+
+    def test_archived_texts_are_compressed_with_the_dictionary(self):
+        dictionary = CompressionDictionary.objects.get()
+        archived = ArchivedMessage.objects.get(id=self.old.id)
+        blob = bytes(archived.text)
+        header = compression.MAGIC + bytes([compression.VERSION, compression.CODEC_IDS[compression.ZDICT]])
+        self.assertEqual(blob[:3], header)
+        self.assertEqual(int.from_bytes(blob[3:5], 'big'), dictionary.id)
+        self.assertLess(len(blob), len(self.TEXT))
+
+        compression.reset_dictionary_cache()
+        self.assertEqual(compression.decode(blob), self.TEXT)
+
+    def test_archived_messages_are_listed_with_include_archived(self):
+        self.assertEqual(self.messages(False), [{
+            'text': 'and a good morning to you too', 'archived': False, 'possible_responses': [],
+        }])
+
+        messages = self.messages(True)
+        self.assertEqual(
+            [(message['text'], message['archived']) for message in messages],
+            [(self.TEXT, True), ('morning! ' + self.TEXT, True), ('and a good morning to you too', False)]
+        )
+        self.assertEqual(messages[2]['possible_responses'], [{'text': self.TEXT, 'archived': True}])
+        self.assertEqual(
+            [response['text'] for response in messages[0]['possible_responses']],
+            ['morning! ' + self.TEXT, 'and a good morning to you too']
+        )
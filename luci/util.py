@@ -1,29 +1,35 @@
 """
 Utilities module.
 """
-from operator import length_hint
+from collections import Counter
+from functools import reduce
+from operator import length_hint, or_
 from string import ascii_lowercase, punctuation
-from luci.models import Message, Quote, Word
+from django.conf import settings
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.db.models import BigIntegerField, Case, Count, F, FloatField, Q, Value, When
+from luci.models import Message, MessageToken, Word, WordCountDelta, TOKEN_MAX_LENGTH
+from luci import compression
 
 
 class CompressedString:
     def __init__(self, text: str) -> None:
         self.bit_string = self._compress(text)
 
-    def _compress(self, text: str) -> None:
+    def _compress(self, text: str) -> bytes:
         """
-        Compress the text to bytes type for data storage optimization.
-        In pure python, a unique char needs 50  bytes.
-        The same char in bytes type needs 34 bytes.
-        This is not a great difference, but is a difference.
+        Compress the text to bytes type for data storage optimization,
+        using the codec defined by settings.TEXT_CODEC.
+        See luci.compression for the stored format.
         """
-        return bytes(text.encode('utf-8'))
+        return compression.encode(text)
 
     def decompress(self) -> str:
         """
         Decompress the byte string to pure string.
         """
-        return self.bit_string.decode('utf-8')
+        return compression.decode(self.bit_string)
 
     def __repr__(self) -> str:
         """
@@ -37,60 +43,246 @@ class CompressedString:
         Use this method for decompressing any other byte string whithout
         the need of instantiating the class.
         """
-        return byte_string.decode('utf-8')
+        return compression.decode(byte_string)
 
 
-def populate_word_table():
+EMOTION_FIELDS = ('pleasantness', 'attention', 'sensitivity', 'aptitude')
+
+
+def increments(deltas: dict) -> dict:
     """
-    Create Word records on database from all messages and quotes registered
-    o database.
-    Words must be all lowercase.
-    Word must be a single token.
-    Word cannot contain or be:
+    Map each non zero delta to a `field + delta` expression, so an UPDATE
+    adds it to the stored value in a single statement, without losing
+    concurrent increments.
+    """
+    return {field: F(field) + value for field, value in deltas.items() if value}
+
+
+def keyed_increments(key: str, deltas: dict, output_field=None) -> dict:
+    """
+    Like `increments`, for deltas given by row: {key value: {field: delta}}.
+    Rows of all keys are updated by the same statement.
+    """
+    fields = {field for row_deltas in deltas.values() for field in row_deltas}
+    expressions = {}
+    for field in fields:
+        cases = [
+            When(**{key: key_value}, then=Value(row_deltas[field]))
+            for key_value, row_deltas in deltas.items()
+            if row_deltas.get(field)
+        ]
+        if cases:
+            expressions[field] = F(field) + Case(
+                *cases,
+                default=Value(0),
+                output_field=output_field or FloatField()
+            )
+
+    return expressions
+
+
+NOT_VOWELS = [i for i in ascii_lowercase if i not in 'aeiou']
+
+
+def tokenize(text: str) -> list:
+    """
+    Split a text into the word tokens known by Luci.
+    Tokens are lowercase and cannot contain or be:
         - puncts
         - special characters
         - spaces
         - numbers
-    
-    So it is necessary to preprocess all entries before saving.
-    """
-    messages = [CompressedString.decompress_bytes(m.text)
-                for m in Message.objects.all()]
-    messages = messages + [CompressedString.decompress_bytes(q.quote)
-                for q in Quote.objects.all()]
-    not_vowels = [i for i in ascii_lowercase if i not in 'aeiou']
-    words = set()
-
-    for message in messages:
-        tokens = message.lower().split()
-        for token in tokens:
-            token = token.strip()
-
-            if not token[0].isalpha():
-                token = token.replace(token[0], '')
-            if not token:
-                continue
-            if not token[-1].isalpha():
-                token = token.replace(token[-1], '')
-            
-            if not token.isalpha():
-                continue
-
-            if len(token) < 2 and token not in not_vowels:
-                words.add(token)
-            elif len(token) > 1:
-                words.add(token)
-    
-    print(f'Identified {len(words)} words!')
-    creations = 0
-    errors = 0
-    for word in list(words):    
-        try:
-            obj, is_new = Word.objects.get_or_create(token=word, length=len(word))
-            if is_new:
-                obj.save()
-                creations += 1
-        except:
-            errors += 1
-
-    print(f'Done! Created {creations} new tokens with {errors} errors.')
+    Single letter tokens are only kept if they are not consonants.
+    Repeated tokens are kept, in the order they appear.
+    """
+    words = []
+    for token in text.lower().split():
+        token = token.strip()
+
+        if not token[0].isalpha():
+            token = token.replace(token[0], '')
+        if not token:
+            continue
+        if not token[-1].isalpha():
+            token = token.replace(token[-1], '')
+
+        if not token.isalpha():
+            continue
+
+        if len(token) < 2 and token not in NOT_VOWELS:
+            words.append(token)
+        elif len(token) > 1:
+            words.append(token)
+
+    return words
+
+
+def index_message(message: Message, text: str = None) -> None:
+    """
+    Register the tokens of a message text on the inverted index
+    used by message search.
+    """
+    if text is None:
+        text = CompressedString.decompress_bytes(message.text)
+
+    index_messages([(message, text)])
+
+
+def index_messages(messages: list) -> None:
+    """
+    Register the tokens of many (message, text) pairs with a single insert.
+    """
+    entries = []
+    for message, text in messages:
+        tokens = {token for token in tokenize(text) if len(token) <= TOKEN_MAX_LENGTH}
+        entries.extend(MessageToken(token=token, message=message) for token in tokens)
+
+    MessageToken.objects.bulk_create(entries, ignore_conflicts=True)
+
+
+def messages_with_words(text: str):
+    """
+    Ids of the messages containing every word token of a text, found
+    through the inverted token index. Used instead of LIKE filters on the
+    stored texts, which can not match inside compressed ones.
+    Returns None if the text has no tokens.
+    """
+    tokens = {token for token in tokenize(text) if len(token) <= TOKEN_MAX_LENGTH}
+    if not tokens:
+        return None
+
+    return (
+        MessageToken.objects.filter(token__in=tokens)
+        .values('message_id')
+        .annotate(found=Count('token'))
+        .filter(found=len(tokens))
+        .values('message_id')
+    )
+
+
+def filter_by_words(messages, text: str, exclude: bool = False):
+    """
+    Keep, or with `exclude` drop, the messages of a queryset containing
+    every word of a text.
+    """
+    ids = messages_with_words(text)
+    if ids is None:
+        return messages if exclude else messages.none()
+
+    if exclude:
+        return messages.exclude(id__in=ids)
+    return messages.filter(id__in=ids)
+
+
+def search_messages(query: str, reference: str = None, operator: str = 'AND'):
+    """
+    Search messages through the inverted token index.
+    Each query term is matched as a whole token, or as a token prefix
+    when ending with `*`. With the AND operator all terms must be found
+    in a message, with OR any of them is enough.
+    Returns a queryset with the most recent messages first.
+    """
+    conditions = []
+    for term in query.split():
+        if term.endswith('*'):
+            prefix = term.rstrip('*').lower()
+            if prefix.isalpha():
+                # tokens are lowercase, and a case insensitive LIKE 'x%'
+                # is the form MySQL resolves with the token index
+                conditions.append(Q(token__istartswith=prefix))
+        else:
+            conditions.extend(Q(token=token) for token in tokenize(term))
+
+    if not conditions:
+        return Message.objects.none()
+
+    messages = Message.objects.all()
+    if reference:
+        messages = messages.filter(reference=reference)
+
+    if operator == 'OR':
+        matches = reduce(or_, conditions)
+        messages = messages.filter(
+            id__in=MessageToken.objects.filter(matches).values('message_id')
+        )
+    else:
+        for condition in conditions:
+            messages = messages.filter(
+                id__in=MessageToken.objects.filter(condition).values('message_id')
+            )
+
+    return messages.order_by('-id')
+
+
+def learn_vocabulary(texts: list) -> None:
+    """
+    Stage the word counts of newly stored texts: their occurrences and the
+    number of texts using them. Staging only inserts rows, so the request
+    storing the texts never locks the Word rows of common words, which are
+    updated later by `flush_vocabulary`.
+    """
+    occurrences = Counter()
+    documents = Counter()
+    for text in texts:
+        tokens = [token for token in tokenize(text) if len(token) <= TOKEN_MAX_LENGTH]
+        occurrences.update(tokens)
+        documents.update(set(tokens))
+
+    WordCountDelta.objects.bulk_create([
+        WordCountDelta(token=token, occurrences=count, document_frequency=documents[token])
+        for token, count in occurrences.items()
+    ])
+
+
+def flush_vocabulary(batch_size: int = None) -> int:
+    """
+    Add a batch of staged word counts to the Word vocabulary, creating the
+    unknown words. Words are inserted and updated in token order, so
+    concurrent flushes lock their rows in the same order.
+    Returns the number of staged rows flushed.
+    """
+    batch_size = batch_size or settings.VOCABULARY_FLUSH_BATCH_SIZE
+    skip_locked = connection.features.has_select_for_update_skip_locked
+    with transaction.atomic():
+        staged = list(
+            WordCountDelta.objects.select_for_update(skip_locked=skip_locked)
+            .order_by('id')
+            .values_list('id', 'token', 'occurrences', 'document_frequency')[:batch_size]
+        )
+        if not staged:
+            return 0
+
+        deltas = {}
+        for _, token, count, document_count in staged:
+            token_deltas = deltas.setdefault(token, {'occurrences': 0, 'document_frequency': 0})
+            token_deltas['occurrences'] += count
+            token_deltas['document_frequency'] += document_count
+
+        tokens = sorted(deltas)
+        Word.objects.bulk_create(
+            [Word(token=token, length=len(token)) for token in tokens],
+            ignore_conflicts=True
+        )
+
+        chunk_size = settings.VOCABULARY_UPDATE_CHUNK_SIZE
+        for start in range(0, len(tokens), chunk_size):
+            chunk = tokens[start:start + chunk_size]
+            Word.objects.filter(token__in=chunk).update(**keyed_increments(
+                'token',
+                {token: deltas[token] for token in chunk},
+                BigIntegerField()
+            ))
+
+        WordCountDelta.objects.filter(id__in=[row[0] for row in staged]).delete()
+
+    return len(staged)
+
+
+def populate_word_table():
+    """
+    Create Word records on database from all messages and quotes registered
+    o database.
+    See `tokenize` for the rules a word must follow, and the
+    `populate_word_table` management command for the options.
+    """
+    call_command('populate_word_table')
@@ -1,3 +1,330 @@
-from django.shortcuts import render
+"""
+GraphQL endpoint with automatic persisted queries.
 
-# Create your views here.
+Clients send the SHA-256 hash of a query document in the persistedQuery
+extension instead of its text. A hash the server does not know yet gets a
+PersistedQueryNotFound error, and the client then sends the text along with
+the hash once, registering it:
+
+    {"extensions": {"persistedQuery": {"version": 1, "sha256Hash": "..."}}}
+
+Registered texts are shared by every process through the Django cache.
+Each process also keeps the documents it parsed and validated in a LRU
+keyed by hash, so known documents are executed straight away.
+
+Queries over the depth and cost limits of luci.limits are rejected before
+execution, and the measures of the others are returned in the response
+extensions.
+"""
+import json
+import threading
+from datetime import datetime, time
+from collections import OrderedDict
+from functools import partial
+from hashlib import sha256
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS
+from django.http import Http404, HttpResponseBadRequest, JsonResponse, StreamingHttpResponse
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+from django.views.decorators.http import require_GET
+from graphene_django.views import GraphQLView, HttpError
+from graphql.backend.base import GraphQLBackend, GraphQLDocument
+from graphql.execution import ExecutionResult, execute
+from graphql.language.base import parse
+from graphql.validation import validate
+from luci.export import EXPORTS, to_ndjson
+from luci import routers
+from luci.limits import check_limits, measure_query
+
+PERSISTED_QUERY_NOT_FOUND = 'PersistedQueryNotFound'
+
+
+def query_hash(query):
+    return sha256(query.encode('utf-8')).hexdigest()
+
+
+def persisted_query_key(document_hash):
+    return f'persisted_query:{document_hash}'
+
+
+class DocumentCache:
+    """
+    Thread safe LRU of parsed and validated documents.
+    """
+    def __init__(self, size):
+        self.size = size
+        self.documents = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            document = self.documents.get(key)
+            if document is not None:
+                self.documents.move_to_end(key)
+            return document
+
+    def set(self, key, document):
+        with self.lock:
+            self.documents[key] = document
+            self.documents.move_to_end(key)
+            while len(self.documents) > self.size:
+                self.documents.popitem(last=False)
+
+
+class CachedDocumentBackend(GraphQLBackend):
+    """
+    Parses and validates each document once per process. Documents failing
+    validation are kept too, returning their errors when executed.
+    """
+    def __init__(self, size):
+        self.documents = DocumentCache(size)
+
+    def document_from_string(self, schema, document_string):
+        document_hash = query_hash(document_string)
+        document = self.documents.get(document_hash)
+        if document is None:
+            document = self.build(schema, document_string)
+            self.documents.set(document_hash, document)
+
+        return document
+
+    def get_document(self, document_hash):
+        return self.documents.get(document_hash)
+
+    @staticmethod
+    def build(schema, document_string):
+        document_ast = parse(document_string)
+        errors = validate(schema, document_ast)
+        if errors:
+            def execute_document(*args, **kwargs):
+                return ExecutionResult(errors=errors, invalid=True)
+        else:
+            execute_document = partial(execute, schema, document_ast)
+
+        document = GraphQLDocument(schema, document_string, document_ast, execute_document)
+        document.validation_errors = errors
+        return document
+
+
+backend = CachedDocumentBackend(settings.PERSISTED_QUERY_CACHE_SIZE)
+
+
+class PersistedQueryNotFound(Exception):
+    pass
+
+
+class PersistedQueryView(GraphQLView):
+    def get_backend(self, request):
+        return backend
+
+    def get_response(self, request, data, show_graphiql=False):
+        try:
+            data = self.resolve_persisted_query(request, data)
+        except PersistedQueryNotFound:
+            response = {
+                'errors': [{
+                    'message': PERSISTED_QUERY_NOT_FOUND,
+                    'extensions': {'code': 'PERSISTED_QUERY_NOT_FOUND'}
+                }]
+            }
+            return self.json_encode(request, response, pretty=show_graphiql), 200
+
+        return self.get_result_response(request, data, show_graphiql)
+
+    def get_result_response(self, request, data, show_graphiql=False):
+        """
+        Same as GraphQLView.get_response, with the result extensions.
+        """
+        query, variables, operation_name, id = self.get_graphql_params(request, data)
+
+        execution_result = self.execute_graphql_request(
+            request, data, query, variables, operation_name, show_graphiql
+        )
+
+        status_code = 200
+        if execution_result:
+            response = {}
+
+            if execution_result.errors:
+                response['errors'] = [
+                    self.format_error(e) for e in execution_result.errors
+                ]
+
+            if execution_result.invalid:
+                status_code = 400
+            else:
+                response['data'] = execution_result.data
+
+            if execution_result.extensions:
+                response['extensions'] = execution_result.extensions
+
+            if self.batch:
+                response['id'] = id
+                response['status'] = status_code
+
+            result = self.json_encode(request, response, pretty=show_graphiql)
+        else:
+            result = None
+
+        return result, status_code
+
+    def execute_graphql_request(
+        self, request, data, query, variables, operation_name, show_graphiql=False
+    ):
+        if not query:
+            return super().execute_graphql_request(
+                request, data, query, variables, operation_name, show_graphiql
+            )
+
+        try:
+            document = self.get_backend(request).document_from_string(self.schema, query)
+        except Exception as e:
+            return ExecutionResult(errors=[e], invalid=True)
+
+        if document.validation_errors:
+            return ExecutionResult(errors=document.validation_errors, invalid=True)
+
+        depth, cost = measure_query(self.schema, document.document_ast, operation_name, variables)
+        errors = check_limits(depth, cost)
+        if errors:
+            return ExecutionResult(errors=errors, invalid=True)
+
+        # queries may read from replicas until the request runs a mutation
+        if document.get_operation_type(operation_name) == 'query':
+            routers.allow_replica_reads()
+        else:
+            routers.pin_primary()
+
+        result = super().execute_graphql_request(
+            request, data, query, variables, operation_name, show_graphiql
+        )
+        if result is not None:
+            result.extensions['cost'] = {
+                'depth': depth,
+                'cost': cost,
+                'max_depth': settings.QUERY_MAX_DEPTH,
+                'max_cost': settings.QUERY_MAX_COST,
+            }
+
+        return result
+
+    @staticmethod
+    def get_persisted_query_hash(request, data):
+        extensions = request.GET.get('extensions') or data.get('extensions')
+        if not extensions:
+            return None
+
+        if isinstance(extensions, str):
+            try:
+                extensions = json.loads(extensions)
+            except ValueError:
+                raise HttpError(HttpResponseBadRequest('Extensions are invalid JSON.'))
+
+        persisted_query = extensions.get('persistedQuery')
+        if not isinstance(persisted_query, dict):
+            return None
+
+        if persisted_query.get('version') != 1:
+            raise HttpError(HttpResponseBadRequest('Unsupported persisted query version.'))
+
+        return persisted_query.get('sha256Hash')
+
+    def resolve_persisted_query(self, request, data):
+        """
+        Return the request data with the query text of the persisted query,
+        registering it first if the text was sent along with its hash.
+        """
+        document_hash = self.get_persisted_query_hash(request, data)
+        if document_hash is None:
+            return data
+
+        query = request.GET.get('query') or data.get('query')
+        if query:
+            if query_hash(query) != document_hash:
+                raise HttpError(HttpResponseBadRequest('Provided sha does not match query.'))
+            cache.set(
+                persisted_query_key(document_hash),
+                query,
+                settings.PERSISTED_QUERY_TIMEOUT
+            )
+            return data
+
+        document = backend.get_document(document_hash)
+        if document is not None:
+            query = document.document_string
+        else:
+            query = cache.get(persisted_query_key(document_hash))
+            if query is None:
+                raise PersistedQueryNotFound()
+
+        data = dict(data.items())
+        data['query'] = query
+        return data
+
+
+def parse_moment(value):
+    """
+    Parse an ISO datetime, or date meaning its midnight, as an aware datetime.
+    """
+    moment = parse_datetime(value)
+    if moment is None:
+        day = parse_date(value)
+        if day is None:
+            raise ValueError(f'Invalid date: {value}')
+        moment = datetime.combine(day, time())
+
+    if timezone.is_naive(moment):
+        moment = timezone.make_aware(moment)
+
+    return moment
+
+
+@require_GET
+def export(request, kind):
+    """
+    Stream a kind of rows of luci.export as NDJSON, optionally gzip compressed.
+    Accepts the reference, since and until (exclusive) filters.
+    """
+    if kind not in EXPORTS:
+        raise Http404(f'Unknown export: {kind}')
+
+    try:
+        since = request.GET.get('since')
+        since = parse_moment(since) if since else None
+        until = request.GET.get('until')
+        until = parse_moment(until) if until else None
+    except ValueError as ex:
+        return HttpResponseBadRequest(str(ex))
+
+    compress = request.GET.get('gzip') in ('1', 'true')
+    records = routers.read_from_replicas(EXPORTS[kind](
+        reference=request.GET.get('reference'),
+        since=since,
+        until=until
+    ))
+
+    filename = f'{kind}.ndjson'
+    if compress:
+        response = StreamingHttpResponse(to_ndjson(records, compress=True), content_type='application/gzip')
+        filename += '.gz'
+    else:
+        response = StreamingHttpResponse(to_ndjson(records), content_type='application/x-ndjson')
+    response['Content-Disposition'] = f'attachment; filename="{filename}"'
+
+    return response
+
+
+@require_GET
+def health(request):
+    """
+    Report if the primary database and the replicas answer queries.
+    Fails with 503 if the primary does not.
+    """
+    primary = routers.check_database(DEFAULT_DB_ALIAS)
+    replicas = {alias: routers.is_healthy(alias) for alias in settings.DATABASE_REPLICAS}
+    return JsonResponse(
+        {'database': primary, 'replicas': replicas},
+        status=200 if primary else 503
+    )